@@ -0,0 +1,225 @@
+"""
+Benchmarks for the plan collaboration designs.
+
+Builds a synthetic plan genealogy - a root plan with some number of activities, and a tree of duplicates
+of configurable depth and fan-out - edits every duplicate, and then merges every duplicate back into its
+parent, deepest first. Every call to the interface is timed, per implementation.
+
+Usage:
+    python bench.py --activities 1000 --depth 2 --fan-out 3 --output bench_results.json
+
+Implementations that cannot be instantiated, or that do not support an operation (by raising
+NotImplementedError), are reported as such rather than failing the whole run.
+"""
+
+import argparse
+import importlib
+import json
+import random
+import sys
+import time
+
+IMPLEMENTATIONS = ["snapshots", "sqlite_snapshots", "status_quo", "event_log", "revision_counters"]
+
+
+class Timings:
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, operation, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.samples.setdefault(operation, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        summary = {}
+        for operation, samples in self.samples.items():
+            samples = sorted(samples)
+            summary[operation] = {
+                "count": len(samples),
+                "total": sum(samples),
+                "mean": sum(samples) / len(samples),
+                "min": samples[0],
+                "median": samples[len(samples) // 2],
+                "max": samples[-1],
+            }
+        return summary
+
+
+def make_genealogy(db, timings, rng, activities, depth, fan_out):
+    """
+    :return: the root plan id, and a list of (plan_id, parent_plan_id) for every duplicate, in creation order
+    """
+    root = timings.time("make_fresh_plan", db.make_fresh_plan)
+    for i in range(activities):
+        timings.time("add_activity", db.add_activity, root, start_time=i, args={"index": i, "value": rng.random()})
+
+    edges = []
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for _ in range(fan_out):
+                child = timings.time("duplicate", db.duplicate, parent)
+                edges.append((child, parent))
+                next_level.append(child)
+        level = next_level
+    return root, edges
+
+
+def edit_plan(db, timings, rng, plan_id, edit_rate):
+    """
+    Modifies, deletes and adds a fraction of the plan's activities
+    :return: the ids of the activities that were modified
+    """
+    activity_ids = list(db.get_activity_ids(plan_id))
+    edited = rng.sample(activity_ids, int(len(activity_ids) * edit_rate))
+    deleted = edited[:len(edited) // 4]
+    modified = edited[len(edited) // 4:]
+    for activity_id in modified:
+        timings.time("modify_activity", db.modify_activity, plan_id, activity_id, rng.randrange(1000), {"value": rng.random()})
+    for activity_id in deleted:
+        timings.time("delete_activity", db.delete_activity, plan_id, activity_id)
+    for _ in range(len(deleted)):
+        timings.time("add_activity", db.add_activity, plan_id, start_time=rng.randrange(1000), args={"value": rng.random()})
+    return modified
+
+
+def read_plan(db, timings, rng, plan_id, reads):
+    activity_ids = timings.time("get_activity_ids", db.get_activity_ids, plan_id)
+    for activity_id in rng.sample(list(activity_ids), min(reads, len(activity_ids))):
+        timings.time("get_activity_type", db.get_activity_type, plan_id, activity_id)
+        timings.time("get_activity_start_time", db.get_activity_start_time, plan_id, activity_id)
+        timings.time("get_activity_args", db.get_activity_args, plan_id, activity_id)
+
+
+def merge(db, timings, plan_supplying_changes, plan_receiving_changes):
+    """
+    Merges, resolving all conflicts in favor of the supplier
+    :return: the number of conflicts, or None if there was nothing to merge
+    """
+    try:
+        merge_id = timings.time("request_merge", db.request_merge, plan_supplying_changes, plan_receiving_changes)
+    except Exception as e:
+        if e.args and e.args[0] == "Cannot request merge with empty changeset":
+            return None
+        raise
+    conflicts = timings.time("begin_merge", db.begin_merge, merge_id)
+    if isinstance(conflicts, int):
+        # The conflicts were left in storage (see interface.begin_merge)
+        conflict_count = conflicts
+    else:
+        # Implementations without a merge workflow, like status_quo, return None
+        conflict_count = len(list(conflicts or []))
+    if conflict_count:
+        timings.time("resolve_conflicts_bulk", db.resolve_conflicts_bulk, merge_id, "CHANGE_SUPPLIER")
+    timings.time("commit_merge", db.commit_merge, merge_id)
+    return conflict_count
+
+
+def run(implementation, activities=100, depth=2, fan_out=2, edit_rate=0.1, conflict_rate=0.1, reads=10, seed=0):
+    """
+    Runs the benchmark against one implementation
+    :return: a dict of results that can be serialized as JSON
+    """
+    result = {"implementation": implementation}
+    try:
+        db = importlib.import_module(implementation).PlanCollaborationInterface()
+    except Exception as e:
+        result["skipped"] = "%s: %s" % (type(e).__name__, e)
+        return result
+
+    rng = random.Random(seed)
+    timings = Timings()
+    stages = {}
+    conflicts = 0
+    merges = 0
+
+    def stage(name, function):
+        stages[name] = "ok"
+        try:
+            function()
+        except NotImplementedError as e:
+            stages[name] = "unsupported (%s: %s)" % (type(e).__name__, e)
+            return False
+        return True
+
+    state = {}
+
+    def build():
+        state["root"], state["edges"] = make_genealogy(db, timings, rng, activities, depth, fan_out)
+
+    def edit():
+        state["modified"] = {}
+        for child, parent in state["edges"]:
+            state["modified"][child] = edit_plan(db, timings, rng, child, edit_rate)
+
+    def read():
+        for child, _ in state["edges"]:
+            read_plan(db, timings, rng, child, reads)
+        read_plan(db, timings, rng, state["root"], reads)
+
+    def merge_all():
+        nonlocal conflicts, merges
+        for child, parent in reversed(state["edges"]):
+            parent_activity_ids = set(db.get_activity_ids(parent))
+            candidates = [activity_id for activity_id in state["modified"][child] if activity_id in parent_activity_ids]
+            for activity_id in rng.sample(candidates, int(len(candidates) * conflict_rate)):
+                # Modify the same activity differently in the receiving plan, to make a conflict
+                db.modify_activity(parent, activity_id, -1, {"conflict": rng.random()})
+            merge_conflicts = merge(db, timings, child, parent)
+            if merge_conflicts is not None:
+                merges += 1
+                conflicts += merge_conflicts
+
+    try:
+        stage("build", build) and stage("edit", edit) and stage("read", read) and stage("merge", merge_all)
+    finally:
+        if hasattr(db, "close"):
+            db.close()
+
+    result["stages"] = stages
+    result["merges"] = merges
+    result["conflicts"] = conflicts
+    result["operations"] = timings.summary()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--implementations", nargs="+", default=IMPLEMENTATIONS)
+    parser.add_argument("--activities", type=int, default=100, help="number of activities in the root plan")
+    parser.add_argument("--depth", type=int, default=2, help="depth of the tree of duplicates")
+    parser.add_argument("--fan-out", type=int, default=2, help="number of duplicates of each plan in the tree")
+    parser.add_argument("--edit-rate", type=float, default=0.1, help="fraction of each duplicate's activities to edit")
+    parser.add_argument("--conflict-rate", type=float, default=0.1, help="fraction of edited activities to also modify in the parent")
+    parser.add_argument("--reads", type=int, default=10, help="number of activities to read from each plan")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to (defaults to stdout)")
+    args = parser.parse_args(argv)
+
+    config = {
+        "activities": args.activities,
+        "depth": args.depth,
+        "fan_out": args.fan_out,
+        "edit_rate": args.edit_rate,
+        "conflict_rate": args.conflict_rate,
+        "reads": args.reads,
+        "seed": args.seed,
+    }
+    results = {
+        "config": config,
+        "python": sys.version,
+        "results": [run(implementation, **config) for implementation in args.implementations],
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
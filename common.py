@@ -0,0 +1,45 @@
+"""
+Types shared by the snapshot designs (snapshots.py and sqlite_snapshots.py).
+"""
+
+
+class Printable:
+    __slots__ = ()
+
+    def __repr__(self):
+        return repr({name: getattr(self, name) for name in self.__slots__})
+
+
+class Conflict(Printable):
+    """
+    A conflict of an in-progress merge, by reference rather than with copies of the activity versions: each side's
+    change is "MODIFY" or "DELETE", and its version is the activity in the supplier's snapshot or in the receiving plan.
+    The versions can be read with get_conflict, or with get_activity_* for the receiver's.
+    """
+    __slots__ = ("conflict_index", "activity_id", "supplier_change", "receiver_change", "supplier_snapshot_id", "receiver_plan_id", "resolution")
+
+    def __init__(self, conflict_index, activity_id, supplier_change, receiver_change, supplier_snapshot_id, receiver_plan_id, resolution):
+        self.conflict_index = conflict_index
+        self.activity_id = activity_id
+        self.supplier_change = supplier_change
+        self.receiver_change = receiver_change
+        self.supplier_snapshot_id = supplier_snapshot_id
+        self.receiver_plan_id = receiver_plan_id
+        self.resolution = resolution
+
+
+def in_window(window, start_time):
+    """
+    :param window: (start_time, end_time), either of which may be None if unbounded, or None for no window
+    """
+    if window is None:
+        return True
+    return (window[0] is None or window[0] <= start_time) and (window[1] is None or start_time <= window[1])
+
+
+def intersect_windows(window, other_window):
+    if window is None:
+        return other_window
+    start_times = [start_time for start_time in (window[0], other_window[0]) if start_time is not None]
+    end_times = [end_time for end_time in (window[1], other_window[1]) if end_time is not None]
+    return max(start_times, default=None), min(end_times, default=None)
@@ -1,15 +1,216 @@
+import bisect
+from array import array
+
 import interface
 
+# A copy of a plan's state is taken every CHECKPOINT_INTERVAL events in that plan, or every N events
+# for a plan with N activities if that is more, so that copying states costs O(1) per event.
+# The state at any event can then be rebuilt by replaying about as many events as it takes to copy the state.
+# Only the latest checkpoint of each plan, and the ids of the plan's events since, are kept in memory: older
+# checkpoints, each with the ids of the plan's events until the next, are kept by a checkpoint store (see
+# CheckpointStore), so that memory does not grow with the length of the log if the store is on disk.
+CHECKPOINT_INTERVAL = 64
+
 class Event:
     def __init__(self, event_id, plan_id, payload): ### ??
         self.event_id = event_id
         self.plan_id = plan_id
         self.payload = payload
 
+class MergeRequest:
+    def __init__(self, id, plan_supplying_changes, plan_receiving_changes, supplier_event_id, base_state, supplier_changes):
+        self.id = id
+        self.state = "REQUESTED"
+        self.plan_supplying_changes = plan_supplying_changes
+        self.plan_receiving_changes = plan_receiving_changes
+        # The latest event of the plan_supplying_changes as of the request
+        self.supplier_event_id = supplier_event_id
+        # State of the merge base, and the changes of the plan_supplying_changes since then, as of the request
+        self.base_state = base_state
+        self.supplier_changes = supplier_changes
+        self.staging_plan_id = None
+        # (activity id, supplier's activity or "DELETE", receiver's activity or "DELETE")
+        self.conflicts = []
+        self.decisions = []
+        # Ids of the activities written to the staging plan
+        self.staged_activity_ids = set()
+
+class CheckpointStore:
+    """
+    Keeps checkpoints in memory, for event logs that do not store them (see event_store.SegmentedEventLog.write_checkpoint)
+    """
+    def __init__(self):
+        self.checkpoints = {}  # (plan id, event id) -> (state, event ids)
+
+    def write_checkpoint(self, plan_id, event_id, state, event_ids):
+        """
+        :param state: the plan's state after the event
+        :param event_ids: the ids of the plan's events from this checkpoint until the next
+        """
+        self.checkpoints[(plan_id, event_id)] = (state, event_ids)
+
+    def read_checkpoint(self, plan_id, event_id):
+        return self.checkpoints[(plan_id, event_id)][0]
+
+    def read_checkpoint_event_ids(self, plan_id, event_id):
+        return self.checkpoints[(plan_id, event_id)][1]
+
+    def drop_checkpoint(self, plan_id, event_id):
+        del self.checkpoints[(plan_id, event_id)]
+
 class PlanCollaborationInterface(interface.PlanCollaborationInterface):
-    def __init__(db):
+    def __init__(db, event_log=None):
+        """
+        :param event_log: where to store events - by default, an in-memory list. Pass an
+                          event_store.SegmentedEventLog to keep them on disk; its existing events are replayed.
+                          If it can store checkpoints, they are kept there too.
+        """
         db.event_log = []
+        db.checkpoint_store = event_log if hasattr(event_log, "write_checkpoint") else CheckpointStore()
         db.plan_counter = 0
+        db.activity_counter = 0
+
+        # Materialized state of every plan as of the latest event, kept up to date as events are appended.
+        # Maps plan id to a dict of activity id to {"type", "start_time", "args"}. The activity dicts are
+        # replaced rather than modified, so that copies of a plan's state can share them.
+        db.projections = {}
+        # Maps plan id to its latest checkpoint: (event id, copy of the plan's state after that event).
+        # The first is the plan's state when it was created, the merge base of the plans duplicated from it.
+        db.checkpoints = {}
+        # Maps plan id to the event ids of all its checkpoints, in order. The older ones are in db.checkpoint_store.
+        db.checkpoint_ids = {}
+        # Maps plan id to the number of events applied to the plan since its last checkpoint
+        db.events_since_checkpoint = {}
+
+        # Indexes over the event log
+        db.creation_events = {}  # plan id -> the PLAN_CREATED event of that plan
+        db.plan_event_ids = {}  # plan id -> ids of that plan's events since its latest checkpoint (included), in order
+        db.children = {}  # plan id -> ids of the plans duplicated from it
+        db.merges = {}  # plan id -> (MERGED event id, supplying plan id, supplier's event id) of the merges into it
+
+        db.deleted_plans = set()
+        # Deleted plans whose events have been dropped or folded into their children (see compact)
+        db.compacted_plans = set()
+        # State of the in-progress compaction, if any
+        db.compaction = None
+
+        # Merge requests are kept in memory only: a merge's effects are the events it appends to the plans
+        db.merge_requests = {}  # merge id -> MergeRequest
+        db.merge_locks = {}  # plan id -> id of the in-progress merge that locks it, as its receiving or staging plan
+
+        if event_log is not None:
+            for event in event_log:
+                db.apply_event(event)
+                db.plan_counter = max(db.plan_counter, event.plan_id + 1)
+                if event.payload["type"] == "ACTIVITY_CREATED":
+                    db.activity_counter = max(db.activity_counter, event.payload["activity_id"] + 1)
+            db.event_log = event_log
+
+    def append_event(db, plan_id, payload):
+        if plan_id in db.deleted_plans:
+            raise Exception("Plan %d is deleted" % plan_id)
+        event = Event(len(db.event_log), plan_id, payload)
+        db.event_log.append(event)
+        db.apply_event(event)
+        return event
+
+    def check_writable(db, plan_id):
+        if plan_id in db.merge_locks:
+            raise Exception("Plan %s is locked by in-progress merge %s" % (plan_id, db.merge_locks[plan_id]))
+
+    def apply_event(db, event):
+        """
+        Updates the indexes and the projection of the event's plan, and checkpoints it if needed
+        """
+        db.plan_event_ids.setdefault(event.plan_id, array("q")).append(event.event_id)
+        if event.payload["type"] == "PLAN_CREATED":
+            db.creation_events[event.plan_id] = event
+            parent = event.payload["parent"]
+            if parent is not None:
+                db.children.setdefault(parent, []).append(event.plan_id)
+            if "state" in event.payload:
+                # Folded by compaction, because the parent's events are gone
+                db.projections[event.plan_id] = {activity_id: activity for activity_id, activity in event.payload["state"]}
+            else:
+                db.projections[event.plan_id] = {} if parent is None else dict(db.projections[parent])
+            db.checkpoint(event)
+            return
+        if event.payload["type"] == "PLAN_DELETED":
+            db.deleted_plans.add(event.plan_id)
+            if event.plan_id not in db.creation_events:
+                db.compacted_plans.add(event.plan_id)
+            return
+        if event.payload["type"] == "MERGED":
+            db.merges.setdefault(event.plan_id, []).append((event.event_id, event.payload["supplier"], event.payload["supplier_event_id"]))
+
+        apply_payload(db.projections[event.plan_id], event.payload)
+        db.events_since_checkpoint[event.plan_id] += 1
+        if db.events_since_checkpoint[event.plan_id] >= max(CHECKPOINT_INTERVAL, len(db.projections[event.plan_id])):
+            db.checkpoint(event)
+
+    def checkpoint(db, event):
+        plan_id = event.plan_id
+        if plan_id in db.checkpoints:
+            checkpoint_event_id, state = db.checkpoints[plan_id]
+            db.checkpoint_store.write_checkpoint(plan_id, checkpoint_event_id, state, db.plan_event_ids[plan_id][:-1])
+        db.checkpoints[plan_id] = (event.event_id, dict(db.projections[plan_id]))
+        db.checkpoint_ids.setdefault(plan_id, array("q")).append(event.event_id)
+        db.events_since_checkpoint[plan_id] = 0
+        db.plan_event_ids[plan_id] = array("q", [event.event_id])
+
+    def get_checkpoint(db, plan_id, checkpoint_event_id):
+        """
+        :return: the plan's state as of its checkpoint at the given event
+        """
+        if db.checkpoints[plan_id][0] == checkpoint_event_id:
+            return db.checkpoints[plan_id][1]
+        return db.checkpoint_store.read_checkpoint(plan_id, checkpoint_event_id)
+
+    def get_checkpoint_event_ids(db, plan_id, checkpoint_event_id):
+        """
+        :return: the ids of the plan's events from its checkpoint at the given event until the next checkpoint
+        """
+        if db.checkpoints[plan_id][0] == checkpoint_event_id:
+            return db.plan_event_ids[plan_id]
+        return db.checkpoint_store.read_checkpoint_event_ids(plan_id, checkpoint_event_id)
+
+    def get_plan_state_at(db, plan_id, event_id):
+        """
+        Rebuilds the state of a plan as of the given event, by replaying the plan's events since the nearest checkpoint
+        :return: a dict of activity id to {"type", "start_time", "args"}, or None if the plan did not exist yet
+        """
+        checkpoint_ids = db.checkpoint_ids[plan_id]
+        index = bisect.bisect_right(checkpoint_ids, event_id) - 1
+        if index < 0:
+            return None
+        state = dict(db.get_checkpoint(plan_id, checkpoint_ids[index]))
+        for event in db.get_events_since(plan_id, checkpoint_ids[index], event_id):
+            apply_payload(state, event.payload)
+        return state
+
+    def get_event_ids_since(db, plan_id, event_id, until_event_id=None):
+        """
+        :return: the ids of the given plan's events greater than event_id (and at most until_event_id), in order
+        """
+        if plan_id not in db.checkpoint_ids:
+            # Compacted: only the events that compaction kept are left
+            chunks = [db.plan_event_ids.get(plan_id, [])]
+        else:
+            checkpoint_ids = db.checkpoint_ids[plan_id]
+            first = max(bisect.bisect_right(checkpoint_ids, event_id) - 1, 0)
+            last = len(checkpoint_ids) if until_event_id is None else bisect.bisect_right(checkpoint_ids, until_event_id)
+            chunks = [db.get_checkpoint_event_ids(plan_id, checkpoint_ids[index]) for index in range(first, last)]
+        end = len(db.event_log) if until_event_id is None else until_event_id + 1
+        event_ids = []
+        for chunk in chunks:
+            event_ids.extend(chunk[bisect.bisect_right(chunk, event_id):bisect.bisect_left(chunk, end)])
+        return event_ids
+
+    def get_events_since(db, plan_id, event_id, until_event_id=None):
+        """
+        :return: the events of the given plan with ids greater than event_id (and at most until_event_id), in order
+        """
+        return [db.event_log[i] for i in db.get_event_ids_since(plan_id, event_id, until_event_id)]
 
     def make_fresh_plan(db):
         """
@@ -17,7 +218,7 @@ class PlanCollaborationInterface(interface.PlanCollaborationInterface):
         :return: the new plan id
         """
         new_plan_id = db.plan_counter
-        db.event_log.append(Event(len(db.event_log), new_plan_id, {"type": "PLAN_CREATED", "parent": None}))  # TBD: child?
+        db.append_event(new_plan_id, {"type": "PLAN_CREATED", "parent": None})  # TBD: child?
         db.plan_counter += 1
         return new_plan_id
 
@@ -25,16 +226,16 @@ class PlanCollaborationInterface(interface.PlanCollaborationInterface):
         """
         :return: the activity ids of all activities in the given plan
         """
-        pass
+        return list(db.projections[plan_id])
 
     def get_activity_type(db, plan_id, activity_id):
-        pass
+        return db.projections[plan_id][activity_id]["type"]
 
     def get_activity_args(db, plan_id, activity_id):
-        pass
+        return db.projections[plan_id][activity_id]["args"]
 
     def get_activity_start_time(db, plan_id, activity_id):
-        pass
+        return db.projections[plan_id][activity_id]["start_time"]
 
     def is_same_activity(db, plan_id_1, activity_id_1, plan_id_2, activity_id_2):
         """
@@ -48,90 +249,403 @@ class PlanCollaborationInterface(interface.PlanCollaborationInterface):
         Add a new activity to the given plan
         :return: the id of the "persistent identity" of the new activity
         """
-        db.event_log.append(Event(len(db.event_log), plan_id, {
+        db.check_writable(plan_id)
+        activity_id = db.activity_counter
+        db.activity_counter += 1
+        db.append_event(plan_id, {
             "type": "ACTIVITY_CREATED",
+            "activity_id": activity_id,
             "activity_type": type,
             "start_time": start_time,
             "args": args
-        }))
+        })
+        return activity_id
 
     def modify_activity(db, plan_id, activity_id, new_start_time, new_activity_args):
-        db.event_log.append(Event(len(db.event_log), plan_id, {
+        db.check_writable(plan_id)
+        db.append_event(plan_id, {
             "type": "ACTIVITY_MODIFIED",
             "activity_id": activity_id,
             "new_start_time": new_start_time,
             "new_args": new_activity_args
-        }))
+        })
 
     def delete_activity(db, plan_id, activity_id):
-        db.event_log.append(Event(len(db.event_log), plan_id, {
+        db.check_writable(plan_id)
+        db.append_event(plan_id, {
             "type": "ACTIVITY_DELETED",
             "activity_id": activity_id,
-        }))
+        })
 
     def duplicate(db, plan_id):
+        if plan_id in db.deleted_plans:
+            raise Exception("Plan %d is deleted" % plan_id)
         new_plan_id = db.plan_counter
-        db.event_log.append(Event(len(db.event_log), new_plan_id, {
+        db.append_event(new_plan_id, {
             "type": "PLAN_CREATED",
             "parent": plan_id
-        }))
+        })
         db.plan_counter += 1
         return new_plan_id
 
-    def merge(db, source_plan, target_plan):
-        # merge_base is the id of most recent event that precedes all changes on both sides of the merge
-        merge_base_event_id, common_ancestor_plan_id = db.get_merge_base(source_plan, target_plan)
+    def put_activity(db, plan_id, activity_id, activity):
+        """
+        Writes a version of an activity (a {"type", "start_time", "args"} dict) to the plan, or deletes the
+        activity if it is None. Nothing is written if the plan already has that version.
+        """
+        state = db.projections[plan_id]
+        if activity is None:
+            if activity_id in state:
+                db.append_event(plan_id, {"type": "ACTIVITY_DELETED", "activity_id": activity_id})
+        elif activity_id not in state:
+            db.append_event(plan_id, {
+                "type": "ACTIVITY_CREATED",
+                "activity_id": activity_id,
+                "activity_type": activity["type"],
+                "start_time": activity["start_time"],
+                "args": activity["args"]
+            })
+        elif state[activity_id] != activity:
+            db.append_event(plan_id, {
+                "type": "ACTIVITY_MODIFIED",
+                "activity_id": activity_id,
+                "new_start_time": activity["start_time"],
+                "new_args": activity["args"]
+            })
 
-        # Set of new activities in source that should be added to target
+    def get_merge_base(db, source_plan, target_plan):
+        """
+        Finds the latest state that the current states of both plans descend from. A plan's state descends from
+        its parent's state when it was duplicated, and from the supplying plan's state as of the request of
+        every merge committed into it (see commit_merge), so the merge base moves forward with every merge
+        between the plans, like the snapshots designs' latest common snapshot.
+        :return: (event id, plan id): the merge base is the state of that plan as of that event
+        """
+        source_ancestors = db.get_ancestor_states(source_plan)
+        target_ancestors = db.get_ancestor_states(target_plan)
+        common_ancestors = source_ancestors.keys() & target_ancestors.keys()
+        if not common_ancestors:
+            raise UnrelatedPlans()
+        # The states of a plan are in order, so each side descends from all of them up to its latest; the
+        # most recent merge base is the latest state of any plan that both sides descend from
+        return max((min(source_ancestors[plan_id], target_ancestors[plan_id]), plan_id) for plan_id in common_ancestors)
 
-        # get set of all activities that have been created between merge base and source
-        # remove all activities that have been deleted..?
+    def get_ancestor_states(db, plan_id):
+        """
+        :return: a dict of plan id to the id of the latest event of that plan whose state the given plan's
+                 current state descends from (or len(event_log) for the plan itself)
+        """
+        ancestors = {plan_id: len(db.event_log)}
+        stack = [plan_id]
+        while stack:
+            plan_id = stack.pop()
+            edges = []
+            creation_event = db.creation_events.get(plan_id)
+            if creation_event is not None and creation_event.payload["parent"] is not None:
+                edges.append((creation_event.payload["parent"], creation_event.event_id))
+            for merge_event_id, supplier, supplier_event_id in db.merges.get(plan_id, []):
+                # The states of a compacted plan can no longer be rebuilt, so it cannot be a merge base
+                if merge_event_id <= ancestors[plan_id] and supplier not in db.compacted_plans:
+                    edges.append((supplier, supplier_event_id))
+            for ancestor, event_id in edges:
+                if ancestors.get(ancestor, -1) < event_id:
+                    ancestors[ancestor] = event_id
+                    stack.append(ancestor)
+        return ancestors
 
-        # Question: Should we track activities as their own entities
+    def get_merge_base_state(db, plan_id, event_id):
+        """
+        :return: the state of the plan as of the event (see get_merge_base)
+        """
+        event = db.event_log[event_id]
+        if event is not None and event.plan_id != plan_id:
+            # The merge base is where a plan was duplicated from this one, which is that plan's initial state
+            return db.get_initial_state(event.plan_id)
+        return db.get_plan_state_at(plan_id, event_id)
 
-        # Set of activities that have been modified between the merge base and the source
-        # Set of activities that have been modified between the merge base and the target
+    def get_initial_state(db, plan_id):
+        """
+        :return: the state of the plan when it was created, that is, of its parent at that point
+        """
+        creation_event = db.creation_events[plan_id]
+        if "state" in creation_event.payload:
+            return {activity_id: activity for activity_id, activity in creation_event.payload["state"]}
+        return db.get_checkpoint(plan_id, creation_event.event_id)
+
+    def request_merge(db, plan_supplying_changes, plan_receiving_changes):
+        """
+        Diffs the plan_supplying_changes against the merge base (see get_merge_base). Activities are compared
+        as a whole, so two different changes to the same activity conflict even if they changed different fields.
+        :return: the merge request id
+        """
+        if plan_supplying_changes == plan_receiving_changes:
+            raise Exception("Cannot merge a plan into itself")
+        for plan_id in (plan_supplying_changes, plan_receiving_changes):
+            if plan_id in db.deleted_plans:
+                raise Exception("Plan %d is deleted" % plan_id)
+        merge_base_event_id, merge_base_plan_id = db.get_merge_base(plan_supplying_changes, plan_receiving_changes)
+        base_state = db.get_merge_base_state(merge_base_plan_id, merge_base_event_id)
+        supplier_changes = diff_states(base_state, db.projections[plan_supplying_changes])
+        if not supplier_changes:
+            raise Exception("Cannot request merge with empty changeset")
+        merge_id = len(db.merge_requests)
+        db.merge_requests[merge_id] = MergeRequest(
+            merge_id,
+            plan_supplying_changes,
+            plan_receiving_changes,
+            db.plan_event_ids[plan_supplying_changes][-1],
+            base_state,
+            supplier_changes
+        )
+        return merge_id
+
+    def begin_merge(db, merge_request_id):
+        """
+        Locks the plan_receiving_changes, and writes the changes that do not conflict to a staging plan: a
+        duplicate of the plan_receiving_changes that can only be changed by resolving conflicts. Until a
+        conflict is resolved, the staging plan has the receiver's version of the activity.
+        :return: the conflicts, as (activity_id, supplier's activity or "DELETE", receiver's activity or "DELETE")
+        """
+        merge_request = db.merge_requests[merge_request_id]
+        if merge_request.state != "REQUESTED":
+            raise Exception("Cannot begin a merge in state " + merge_request.state)
+        for plan_id in (merge_request.plan_supplying_changes, merge_request.plan_receiving_changes):
+            if plan_id in db.deleted_plans:
+                raise Exception("Plan %d is deleted" % plan_id)
+        db.check_writable(merge_request.plan_receiving_changes)
+
+        receiver_changes = diff_states(merge_request.base_state, db.projections[merge_request.plan_receiving_changes])
+        non_conflicting_changes = {}
+        conflicts = []
+        for activity_id, activity in merge_request.supplier_changes.items():
+            if activity_id not in receiver_changes:
+                non_conflicting_changes[activity_id] = activity
+            elif receiver_changes[activity_id] != activity:
+                receiver_activity = receiver_changes[activity_id]
+                conflicts.append((activity_id, "DELETE" if activity is None else activity, "DELETE" if receiver_activity is None else receiver_activity))
+
+        merge_request.staging_plan_id = db.duplicate(merge_request.plan_receiving_changes)
+        for activity_id, activity in non_conflicting_changes.items():
+            db.stage(merge_request, activity_id, activity)
+        db.merge_locks[merge_request.plan_receiving_changes] = merge_request.id
+        db.merge_locks[merge_request.staging_plan_id] = merge_request.id
+        merge_request.conflicts = conflicts
+        merge_request.decisions = [None] * len(conflicts)
+        merge_request.state = "INPROGRESS"
+        return conflicts
+
+    def stage(db, merge_request, activity_id, activity):
+        merge_request.staged_activity_ids.add(activity_id)
+        db.put_activity(merge_request.staging_plan_id, activity_id, activity)
+
+    def get_merge_status(db, merge_id):
+        return db.merge_requests[merge_id].state
+
+    def resolve_conflict(db, merge_id, conflict_index, resolution):
+        """
+        Resolution is either "CHANGE_SUPPLIER" or "CHANGE_RECEIVER"
+
+        A resolution chooses an activity version from one plan or the other
+        """
+        db.resolve_conflicts_bulk(merge_id, [(conflict_index, resolution)])
+
+    def resolve_conflicts_bulk(db, merge_id, resolutions):
+        """
+        Applies multiple resolutions at once.
+        :param resolutions: either "CHANGE_SUPPLIER" or "CHANGE_RECEIVER", to resolve every conflict that way,
+                            or a list of (conflict_index, resolution) pairs
+        """
+        merge_request = db.merge_requests[merge_id]
+        if merge_request.state != "INPROGRESS":
+            raise Exception("Cannot resolve conflicts of a merge in state " + merge_request.state)
+        if isinstance(resolutions, str):
+            resolutions = [(conflict_index, resolutions) for conflict_index in range(len(merge_request.conflicts))]
+        else:
+            resolutions = list(resolutions)
+        for conflict_index, resolution in resolutions:
+            if resolution not in ("CHANGE_SUPPLIER", "CHANGE_RECEIVER"):
+                raise Exception("Invalid resolution: " + repr(resolution))
+            if not 0 <= conflict_index < len(merge_request.decisions):
+                raise Exception("Invalid conflict index: " + repr(conflict_index))
+        for conflict_index, resolution in resolutions:
+            merge_request.decisions[conflict_index] = resolution
+            activity_id, supplier, receiver = merge_request.conflicts[conflict_index]
+            version = supplier if resolution == "CHANGE_SUPPLIER" else receiver
+            db.stage(merge_request, activity_id, None if version == "DELETE" else version)
+
+    def commit_merge(db, merge_id):
+        """
+        Checks that the merge is fully resolved, and writes the activities in the staging plan that the merge
+        changed to the plan_receiving_changes, followed by a MERGED event that makes the supplier's state as of
+        the request an ancestor of the plan_receiving_changes (see get_merge_base). Marks the merge as
+        "COMMITTED", which unlocks the plan_receiving_changes, and deletes the staging plan.
+        """
+        merge_request = db.merge_requests[merge_id]
+        if merge_request.state != "INPROGRESS":
+            raise Exception("Cannot commit a merge in state " + merge_request.state)
+        if None in merge_request.decisions:
+            raise Exception("Merge cannot be committed until all conflicts are resolved")
+        staging_state = db.projections[merge_request.staging_plan_id]
+        for activity_id in sorted(merge_request.staged_activity_ids):
+            db.put_activity(merge_request.plan_receiving_changes, activity_id, staging_state.get(activity_id))
+        db.append_event(merge_request.plan_receiving_changes, {
+            "type": "MERGED",
+            "supplier": merge_request.plan_supplying_changes,
+            "supplier_event_id": merge_request.supplier_event_id
+        })
+        merge_request.state = "COMMITTED"
+        db.end_merge(merge_request)
+
+    def abort_merge(db, merge_id):
+        """
+        Marks the merge as "ABORTED", which unlocks the plan_receiving_changes, and deletes the staging plan
+        """
+        merge_request = db.merge_requests[merge_id]
+        if merge_request.state not in ("REQUESTED", "INPROGRESS"):
+            raise Exception("Cannot abort a merge in state " + merge_request.state)
+        in_progress = merge_request.state == "INPROGRESS"
+        merge_request.state = "ABORTED"
+        if in_progress:
+            db.end_merge(merge_request)
+
+    def end_merge(db, merge_request):
+        del db.merge_locks[merge_request.plan_receiving_changes]
+        del db.merge_locks[merge_request.staging_plan_id]
+        # Its events are reclaimed by compact
+        db.append_event(merge_request.staging_plan_id, {"type": "PLAN_DELETED"})
+        merge_request.base_state = merge_request.supplier_changes = None
+
+    def delete(db, plan_id):
+        """
+        Marks the plan as deleted. Its events are reclaimed by compact.
+        """
+        if plan_id in db.merge_locks:
+            merge_request = db.merge_requests[db.merge_locks[plan_id]]
+            if plan_id == merge_request.staging_plan_id:
+                raise Exception("Cannot delete the staging plan of merge %s" % merge_request.id)
+            raise Exception("Cannot delete a plan involved in an in-progress merge")
+        db.append_event(plan_id, {"type": "PLAN_DELETED"})
+
+    def compact(db, budget=1000):
+        """
+        Runs compaction for at most budget units of work (plans visited, or events folded or dropped),
+        so that it can be interleaved with other operations. Call it repeatedly to make progress.
+
+        A deleted plan that is an ancestor of a live plan is still needed to find merge bases, so its
+        PLAN_CREATED and PLAN_DELETED events are kept, and its initial state and its state when each of its
+        children was duplicated are folded into their PLAN_CREATED events; the rest of its events are dropped. A deleted plan with no live descendants is
+        dropped entirely, except for its PLAN_DELETED event, so that its id is not reused.
+
+        :return: True if a compaction cycle finished during this call
+        """
+        if db.compaction is None:
+            db.compaction = db.compaction_cycle()
+        for _ in range(budget):
+            try:
+                next(db.compaction)
+            except StopIteration:
+                db.compaction = None
+                return True
+        return False
+
+    def compaction_cycle(db):
+        # Plans deleted after this point are left for the next cycle. Plans created after this point are
+        # live, but they can only be duplicated from live plans, so they do not make any deleted plan needed.
+        deleted_plans = sorted(db.deleted_plans - db.compacted_plans)
+
+        needed_plans = set()
+        for plan_id in list(db.creation_events):
+            if plan_id not in db.deleted_plans:
+                while plan_id is not None and plan_id not in needed_plans:
+                    needed_plans.add(plan_id)
+                    plan_id = db.creation_events[plan_id].payload["parent"]
+            yield
+
+        for plan_id in deleted_plans:
+            if plan_id in needed_plans:
+                # Its initial state is still needed as the merge base of its descendants with its parent's
+                if "state" not in db.creation_events[plan_id].payload:
+                    db.fold(db.creation_events[plan_id])
+                for child in db.children.get(plan_id, []):
+                    creation_event = db.creation_events.get(child)
+                    if creation_event is not None and "state" not in creation_event.payload:
+                        db.fold(creation_event)
+                    yield
+                kept_event_ids = {db.creation_events[plan_id].event_id}
+            else:
+                parent = db.creation_events[plan_id].payload["parent"]
+                if parent in db.children:
+                    db.children[parent].remove(plan_id)
+                del db.creation_events[plan_id]
+                kept_event_ids = set()
+
+            # PLAN_DELETED is the plan's last event
+            kept_event_ids.add(db.plan_event_ids[plan_id][-1])
+            for event_id in db.get_event_ids_since(plan_id, -1):
+                if event_id not in kept_event_ids:
+                    db.event_log[event_id] = None
+                yield
+            for checkpoint_event_id in db.checkpoint_ids.pop(plan_id)[:-1]:
+                db.checkpoint_store.drop_checkpoint(plan_id, checkpoint_event_id)
+            db.plan_event_ids[plan_id] = array("q", sorted(kept_event_ids))
+            del db.projections[plan_id]
+            del db.checkpoints[plan_id]
+            del db.events_since_checkpoint[plan_id]
+            db.children.pop(plan_id, None)
+            db.merges.pop(plan_id, None)
+            db.compacted_plans.add(plan_id)
+
+        if hasattr(db.event_log, "compact"):
+            yield from db.event_log.compact()
+
+    def fold(db, creation_event):
+        """
+        Replaces a PLAN_CREATED event with one that holds the plan's initial state, so that it no longer
+        depends on its parent's events
+        """
+        state = db.get_initial_state(creation_event.plan_id)
+        payload = dict(creation_event.payload)
+        payload["state"] = [[activity_id, activity] for activity_id, activity in state.items()]
+        folded_event = Event(creation_event.event_id, creation_event.plan_id, payload)
+        db.event_log[creation_event.event_id] = folded_event
+        db.creation_events[creation_event.plan_id] = folded_event
+
+
+def diff_states(base, state):
+    """
+    :return: a dict of activity id to the activity in state, or None if it was deleted, for the activities
+             that differ between the two plan states
+    """
+    changes = {}
+    for activity_id, activity in state.items():
+        base_activity = base.get(activity_id)
+        if base_activity is not activity and base_activity != activity:
+            changes[activity_id] = activity
+    for activity_id in base:
+        if activity_id not in state:
+            changes[activity_id] = None
+    return changes
+
+
+def apply_payload(state, payload):
+    """
+    Applies an activity event to a plan state (a dict of activity id to {"type", "start_time", "args"})
+    """
+    if payload["type"] == "ACTIVITY_CREATED":
+        state[payload["activity_id"]] = {
+            "type": payload["activity_type"],
+            "start_time": payload["start_time"],
+            "args": payload["args"],
+        }
+    elif payload["type"] == "ACTIVITY_MODIFIED":
+        state[payload["activity_id"]] = {
+            "type": state[payload["activity_id"]]["type"],
+            "start_time": payload["new_start_time"],
+            "args": payload["new_args"],
+        }
+    elif payload["type"] == "ACTIVITY_DELETED":
+        del state[payload["activity_id"]]
 
-    def get_merge_base(db, source_plan, target_plan):
-        def get_creation_event(plan_id):
-            return [
-                event
-                for event in db.event_log
-                if event.payload["type"] == "PLAN_CREATED"
-                   and event.plan_id == plan_id
-            ]
-
-        def get_parent(plan_id):
-            return [
-                event.payload["parent"]
-                for event in get_creation_event(plan_id)
-            ]
-
-        # The nearest common ancestor is the plan of which both source and target are descendants.
-        # The pertinent version of the common ancestor is the version at the creation of the older
-        # ancestor plan
-        source_heritage = [source_plan]
-        target_heritage = [target_plan]
-        intersection = set(source_heritage).intersection(target_heritage)
-        while len(intersection) == 0:
-            source_ancestor = get_parent(source_heritage[-1])
-            source_heritage.extend(source_ancestor)
-            target_ancestor = get_parent(target_heritage[-1])
-            target_heritage.extend(target_ancestor)
-            intersection = set(source_heritage).intersection(target_heritage)
-        common_ancestor = list(intersection)[0]
-        if common_ancestor is None:
-            raise UnrelatedPlans()
-        # Clamp at 0 because if the common ancestor is in index zero, we don't want to loop around
-        source_ancestor_creation = \
-        get_creation_event(source_heritage[max(0, source_heritage.index(common_ancestor) - 1)])[0]
-        target_ancestor_creation = \
-        get_creation_event(target_heritage[max(0, target_heritage.index(common_ancestor) - 1)])[0]
-        # merge_base is the most recent event that precedes all changes on both sides of the merge
-        return min(source_ancestor_creation.event_id, target_ancestor_creation.event_id), common_ancestor
-
-    def delete(db, plan):
-        pass
 
 class UnrelatedPlans(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,382 @@
+"""
+A durable, append-only event log for the event log design.
+
+Events are written as length-prefixed binary records to segment files in a directory:
+
+    record = header payload
+    header = payload length (u32) | crc32 of payload (u32) | event id (i64) | plan id (i64)
+    payload = the event's payload, as UTF-8 JSON
+
+Each segment file is named after the id of its first event, and a new segment is started once the current
+one reaches segment_size bytes. Writes are made durable with group commit: fsync is called once per
+group_commit_size events, or at most group_commit_interval seconds after an event is appended, whichever
+comes first - by a timer thread if no more events are appended meanwhile. Call sync() to force it.
+
+Segments are read back through mmap, so replaying the log on startup does not load it into memory.
+Only a sparse index (the id and offset of every INDEX_INTERVAL-th record) is kept in memory for random access.
+A torn record at the end of the log (from a crash mid-write) is truncated when the log is opened.
+
+Older checkpoints of the plans' states (see event_log.CheckpointStore) are written to a checkpoints file in the
+same directory, so that they are not kept in memory either. Only their offsets are kept. The file is not made
+durable: it is rebuilt as the log is replayed on startup.
+
+Events can be replaced or dropped by compaction (log[event_id] = event, or None to drop it). The change is
+visible to readers immediately, and is written to the segment files by compact(). Event ids are never
+reused, so there are gaps in the ids once events have been dropped - reading a dropped event returns None.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+from event_log import Event
+
+HEADER = struct.Struct("<IIqq")
+INDEX_INTERVAL = 256
+SEGMENT_SUFFIX = ".log"
+TEMPORARY_SUFFIX = ".tmp"
+CHECKPOINTS_FILE = "checkpoints"
+
+
+class SegmentIndex:
+    """
+    Sparse index of a segment: the id and offset of every INDEX_INTERVAL-th record
+    """
+    def __init__(self):
+        self.records = 0
+        self.event_ids = array("q")
+        self.offsets = array("q")
+
+    def add(self, event_id, offset):
+        if self.records % INDEX_INTERVAL == 0:
+            self.event_ids.append(event_id)
+            self.offsets.append(offset)
+        self.records += 1
+
+    def find(self, event_id):
+        """
+        :return: the offset of an indexed record at or before the given event, or None if there is none
+        """
+        index = bisect.bisect_right(self.event_ids, event_id) - 1
+        return self.offsets[index] if index >= 0 else None
+
+
+class SegmentedEventLog:
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, group_commit_size=64, group_commit_interval=0.01):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.group_commit_size = group_commit_size
+        self.group_commit_interval = group_commit_interval
+
+        os.makedirs(directory, exist_ok=True)
+        self.segment_first_ids = []  # id of the first event of each segment, in order
+        self.segment_indexes = []  # SegmentIndex of each segment
+        self.maps = {}  # segment number -> (size, mmap) of the part of the segment that has been mapped
+        self.length = 0  # id of the next event
+        self.pending = {}  # event id -> replacement event, or None if dropped, not yet written by compact()
+        # Rebuilt as the log is replayed, so any checkpoints from before are discarded
+        self.checkpoints_file = open(os.path.join(directory, CHECKPOINTS_FILE), "w+b")
+        self.checkpoint_offsets = {}  # (plan id, event id) -> (offset, length of the event ids, length of the state)
+
+        for name in os.listdir(directory):
+            if name.endswith(TEMPORARY_SUFFIX):
+                # Left over from a compaction that did not finish
+                os.remove(os.path.join(directory, name))
+        for first_event_id in sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)):
+            self.open_segment(first_event_id)
+
+        if not self.segment_first_ids:
+            self.start_segment()
+        self.file = open(self.segment_path(self.segment_first_ids[-1]), "ab")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        # Guards the active segment file, which the timer thread syncs
+        self.lock = threading.RLock()
+        self.timer = None  # the pending timer that syncs unsynced events, if any
+
+    def segment_path(self, first_event_id):
+        return os.path.join(self.directory, "%020d%s" % (first_event_id, SEGMENT_SUFFIX))
+
+    def open_segment(self, first_event_id):
+        """
+        Scans an existing segment to build its sparse index, and truncates it after the last valid record
+        """
+        if first_event_id < self.length:
+            raise Exception("Overlapping events in segment " + self.segment_path(first_event_id))
+        path = self.segment_path(first_event_id)
+        self.segment_first_ids.append(first_event_id)
+        self.segment_indexes.append(SegmentIndex())
+        self.length = first_event_id
+        offset = 0
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+                    records = read_records(segment, 0, size)
+                    try:
+                        for event_id, _, _, end in records:
+                            if event_id < self.length:
+                                break
+                            self.segment_indexes[-1].add(event_id, offset)
+                            self.length = event_id + 1
+                            offset = end
+                    finally:
+                        records.close()
+        if offset != size:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+    def start_segment(self):
+        self.segment_first_ids.append(self.length)
+        self.segment_indexes.append(SegmentIndex())
+        open(self.segment_path(self.length), "ab").close()
+
+    def append(self, event):
+        if event.event_id != self.length:
+            raise Exception("Events must be appended in order: expected event id %d, got %d" % (self.length, event.event_id))
+        record = encode(event)
+        with self.lock:
+            if self.file.tell() >= self.segment_size:
+                self.roll_over()
+            offset = self.file.tell()
+            self.file.write(record)
+            self.segment_indexes[-1].add(event.event_id, offset)
+            self.length = event.event_id + 1
+
+            self.unsynced += 1
+            if self.unsynced >= self.group_commit_size or time.monotonic() - self.last_sync >= self.group_commit_interval:
+                self.sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.group_commit_interval, self.sync_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def roll_over(self):
+        """
+        Seals the active segment and starts a new one
+        """
+        with self.lock:
+            self.sync()
+            self.file.close()
+            self.start_segment()
+            self.file = open(self.segment_path(self.length), "ab")
+
+    def sync(self):
+        """
+        Makes all appended events durable
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+
+    def sync_on_timer(self):
+        with self.lock:
+            # Unless it was cancelled by a sync meanwhile
+            if self.timer is threading.current_thread():
+                self.timer = None
+                self.sync()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+            self.checkpoints_file.close()
+        self.maps = {}
+
+    def write_checkpoint(self, plan_id, event_id, state, event_ids):
+        """
+        :param state: the plan's state after the event
+        :param event_ids: the ids of the plan's events from this checkpoint until the next
+        """
+        event_ids = array("q", event_ids).tobytes()
+        state = json.dumps([[activity_id, activity] for activity_id, activity in state.items()], separators=(",", ":")).encode()
+        with self.lock:
+            offset = self.checkpoints_file.seek(0, os.SEEK_END)
+            self.checkpoints_file.write(event_ids)
+            self.checkpoints_file.write(state)
+        self.checkpoint_offsets[(plan_id, event_id)] = (offset, len(event_ids), len(state))
+
+    def read_checkpoint(self, plan_id, event_id):
+        offset, event_ids_length, state_length = self.checkpoint_offsets[(plan_id, event_id)]
+        with self.lock:
+            self.checkpoints_file.seek(offset + event_ids_length)
+            state = self.checkpoints_file.read(state_length)
+        return {activity_id: activity for activity_id, activity in json.loads(state)}
+
+    def read_checkpoint_event_ids(self, plan_id, event_id):
+        offset, event_ids_length, _ = self.checkpoint_offsets[(plan_id, event_id)]
+        event_ids = array("q")
+        with self.lock:
+            self.checkpoints_file.seek(offset)
+            event_ids.frombytes(self.checkpoints_file.read(event_ids_length))
+        return event_ids
+
+    def drop_checkpoint(self, plan_id, event_id):
+        """
+        Forgets a checkpoint. Its space in the checkpoints file is not reclaimed until the log is reopened.
+        """
+        del self.checkpoint_offsets[(plan_id, event_id)]
+
+    def segment(self, segment_number):
+        """
+        :return: an mmap of the given segment, covering at least every event appended so far
+        """
+        if segment_number == len(self.segment_first_ids) - 1:
+            with self.lock:
+                self.file.flush()
+        size = os.path.getsize(self.segment_path(self.segment_first_ids[segment_number]))
+        if not size:
+            return b""
+        mapped_size, segment = self.maps.get(segment_number, (0, None))
+        if mapped_size != size:
+            # The previous map is closed when the last reader of it is done
+            with open(self.segment_path(self.segment_first_ids[segment_number]), "rb") as f:
+                segment = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.maps[segment_number] = (size, segment)
+        return segment
+
+    def compact(self):
+        """
+        Writes the replaced and dropped events to the segment files, rewriting one segment at a time.
+        This is a generator that yields after each record, so that it can be run in slices between appends.
+
+        Replacements are all made durable before anything is dropped, and drops are made from the last
+        segment to the first, so that a crash part way through leaves a log that can still be replayed:
+        an event is only dropped once every later event that depends on it has been.
+        """
+        if not self.pending:
+            return
+        if self.segment_indexes[-1].records:
+            self.roll_over()
+        sealed_segments = len(self.segment_first_ids) - 1
+        for segment_number in range(sealed_segments):
+            yield from self.rewrite_segment(segment_number, drops=False)
+        for segment_number in reversed(range(sealed_segments)):
+            yield from self.rewrite_segment(segment_number, drops=True)
+
+    def rewrite_segment(self, segment_number, drops):
+        first_event_id = self.segment_first_ids[segment_number]
+        end_event_id = self.segment_first_ids[segment_number + 1]
+        changes = {
+            event_id: event
+            for event_id, event in self.pending.items()
+            if first_event_id <= event_id < end_event_id and (event is None) == drops
+        }
+        if not changes:
+            return
+
+        path = self.segment_path(first_event_id)
+        index = SegmentIndex()
+        segment = self.segment(segment_number)
+        with open(path + TEMPORARY_SUFFIX, "wb") as f:
+            records = read_records(segment, 0, len(segment))
+            try:
+                offset = 0
+                for event_id, _, _, end in records:
+                    if event_id in changes:
+                        record = b"" if drops else encode(changes[event_id])
+                    else:
+                        record = segment[offset:end]
+                    if record:
+                        index.add(event_id, f.tell())
+                        f.write(record)
+                    offset = end
+                    yield
+            finally:
+                records.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + TEMPORARY_SUFFIX, path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        self.segment_indexes[segment_number] = index
+        self.maps.pop(segment_number, None)
+        for event_id, event in changes.items():
+            # Unless it was changed again in the meantime
+            if self.pending.get(event_id, event) is event:
+                del self.pending[event_id]
+
+    def __len__(self):
+        return self.length
+
+    def __setitem__(self, event_id, event):
+        if not 0 <= event_id < self.length:
+            raise IndexError(event_id)
+        self.pending[event_id] = event
+
+    def __getitem__(self, event_id):
+        if not 0 <= event_id < self.length:
+            raise IndexError(event_id)
+        if event_id in self.pending:
+            return self.pending[event_id]
+        segment_number = bisect.bisect_right(self.segment_first_ids, event_id) - 1
+        offset = self.segment_indexes[segment_number].find(event_id)
+        if offset is None:
+            return None
+        segment = self.segment(segment_number)
+        for record_event_id, plan_id, payload, _ in read_records(segment, offset, len(segment)):
+            if record_event_id == event_id:
+                return Event(event_id, plan_id, json.loads(payload.tobytes()))
+            if record_event_id > event_id:
+                return None
+        return None
+
+    def __iter__(self):
+        """
+        :return: an iterator of every event that has not been dropped, in order
+        """
+        for segment_number in range(len(self.segment_first_ids)):
+            segment = self.segment(segment_number)
+            if len(segment):
+                for event_id, plan_id, payload, _ in read_records(segment, 0, len(segment)):
+                    if event_id in self.pending:
+                        if self.pending[event_id] is not None:
+                            yield self.pending[event_id]
+                    else:
+                        yield Event(event_id, plan_id, json.loads(payload.tobytes()))
+
+
+def encode(event):
+    payload = json.dumps(event.payload, separators=(",", ":")).encode()
+    return HEADER.pack(len(payload), zlib.crc32(payload), event.event_id, event.plan_id) + payload
+
+
+def read_records(segment, offset, size):
+    """
+    Reads records from a mapped segment without copying them, stopping at the end or at the first
+    incomplete or corrupt record
+    :return: an iterator of (event id, plan id, memoryview of the payload, offset of the end of the record)
+    """
+    view = memoryview(segment)
+    try:
+        while offset + HEADER.size <= size:
+            length, crc, event_id, plan_id = HEADER.unpack_from(view, offset)
+            start = offset + HEADER.size
+            end = start + length
+            if end > size:
+                return
+            payload = view[start:end]
+            try:
+                if zlib.crc32(payload) != crc:
+                    return
+                yield event_id, plan_id, payload, end
+            finally:
+                payload.release()
+            offset = end
+    finally:
+        view.release()
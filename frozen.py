@@ -0,0 +1,163 @@
+"""
+Immutable, hash-consed activity args.
+
+freeze() turns a JSON value into a canonical immutable one: a FrozenDict for an object, a FrozenList for
+an array, and primitives as they are. Canonical values are interned, so equal args share storage, and two
+canonical values are equal exactly when they are the same object.
+
+Equality follows the notes' "exact match" semantics rather than Python's: objects must have the same keys,
+arrays the same length, and primitives must be identical - so 1, 1.0 and True are all different, and so
+are 0.0 and -0.0.
+"""
+
+import threading
+import weakref
+from collections import deque
+
+PRIMITIVE_TYPES = (str, int, float, bool, type(None))
+
+# Structural hash -> weak references to the interned values with that hash
+pool = {}
+pool_lock = threading.Lock()
+# (hash, weak reference) of interned values that have died, to be removed from the pool by the next intern
+discarded = deque()
+
+# Stand for a key that is not in an object, and for a conflict, in three_way_merge
+MISSING = object()
+CONFLICT = object()
+
+
+class FrozenDict(dict):
+    __slots__ = ("hash", "interned", "__weakref__")
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return equal(self, other)
+
+    def __ne__(self, other):
+        return not equal(self, other)
+
+    def immutable(self, *args, **kwargs):
+        raise Exception("Activity args are immutable")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = immutable
+
+
+class FrozenList(list):
+    __slots__ = ("hash", "interned", "__weakref__")
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return equal(self, other)
+
+    def __ne__(self, other):
+        return not equal(self, other)
+
+    def immutable(self, *args, **kwargs):
+        raise Exception("Activity args are immutable")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = clear = extend = insert = pop = remove = reverse = sort = immutable
+
+
+def freeze(value):
+    """
+    :return: the canonical immutable value that exactly matches the given JSON value
+    """
+    if isinstance(value, (FrozenDict, FrozenList)) and value.interned:
+        return value
+    if isinstance(value, dict):
+        frozen = FrozenDict((key, freeze(item)) for key, item in value.items())
+        frozen.hash = hash(("object", frozenset((key, structural_hash(item)) for key, item in frozen.items())))
+    elif isinstance(value, (list, tuple)):
+        frozen = FrozenList(freeze(item) for item in value)
+        frozen.hash = hash(("array", tuple(structural_hash(item) for item in frozen)))
+    elif isinstance(value, PRIMITIVE_TYPES):
+        return value
+    else:
+        raise Exception("Activity args must be JSON values, got " + repr(value))
+    frozen.interned = False
+    return intern(frozen)
+
+
+def intern(frozen):
+    with pool_lock:
+        while discarded:
+            hash, reference = discarded.popleft()
+            references = pool.get(hash)
+            if references is not None:
+                references.remove(reference)
+                if not references:
+                    del pool[hash]
+        references = pool.setdefault(frozen.hash, [])
+        for reference in references:
+            existing = reference()
+            if existing is not None and equal(existing, frozen):
+                return existing
+        references.append(weakref.ref(frozen, lambda reference, hash=frozen.hash: discard(hash, reference)))
+        frozen.interned = True
+        return frozen
+
+
+def discard(hash, reference):
+    # Runs when an interned value dies, which can be during garbage collection in the middle of intern, on
+    # any thread - so rather than taking pool_lock, it leaves the removal to the next intern
+    discarded.append((hash, reference))
+
+
+def structural_hash(value):
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value.hash
+    return hash(primitive_key(value))
+
+
+def primitive_key(value):
+    # repr distinguishes floats that compare equal but are written differently, like 0.0 and -0.0
+    return type(value), repr(value) if isinstance(value, float) else value
+
+
+def equal(a, b):
+    """
+    :return: whether a and b match exactly. O(1) if both are canonical.
+    """
+    if a is b:
+        return True
+    if isinstance(a, (FrozenDict, FrozenList)) and isinstance(b, (FrozenDict, FrozenList)):
+        if (a.interned and b.interned) or a.hash != b.hash:
+            return False
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(equal(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)):
+        return isinstance(b, (list, tuple)) and len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(b, (dict, list, tuple)):
+        return False
+    return primitive_key(a) == primitive_key(b)
+
+
+def three_way_merge(base, ours, theirs):
+    """
+    Merges two edits of a canonical value: where only one side changed something, its change is taken, and
+    objects that both sides changed are merged key by key, so edits to different keys do not conflict.
+    Equal canonical values are the same object, so unchanged keys and subtrees are skipped in O(1), and only
+    the keys whose values differ are descended into.
+    :param base, ours, theirs: canonical values, or MISSING
+    :return: the merged canonical value (or MISSING), or CONFLICT if both sides changed the same thing differently
+    """
+    if equal(ours, theirs) or equal(base, theirs):
+        return ours
+    if equal(base, ours):
+        return theirs
+    if not (isinstance(base, FrozenDict) and isinstance(ours, FrozenDict) and isinstance(theirs, FrozenDict)):
+        return CONFLICT
+    merged = {}
+    # A key that is only in base was deleted by both sides
+    for key in list(ours) + [key for key in theirs if key not in ours]:
+        value = three_way_merge(base.get(key, MISSING), ours.get(key, MISSING), theirs.get(key, MISSING))
+        if value is CONFLICT:
+            return CONFLICT
+        if value is not MISSING:
+            merged[key] = value
+    return freeze(merged)
@@ -73,6 +73,11 @@ class PlanCollaborationInterface(ABC):
         - If a change is in one but not the other, apply that change
         - If a change is in both, and it is not identical, this is a conflict
 
+        The designs compare changes at different granularities, so the same merge can have different conflicts in each:
+        snapshots.py combines modifications of different fields, or of different keys of the args, of the same
+        activity (see snapshots.merge_versions), while sqlite_snapshots.py and event_log.py compare whole activities,
+        so that any two different modifications of an activity conflict.
+
         Returns an in-progress merge that has:
          - merge id
          - plan_supplying_changes_id
@@ -97,7 +102,8 @@ class PlanCollaborationInterface(ABC):
            to be made aside from those that come from resolving conflicts. Importantly, it must allow
            running constraints, in order to help determine the validity of the merge.
 
-        Return the id of the new staging plan
+        :return: the conflicts, as (activity_id, supplier's version or "DELETE", receiver's version or "DELETE"),
+                 or the number of conflicts for implementations that leave them in storage (see sqlite_snapshots)
         """
         pass
 
@@ -129,6 +135,14 @@ class PlanCollaborationInterface(ABC):
         """
         pass
 
+    @abstractmethod
+    def resolve_conflicts_bulk(db, merge_id, resolutions):
+        """
+        Applies multiple resolutions at once: either "CHANGE_SUPPLIER" or "CHANGE_RECEIVER" for every conflict,
+        or a list of (conflict_id, resolution) pairs
+        """
+        pass
+
 
     @abstractmethod
     def delete(db, plan):
@@ -0,0 +1,71 @@
+"""
+Synchronization primitives for running a design from many threads at once.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    Allows either any number of readers, or a single writer. The lock is reentrant: a thread that holds it
+    can acquire it again, and a writer can also read. A reader cannot become a writer without releasing it first.
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = {}  # thread id -> number of times it holds the lock for reading
+        self.writer = None  # thread id of the writer
+        self.writes = 0  # number of times the writer holds the lock
+
+    @contextmanager
+    def read(self):
+        thread = threading.get_ident()
+        with self.condition:
+            if self.writer != thread:
+                while self.writer is not None:
+                    self.condition.wait()
+                self.readers[thread] = self.readers.get(thread, 0) + 1
+        try:
+            yield
+        finally:
+            if self.writer != thread:
+                with self.condition:
+                    self.readers[thread] -= 1
+                    if not self.readers[thread]:
+                        del self.readers[thread]
+                        self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        thread = threading.get_ident()
+        with self.condition:
+            if self.writer != thread:
+                if thread in self.readers:
+                    raise Exception("Cannot acquire a write lock while holding a read lock")
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.writer = thread
+            self.writes += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writes -= 1
+                if not self.writes:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+class AtomicCounter:
+    """
+    Hands out consecutive ids, from any thread
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def next(self):
+        with self.lock:
+            value = self.value
+            self.value += 1
+            return value
@@ -0,0 +1,133 @@
+"""
+Persistent Merkle tries of activity digests, keyed by activity id.
+
+A tree is immutable: setting a key copies only the nodes on the path to it (O(log N)), and shares the rest
+with the previous version. So a snapshot or a duplicate can share its plan's tree in O(1), and a plan and
+its snapshots share all the subtrees that did not change between them.
+
+Every node holds the digest of its subtree - the XOR of the digests of the activities in it - so the root's
+digest is the digest of the whole plan. Diffing two trees only descends into subtrees whose digests differ,
+which costs O(changes * log N).
+"""
+
+BITS = 4
+FAN_OUT = 1 << BITS
+MASK = FAN_OUT - 1
+EMPTY_CHILDREN = (None,) * FAN_OUT
+
+
+class Node:
+    __slots__ = ("digest", "children")
+
+    def __init__(self, digest, children):
+        self.digest = digest
+        self.children = children
+
+
+class MerkleTree:
+    """
+    A map of activity id (a non-negative int) to activity digest (an int). A tree of height h has room for
+    the ids below FAN_OUT ** h, and grows as needed; the children of the nodes at the bottom level are digests.
+    """
+    __slots__ = ("height", "root")
+
+    def __init__(self, height=1, root=None):
+        self.height = height
+        self.root = root
+
+    @property
+    def digest(self):
+        return digest(self.root)
+
+    def get(self, key):
+        """
+        :return: the digest of the given activity, or None if it is not in the tree
+        """
+        if key >= FAN_OUT ** self.height:
+            return None
+        node = self.root
+        for height in range(self.height, 0, -1):
+            if node is None:
+                return None
+            node = node.children[(key >> (BITS * (height - 1))) & MASK]
+        return node
+
+    def set(self, key, value):
+        """
+        :param value: the new digest of the given activity, or None to remove it
+        :return: a new tree with the change
+        """
+        tree = self
+        if key >= FAN_OUT ** tree.height:
+            if value is None:
+                return tree
+            while key >= FAN_OUT ** tree.height:
+                tree = tree.grown()
+        return MerkleTree(tree.height, set_in(tree.root, tree.height, key, value))
+
+    def grown(self):
+        """
+        :return: the same tree, one level higher
+        """
+        if self.root is None:
+            return MerkleTree(self.height + 1)
+        return MerkleTree(self.height + 1, Node(self.root.digest, (self.root,) + EMPTY_CHILDREN[1:]))
+
+    def diff(self, other):
+        """
+        :return: the keys whose digests differ between the two trees (including keys that are in only one of them), in order
+        """
+        tree = self
+        while tree.height < other.height:
+            tree = tree.grown()
+        while other.height < tree.height:
+            other = other.grown()
+        keys = []
+        diff_nodes(tree.root, other.root, tree.height, 0, keys)
+        return keys
+
+    def __len__(self):
+        return count(self.root, self.height)
+
+
+def digest(node):
+    if node is None:
+        return 0
+    if isinstance(node, Node):
+        return node.digest
+    return node
+
+
+def set_in(node, height, key, value):
+    index = (key >> (BITS * (height - 1))) & MASK
+    children = EMPTY_CHILDREN if node is None else node.children
+    child = children[index]
+    new_child = value if height == 1 else set_in(child, height - 1, key, value)
+    if new_child is child:
+        return node
+    new_children = children[:index] + (new_child,) + children[index + 1:]
+    if new_child is None and new_children == EMPTY_CHILDREN:
+        return None
+    return Node(digest(node) ^ digest(child) ^ digest(new_child), new_children)
+
+
+def diff_nodes(a, b, height, prefix, keys):
+    if height == 0:
+        if a != b:
+            keys.append(prefix)
+        return
+    if a is b or (a is not None and b is not None and a.digest == b.digest):
+        return
+    a_children = EMPTY_CHILDREN if a is None else a.children
+    b_children = EMPTY_CHILDREN if b is None else b.children
+    for index in range(FAN_OUT):
+        if a_children[index] is not b_children[index]:
+            diff_nodes(a_children[index], b_children[index], height - 1, (prefix << BITS) | index, keys)
+
+
+def count(node, height):
+    if node is None:
+        return 0
+    if height == 0:
+        return 1
+    return sum(count(child, height - 1) for child in node.children)
@@ -5,11 +5,15 @@ This is the "revision counters" design
 from abc import ABC, abstractmethod
 
 class Plan:
+    __slots__ = ("id", "parent")
+
     def __init__(self, id, parent):
         self.id = id
         self.parent = parent
 
 class Activity:
+    __slots__ = ("plan_id", "activity_id", "type", "start_time", "args", "revision", "parent_revision", "deleted")
+
     def __init__(self, plan_id, activity_id, type, start_time, args, revision, parent_revision, deleted):
         self.plan_id = plan_id
         self.activity_id = activity_id
@@ -1,39 +1,173 @@
-import interface
+import bisect
+import heapq
+import sys
+import threading
+from contextlib import ExitStack, contextmanager
 
-class Printable:
-    def __repr__(self):
-        return repr(self.__dict__)
+import interface
+from common import Conflict, Printable, in_window, intersect_windows
+from frozen import CONFLICT, equal, freeze, structural_hash, three_way_merge
+from locks import AtomicCounter, ReadWriteLock
+from merkle import MerkleTree
+from tables import Table
+
+# Rows use __slots__ rather than a per-instance __dict__, since there are millions of them in large plan sets.
+# Activity args are frozen (see frozen.py): equal args are the same object, so they are compared with `is`.
+#
+# Every activity version has a digest of its content, and every plan and snapshot has a Merkle tree of the
+# digests of its activities (see merkle.py), kept up to date as activities change. The tree's digest is the
+# digest of the whole plan. Digests are built from Python's hash(), which is salted per process, so they are
+# only comparable within a process and are never stored. Digests can collide, so equal digests are only a fast
+# path: two versions of an activity are confirmed to match exactly (see same_content), and two plans match when
+# they share their tree. Only the Merkle diff skips subtrees whose digests are equal without confirming them.
+#
+# Plans are read with multi-version concurrency control, so that long reads (make_snapshot, duplicate, diffs)
+# never hold a plan's lock. Every write to a plan's activities is stamped with a new version, and a plan's
+# rows in the activities table are never modified, just replaced: each row has the version that wrote it
+# (begin_version) and the version that replaced it (end_version, or None while it is current), and links to
+# the row it replaced (previous). A reader picks a version stamp in a short critical section (see read_version),
+# and then sees the plan as it was at that version, by following the chains of rows, while writers carry on.
 
 class Plan(Printable):
-    def __init__(self, id, start_time, end_time, parent_id, latest_snapshots):
+    """
+    A plan's activities are those of its base snapshot, overridden by the plan's own rows in
+    the activities table, minus the activities it has deleted (see DeletedActivity). Rows are only
+    materialized in the activities table when the plan writes to them.
+
+    The staging plan of an in-progress merge is an overlay on the plan receiving changes instead: its activities are
+    the receiving plan's, overridden by its own rows, which hold the merge's changes (see begin_merge).
+    """
+    __slots__ = ("id", "start_time", "end_time", "parent_id", "latest_snapshots", "base_snapshot_id", "deleted", "tree",
+                 "time_index", "window", "lock", "snapshot_lock", "merge_id", "overlay_plan_id",
+                 "changes", "change_counter", "snapshot_change_counters")
+
+    def __init__(self, id, start_time, end_time, parent_id, latest_snapshots, base_snapshot_id=None, tree=MerkleTree(), window=None):
         self.id = id
         self.start_time = start_time
         self.end_time = end_time
         self.parent_id = parent_id
         self.latest_snapshots = latest_snapshots
+        self.base_snapshot_id = base_snapshot_id
+        self.deleted = False
+        self.tree = tree
+        # Sorted list of (start_time, activity id) of the plan's activities, built on first use (see get_time_index)
+        self.time_index = None
+        # (start_time, end_time) if the plan only has the activities of its history within that window (see duplicate)
+        self.window = window
+        # Held for reading or writing the plan's state (see PlanCollaborationInterface.locking)
+        self.lock = ReadWriteLock()
+        # Held while making a snapshot of the plan, so that only one snapshot is rebased onto at a time (see make_snapshot)
+        self.snapshot_lock = threading.Lock()
+        # The id of the in-progress merge into this plan, which prevents it from being modified
+        self.merge_id = None
+        # For a staging plan, the id of the plan it is an overlay on
+        self.overlay_plan_id = None
+
+        # Change tracking, used to diff the plan against its own snapshots in O(changes):
+        # changes maps activity id to the value of change_counter when it was last changed, in that order,
+        # and snapshot_change_counters maps a snapshot id to the value of change_counter when the plan matched it.
+        self.changes = {}
+        self.change_counter = 0
+        self.snapshot_change_counters = {}
+
+    @property
+    def digest(self):
+        return self.tree.digest
 
 class Activity(Printable):
-    def __init__(self, plan_id, activity_id, type, start_time, args):
+    __slots__ = ("plan_id", "activity_id", "type", "start_time", "args", "digest", "begin_version", "end_version", "previous")
+
+    def __init__(self, plan_id, activity_id, type, start_time, args, begin_version=0, previous=None):
         self.plan_id = plan_id
         self.activity_id = activity_id
-        self.type = type
+        self.type = sys.intern(type)
         self.start_time = start_time
-        self.args = args
+        self.args = freeze(args)
+        self.digest = activity_digest(self)
+        self.begin_version = begin_version
+        self.end_version = None
+        self.previous = previous
+
+class DeletedActivity(Printable):
+    """
+    A version of an activity that records that the plan deleted it
+    """
+    __slots__ = ("plan_id", "activity_id", "begin_version", "end_version", "previous")
+
+    def __init__(self, plan_id, activity_id, begin_version=0, previous=None):
+        self.plan_id = plan_id
+        self.activity_id = activity_id
+        self.begin_version = begin_version
+        self.end_version = None
+        self.previous = previous
+
+class PlanVersion(Printable):
+    """
+    The state of a plan at a version stamp, for reading the plan without holding its lock (see read_version).
+    The plan sees every write stamped with a lower version.
+    """
+    __slots__ = ("plan_id", "version", "base_snapshot_id", "overlay_plan_id", "tree", "latest_snapshots", "window", "change_counter", "tracks_changes")
+
+    def __init__(self, plan, version):
+        self.plan_id = plan.id
+        self.version = version
+        self.base_snapshot_id = plan.base_snapshot_id
+        self.overlay_plan_id = plan.overlay_plan_id
+        self.tree = plan.tree
+        self.latest_snapshots = plan.latest_snapshots
+        self.window = plan.window
+        self.change_counter = plan.change_counter
+        self.tracks_changes = bool(plan.snapshot_change_counters)
 
 class PlanSnapshot(Printable):
-    def __init__(self, id, previous_snapshots):
+    """
+    A snapshot's activities are those of its base snapshot, overridden by its own rows in
+    the snapshot_activities table, minus the deleted_activity_ids.
+
+    A snapshot with no base is a checkpoint, which stores all of its activities. depth is the
+    number of deltas between this snapshot and its checkpoint. size is the number of activities in the snapshot,
+    rows is the number of rows and deleted ids it stores itself, and chain_rows is the sum of the rows of the
+    deltas between it and its checkpoint (see make_snapshot_at). A delta with no rows has the same activities
+    as its base.
+
+    generation is one more than the highest generation of the previous_snapshots (or 0 if there are none),
+    so a snapshot's generation is always greater than that of any snapshot in its history.
+    """
+    __slots__ = ("id", "previous_snapshots", "base_snapshot_id", "deleted_activity_ids", "depth", "generation", "tree",
+                 "size", "rows", "chain_rows")
+
+    def __init__(self, id, previous_snapshots, base_snapshot_id=None, deleted_activity_ids=frozenset(), depth=0, generation=0, tree=MerkleTree(),
+                 size=0, rows=0, chain_rows=0):
         self.id = id
         self.previous_snapshots = previous_snapshots
+        self.base_snapshot_id = base_snapshot_id
+        self.deleted_activity_ids = deleted_activity_ids
+        self.depth = depth
+        self.generation = generation
+        self.tree = tree
+        self.size = size
+        self.rows = rows
+        self.chain_rows = chain_rows
+
+    @property
+    def digest(self):
+        return self.tree.digest
 
 class PlanSnapshotActivity(Printable):
+    __slots__ = ("plan_snapshot_id", "activity_id", "type", "start_time", "args", "digest")
+
     def __init__(self, plan_snapshot_id, activity_id, type, start_time, args):
         self.plan_snapshot_id = plan_snapshot_id
         self.activity_id = activity_id
-        self.type = type
+        self.type = sys.intern(type)
         self.start_time = start_time
-        self.args = args
+        self.args = freeze(args)
+        self.digest = activity_digest(self)
 
 class MergeRequest(Printable):
+    __slots__ = ("id", "state", "plan_supplying_changes", "plan_receiving_changes", "plan_supplying_changes_snapshot",
+                 "staging_plan_id", "conflicts", "decisions", "plan_supplying_changes_changeset", "merge_base_id")
+
     def __init__(
             self,
             id,
@@ -43,7 +177,7 @@ class MergeRequest(Printable):
             plan_supplying_changes_snapshot,
             plan_supplying_changes_changeset,
             merge_base_id,
-            non_conflicting_changes,
+            staging_plan_id,
             conflicts,
             decisions,
     ):
@@ -52,36 +186,188 @@ class MergeRequest(Printable):
         self.plan_supplying_changes = plan_supplying_changes
         self.plan_receiving_changes = plan_receiving_changes
         self.plan_supplying_changes_snapshot = plan_supplying_changes_snapshot
-        self.non_conflicting_changes = non_conflicting_changes
+        self.staging_plan_id = staging_plan_id
         self.conflicts = conflicts
         self.decisions = decisions
         self.plan_supplying_changes_changeset = plan_supplying_changes_changeset
         self.merge_base_id = merge_base_id
 
+def visible_version(row, version):
+    """
+    :param version: a version stamp, or None for the current version
+    :return: the version of the row that a reader at the given version sees, following the chain of
+             previous versions, or None if it sees none of them
+    """
+    if version is None:
+        return row if row is not None and row.end_version is None else None
+    while row is not None and row.begin_version >= version:
+        row = row.previous
+    if row is not None and row.end_version is not None and row.end_version < version:
+        return None
+    return row
+
+def prune_versions(row, oldest_version):
+    """
+    Drops the previous versions of the row that no reader can see any more
+    """
+    while row.previous is not None:
+        if row.previous.end_version < oldest_version:
+            row.previous = None
+            return
+        row = row.previous
+
+def merge_versions(plan_id, base, supplier, receiver):
+    """
+    Three-way merges two modifications of an activity against its version in the merge base, field by field:
+    the start times, and the args key by key (see frozen.three_way_merge), so that changes to different
+    fields or different keys of the args do not conflict
+    :param plan_id: the plan the merged version is for. The versions may be rows of snapshots rather than of a plan.
+    :return: the merged version, or None if both sides changed the same field differently
+    """
+    start_time = three_way_merge(base.start_time, supplier.start_time, receiver.start_time)
+    args = three_way_merge(base.args, supplier.args, receiver.args)
+    if start_time is CONFLICT or args is CONFLICT:
+        return None
+    return Activity(plan_id, receiver.activity_id, receiver.type, start_time, args)
+
+def activity_digest(activity):
+    """
+    :return: a digest of the activity's id, type, start_time and args
+    """
+    return hash((activity.activity_id, activity.type, structural_hash(activity.start_time), structural_hash(activity.args)))
+
+def same_content(activity, other):
+    """
+    :return: whether two versions of an activity have the same type, start_time and args. The digests are compared
+             first, to rule out most differences in O(1).
+    """
+    return (
+        activity.digest == other.digest
+        and activity.type == other.type
+        and equal(activity.start_time, other.start_time)
+        and activity.args is other.args  # frozen, so equal args are the same object
+    )
+
+# A snapshot stores all of its activities once the deltas since its checkpoint hold more rows than this fraction
+# of its size, so that the cost of checkpoints is proportional to the changes made since the last one.
+SNAPSHOT_CHECKPOINT_FRACTION = 0.5
+
+# A chain of deltas is at most this long, which bounds the cost of reading an activity from a snapshot.
+# The snapshot that would be one longer is stored as a delta against the checkpoint instead.
+SNAPSHOT_MAX_DEPTH = 16
+
 class PlanCollaborationInterface(interface.PlanCollaborationInterface):
+    """
+    Can be used from many threads at once. Each plan has a lock (see locking), which operations on the plan
+    hold for reading or for writing, so there is no global lock: operations on unrelated plans run concurrently.
+    Internal methods expect their caller to hold the locks of the plans they access.
+
+    Every table row is keyed by a plan, snapshot or merge request, and snapshots are never modified after they
+    are made, so concurrent operations on different plans never write the same rows. Long reads of a plan hold
+    its lock only to pick a version stamp, and then read that version of the plan (see read_version).
+    """
     def __init__(db):
-        db.plans = []
-        db.plan_counter = 0
+        db.plans = Table("id")
+        db.plan_counter = AtomicCounter()
+
+        db.activities = Table(("plan_id", "activity_id"), indexes=["plan_id"])
+        db.activity_counter = AtomicCounter()
 
-        db.activities = []
-        db.activity_counter = 0
+        db.snapshots = Table("id")
+        db.snapshot_counter = AtomicCounter()
 
-        db.snapshots = []
-        db.snapshot_counter = 0
+        db.snapshot_activities = Table(("plan_snapshot_id", "activity_id"), indexes=["plan_snapshot_id"])
 
-        db.snapshot_activities = []
+        db.merge_requests = Table("id", indexes=["plan_supplying_changes", "plan_receiving_changes"])
+        db.merge_request_counter = AtomicCounter()
+
+        # Version stamps of writes to activities (see read_version)
+        db.version_counter = AtomicCounter()
+        db.readers_lock = threading.Lock()
+        db.readers = {}  # version stamp -> number of readers at that version
+        db.pinned_snapshots = {}  # snapshot id -> number of readers using it as their base snapshot
+
+        # State of the in-progress garbage collection cycle, if any (see collect_garbage)
+        db.garbage_collection = None
+        db.gc_marked = None
+        db.gc_worklist = []
+        db.gc_lock = threading.RLock()
+
+    @contextmanager
+    def locking(db, reads=(), writes=()):
+        """
+        Holds the locks of the given plans, for reading or writing. Locks are acquired in order of plan id,
+        so that threads locking several plans cannot deadlock.
+        """
+        with ExitStack() as stack:
+            for plan_id in sorted(set(reads).union(writes)):
+                plan = db.plans.get(plan_id)
+                if plan is not None:
+                    stack.enter_context(plan.lock.write() if plan_id in writes else plan.lock.read())
+            yield
+
+    def read_version(db, plan):
+        """
+        Picks a version stamp for reading the plan, which the caller must hold the lock of, and keeps the
+        versions of rows that the reader can see until it calls release_version.
+        :return: a PlanVersion
+        """
+        with db.readers_lock:
+            at = PlanVersion(plan, db.version_counter.value)
+            db.readers[at.version] = db.readers.get(at.version, 0) + 1
+            if at.base_snapshot_id is not None:
+                db.pinned_snapshots[at.base_snapshot_id] = db.pinned_snapshots.get(at.base_snapshot_id, 0) + 1
+        db.gc_barrier([at.base_snapshot_id])
+        return at
+
+    def release_version(db, at):
+        with db.readers_lock:
+            db.readers[at.version] -= 1
+            if not db.readers[at.version]:
+                del db.readers[at.version]
+            if at.base_snapshot_id is not None:
+                db.pinned_snapshots[at.base_snapshot_id] -= 1
+                if not db.pinned_snapshots[at.base_snapshot_id]:
+                    del db.pinned_snapshots[at.base_snapshot_id]
+
+    @contextmanager
+    def reading(db, plan_id):
+        """
+        Reads the plan at its current version, holding its lock only while picking the version stamp
+        :return: a PlanVersion
+        """
+        plan = db.get_live_plan(plan_id)
+        with plan.lock.read():
+            at = db.read_version(plan)
+        try:
+            yield at
+        finally:
+            db.release_version(at)
+
+    def oldest_read_version(db):
+        """
+        :return: the oldest version stamp that a reader may still read at. Row versions that were replaced
+                 before it can be dropped.
+        """
+        with db.readers_lock:
+            return min(db.readers, default=db.version_counter.value)
 
-        db.merge_requests = []
-        db.merge_request_counter = 0
+    def get_writable_plan(db, plan_id):
+        """
+        :return: the plan, if it can be modified
+        """
+        plan = db.get_live_plan(plan_id)
+        if plan.merge_id is not None:
+            raise Exception("Plan %s is locked by in-progress merge %s" % (plan_id, plan.merge_id))
+        return plan
 
     def make_fresh_plan(db, start_time=None, end_time=None):
         """
         Makes a new, empty plan
         :return: the new plan id
         """
-        new_plan = Plan(db.plan_counter, start_time, end_time, None, [])
-        db.plan_counter += 1
-        append(new_plan, db.plans, lambda x: x.id)
+        new_plan = Plan(db.plan_counter.next(), start_time, end_time, None, [])
+        db.plans.insert(new_plan)
         new_plan.latest_snapshots = []
         return new_plan.id
 
@@ -89,140 +375,590 @@ class PlanCollaborationInterface(interface.PlanCollaborationInterface):
         """
         :return: the activity ids of all activities in the given plan
         """
-        res = []
-        for activity in db.activities:
-            if activity.plan_id == plan_id:
-                res.append(activity.activity_id)
-        return res
+        with db.reading(plan_id) as at:
+            return list(db.get_plan_activities(plan_id, at))
 
     def add_activity(db, plan_id, type="Type", *, start_time, args):
         """
         Add a new activity to the given plan
         :return: the id of the new activity
         """
-        new_activity = Activity(plan_id, db.activity_counter, type, start_time, args)
-        db.activity_counter += 1
-        append(new_activity, db.activities, lambda x: (x.plan_id, x.activity_id))
-        return new_activity.activity_id
+        with db.locking(writes=[plan_id]):
+            db.get_writable_plan(plan_id)
+            activity_id = db.activity_counter.next()
+            db.put_activity(plan_id, activity_id, type, start_time, args)
+            return activity_id
 
     def modify_activity(db, plan_id, activity_id, new_start_time, new_activity_args):
-        activity = get_one(db.activities, plan_id=plan_id, activity_id=activity_id)
-        activity.start_time = new_start_time
-        activity.args = new_activity_args
+        with db.locking(writes=[plan_id]):
+            db.get_writable_plan(plan_id)
+            activity = db.get_activity(plan_id, activity_id)
+            db.put_activity(plan_id, activity_id, activity.type, new_start_time, new_activity_args)
 
     def delete_activity(db, plan_id, activity_id):
-        activity_to_delete = get_one(db.activities, plan_id=plan_id, activity_id=activity_id)
-        db.activities.remove(activity_to_delete)
+        with db.locking(writes=[plan_id]):
+            db.get_writable_plan(plan_id)
+            db.get_activity(plan_id, activity_id)  # asserts that the activity exists
+            db.apply_changes(plan_id, {activity_id: None})
+
+    def put_activity(db, plan_id, activity_id, type, start_time, args):
+        """
+        Writes a new version of the plan's own row for the given activity
+        """
+        db.apply_changes(plan_id, {activity_id: Activity(plan_id, activity_id, type, start_time, args)})
+
+    def apply_changes(db, plan_id, changes):
+        """
+        Writes a batch of activity versions to the plan in one pass, all stamped with the same version
+        :param changes: a dict of activity id to the new version of that activity (any object with
+                        type, start_time and args), or None to delete the activity
+        """
+        plan = db.plans.get(plan_id)
+        version = db.version_counter.next()
+        oldest_version = db.oldest_read_version()
+        new_activities = []
+        for activity_id, activity in changes.items():
+            if plan.time_index is not None:
+                current = db.find_activity(plan_id, activity_id)
+                db.update_time_index(
+                    plan,
+                    activity_id,
+                    None if current is None else current.start_time,
+                    None if activity is None else activity.start_time
+                )
+            existing = db.activities.get((plan_id, activity_id))
+            previous = None
+            if existing is not None:
+                if existing.end_version is None:
+                    existing.end_version = version
+                if existing.end_version >= oldest_version:
+                    # Still visible to a reader, so keep it in the chain
+                    previous = existing
+                    prune_versions(existing, oldest_version)
+            if activity is None:
+                new_activity = DeletedActivity(plan_id, activity_id, version, previous)
+                plan.tree = plan.tree.set(activity_id, None)
+            else:
+                new_activity = Activity(plan_id, activity_id, activity.type, activity.start_time, activity.args, version, previous)
+                plan.tree = plan.tree.set(activity_id, new_activity.digest)
+            if existing is None:
+                new_activities.append(new_activity)
+            else:
+                db.activities.replace(new_activity)
+            db.mark_changed(plan, activity_id)
+        db.activities.insert_many(new_activities)
+
+    def get_time_index(db, plan):
+        """
+        :return: the plan's (start_time, activity id) pairs, sorted. The index is built on first use rather than
+                 when the plan is duplicated, so that duplicate stays O(1), and is then kept up to date.
+        """
+        if plan.time_index is None:
+            plan.time_index = sorted((activity.start_time, activity_id) for activity_id, activity in db.get_plan_activities(plan.id).items())
+        return plan.time_index
+
+    def update_time_index(db, plan, activity_id, old_start_time, new_start_time):
+        """
+        Moves the activity in the plan's time index, if it has been built. A start time of None means the
+        activity is not in the plan.
+        """
+        if plan.time_index is None:
+            return
+        if old_start_time is not None:
+            del plan.time_index[bisect.bisect_left(plan.time_index, (old_start_time, activity_id))]
+        if new_start_time is not None:
+            bisect.insort(plan.time_index, (new_start_time, activity_id))
+
+    def get_activity_ids_in_range(db, plan_id, start_time=None, end_time=None):
+        """
+        :return: the ids of the plan's activities that start between start_time and end_time (inclusive,
+                 and unbounded if None), in order of start time
+        """
+        with db.locking(reads=[plan_id]):
+            time_index = db.get_time_index(db.get_live_plan(plan_id))
+            start = 0 if start_time is None else bisect.bisect_left(time_index, start_time, key=lambda entry: entry[0])
+            end = len(time_index) if end_time is None else bisect.bisect_right(time_index, end_time, key=lambda entry: entry[0])
+            return [activity_id for _, activity_id in time_index[start:end]]
+
+    def get_time_window(db, plan_id):
+        """
+        :return: the plan's (start_time, end_time). A plan without a start or end time extends to its earliest or latest activity.
+        """
+        with db.locking(reads=[plan_id]):
+            plan = db.get_live_plan(plan_id)
+            start_time, end_time = plan.start_time, plan.end_time
+            if start_time is None or end_time is None:
+                time_index = db.get_time_index(plan)
+                if start_time is None and time_index:
+                    start_time = time_index[0][0]
+                if end_time is None and time_index:
+                    end_time = time_index[-1][0]
+            return start_time, end_time
+
+    def is_temporal_subset(db, plan_id, other_plan_id):
+        """
+        :return: whether the plan's time window (see get_time_window) is within the other plan's start and end times
+        """
+        other_plan = db.get_live_plan(other_plan_id)
+        if other_plan.start_time is None and other_plan.end_time is None:
+            return True
+        start_time, end_time = db.get_time_window(plan_id)
+        if other_plan.start_time is not None and start_time is not None and start_time < other_plan.start_time:
+            return False
+        if other_plan.end_time is not None and end_time is not None and end_time > other_plan.end_time:
+            return False
+        return True
+
+    def mark_changed(db, plan, activity_id):
+        if not plan.snapshot_change_counters:
+            return  # No snapshots to diff against
+        plan.change_counter += 1
+        plan.changes.pop(activity_id, None)
+        plan.changes[activity_id] = plan.change_counter
+
+    def get_changed_activity_ids(db, plan_id, snapshot_id):
+        """
+        :return: the ids of activities that were added, modified or deleted in the plan since it matched the given snapshot,
+                 or None if the plan does not track changes against that snapshot
+        """
+        plan = db.plans.get(plan_id)
+        if snapshot_id not in plan.snapshot_change_counters:
+            return None
+        change_counter = plan.snapshot_change_counters[snapshot_id]
+        changed_activity_ids = []
+        for activity_id in reversed(plan.changes):
+            if plan.changes[activity_id] <= change_counter:
+                break
+            changed_activity_ids.append(activity_id)
+        return changed_activity_ids
+
+    def track_changes(db, plan, snapshot_id, change_counter=None):
+        """
+        Starts tracking changes to the plan against the given snapshot, and stops tracking snapshots that are
+        no longer in the plan's latest_snapshots
+        :param change_counter: the plan's change_counter when it matched the snapshot, if not now
+        """
+        plan.snapshot_change_counters[snapshot_id] = plan.change_counter if change_counter is None else change_counter
+        plan.snapshot_change_counters = {
+            tracked_snapshot_id: change_counter
+            for tracked_snapshot_id, change_counter in plan.snapshot_change_counters.items()
+            if tracked_snapshot_id in plan.latest_snapshots or tracked_snapshot_id in (snapshot_id, plan.base_snapshot_id)
+        }
+        oldest_change_counter = min(plan.snapshot_change_counters.values())
+        while plan.changes:
+            activity_id = next(iter(plan.changes))
+            if plan.changes[activity_id] > oldest_change_counter:
+                break
+            del plan.changes[activity_id]
+
+    def get_activity(db, plan_id, activity_id):
+        """
+        :return: the row holding the current version of the activity, which is either
+                 an Activity owned by the plan or a PlanSnapshotActivity shared with its base snapshot
+        """
+        activity = db.find_activity(plan_id, activity_id)
+        assert activity is not None
+        return activity
+
+    def find_activity(db, plan_id, activity_id, at=None):
+        """
+        :param at: a PlanVersion to read the plan at, or None to read its current version
+        :return: the row holding the current version of the activity, or None if it is not in the plan
+        """
+        activity = visible_version(db.activities.get((plan_id, activity_id)), None if at is None else at.version)
+        if activity is None:
+            plan = db.plans.get(plan_id) if at is None else at
+            if plan.overlay_plan_id is not None:
+                activity = db.find_activity(plan.overlay_plan_id, activity_id)
+            elif plan.base_snapshot_id is not None:
+                activity = db.get_snapshot_activity(plan.base_snapshot_id, activity_id)
+        elif isinstance(activity, DeletedActivity):
+            return None
+        return activity
+
+    def get_plan_activities(db, plan_id, at=None):
+        """
+        :param at: a PlanVersion to read the plan at, or None to read its current version
+        :return: a dict of activity id to the row holding the current version of that activity
+        """
+        plan = db.plans.get(plan_id) if at is None else at
+        if plan.overlay_plan_id is not None:
+            activities = db.get_plan_activities(plan.overlay_plan_id)
+        elif plan.base_snapshot_id is None:
+            activities = {}
+        else:
+            activities = db.get_snapshot_activities(plan.base_snapshot_id)
+        for activity in db.activities.get_all(plan_id=plan_id):
+            activity = visible_version(activity, None if at is None else at.version)
+            if isinstance(activity, DeletedActivity):
+                activities.pop(activity.activity_id, None)
+            elif activity is not None:
+                activities[activity.activity_id] = activity
+        return activities
+
+    def get_snapshot_activity(db, snapshot_id, activity_id):
+        """
+        :return: the PlanSnapshotActivity for the given activity, or None if it is not in the snapshot
+        """
+        while snapshot_id is not None:
+            activity = db.snapshot_activities.get((snapshot_id, activity_id))
+            if activity is not None:
+                return activity
+            snapshot = db.snapshots.get(snapshot_id)
+            if activity_id in snapshot.deleted_activity_ids:
+                return None
+            snapshot_id = snapshot.base_snapshot_id
+        return None
+
+    def get_snapshot_activities(db, snapshot_id):
+        """
+        Reconstructs a snapshot by applying the deltas between it and its checkpoint
+        :return: a dict of activity id to PlanSnapshotActivity for all activities in the given snapshot
+        """
+        chain = []
+        while snapshot_id is not None:
+            snapshot = db.snapshots.get(snapshot_id)
+            chain.append(snapshot)
+            snapshot_id = snapshot.base_snapshot_id
+        activities = {}
+        for snapshot in reversed(chain):
+            for activity_id in snapshot.deleted_activity_ids:
+                del activities[activity_id]
+            for activity in db.snapshot_activities.get_all(plan_snapshot_id=snapshot.id):
+                activities[activity.activity_id] = activity
+        return activities
 
     def get_history_plan_id(db, plan_id):
-        plan = get_one(db.plans, id=plan_id)
+        plan = db.plans.get_one(id=plan_id)
         return db.get_history(plan.latest_snapshots)
 
     def get_history(db, snapshot_ids):
         """
-        Returns history in topological sort order
+        Returns history in topological sort order (newest generation first)
         """
         frontier = list(set(snapshot_ids))
-        history = list()  # must be in a topological sort order
+        history = set(frontier)
+        while frontier:
+            snapshot = db.snapshots.get(frontier.pop())
+            for previous_snapshot_id in snapshot.previous_snapshots:
+                if previous_snapshot_id not in history:
+                    history.add(previous_snapshot_id)
+                    frontier.append(previous_snapshot_id)
+        return sorted(history, key=lambda snapshot_id: (db.snapshots.get(snapshot_id).generation, snapshot_id), reverse=True)
+
+    def get_merge_base(db, snapshot_ids_1, snapshot_ids_2):
+        """
+        Finds a best common ancestor of the two sets of snapshots: a snapshot in the history of both
+        that is not in the history of any other such snapshot.
+
+        Walks both histories at once in order of decreasing generation, so that every snapshot is
+        reached by all of its descendants before it is visited. The first snapshot visited that was
+        reached from both sides is therefore a common ancestor with the highest generation.
+        Only snapshots newer than the merge base are visited.
+        Ties in generation are broken in favor of the most recent snapshot.
+
+        :return: the merge base snapshot id, or None if the histories are unrelated
+        """
+        reached_from = {}
+        frontier = []
+
+        def reach(snapshot_id, side):
+            if snapshot_id not in reached_from:
+                reached_from[snapshot_id] = side
+                heapq.heappush(frontier, (-db.snapshots.get(snapshot_id).generation, -snapshot_id))
+            else:
+                reached_from[snapshot_id] |= side
+
+        for snapshot_id in snapshot_ids_1:
+            reach(snapshot_id, 1)
+        for snapshot_id in snapshot_ids_2:
+            reach(snapshot_id, 2)
+
         while frontier:
-            plan_id = frontier.pop()
-            history.append(plan_id)
-            snapshot = get_one(db.snapshots, id=plan_id)
-            new = set(snapshot.previous_snapshots).difference(history).difference(frontier)
-            frontier.extend(new)
-        return history
+            _, negative_snapshot_id = heapq.heappop(frontier)
+            snapshot_id = -negative_snapshot_id
+            side = reached_from[snapshot_id]
+            if side == 3:
+                return snapshot_id
+            for previous_snapshot_id in db.snapshots.get(snapshot_id).previous_snapshots:
+                reach(previous_snapshot_id, side)
+        return None
 
     def make_snapshot(db, plan_id):
-        plan = get_one(db.plans, id=plan_id)
-        snapshot_id = db.snapshot_counter
-        db.snapshot_counter += 1
+        """
+        The snapshot is stored as a delta against the plan's base snapshot (its most recent snapshot):
+        only the plan's own rows are copied into it, and the rest are shared with the base.
+        The plan's own rows are then moved into the snapshot, and the snapshot becomes the plan's new base,
+        so this costs O(changes since the plan's last snapshot) rather than O(plan size).
 
-        append(PlanSnapshot(
-            snapshot_id,
-            plan.latest_snapshots
-        ), db.snapshots, lambda x: x.id)
+        Once the deltas since the last checkpoint add up to a large enough fraction of the plan, the snapshot is stored
+        as a full checkpoint instead (see make_snapshot_at).
 
-        for activity in get_all(db.activities, plan_id=plan_id):
-            append(PlanSnapshotActivity(
+        The snapshot is made of the plan at a version stamp, without holding the plan's lock, so it can be
+        edited meanwhile. The lock is only held to pick the stamp and then to rebase the plan onto the snapshot.
+        The caller must not hold the plan's lock.
+        """
+        plan = db.plans.get_one(id=plan_id)
+        if plan.overlay_plan_id is not None:
+            raise Exception("Cannot snapshot the staging plan of merge %s" % plan.merge_id)
+        with plan.snapshot_lock:
+            with plan.lock.read():
+                at = db.read_version(plan)
+            try:
+                snapshot_id = db.make_snapshot_at(at)
+            finally:
+                db.release_version(at)
+            with plan.lock.write():
+                db.rebase(plan, snapshot_id, at)
+            return snapshot_id
+
+    def make_snapshot_at(db, at):
+        """
+        Makes a snapshot of the plan as it was at the given version. The caller must hold the plan's snapshot_lock,
+        and rebase the plan onto the snapshot (see rebase), which keeps the snapshot from being collected until then.
+
+        The snapshot is a delta against the plan's base snapshot, unless the deltas since the checkpoint would then
+        hold more rows than SNAPSHOT_CHECKPOINT_FRACTION of the snapshot's size, in which case it is a checkpoint.
+        So a checkpoint copies at most 1 / SNAPSHOT_CHECKPOINT_FRACTION times as many rows as were written to deltas
+        since the previous one, and snapshots cost O(changes) amortized. A snapshot of a plan that has not changed
+        since its base stores nothing.
+        :return: the new snapshot id
+        """
+        with db.gc_lock:
+            # So that a collection cycle cannot start between handing out the id and pinning the snapshot
+            snapshot_id = db.snapshot_counter.next()
+            db.pin_snapshot(snapshot_id)
+
+        generation = 1 + max((db.snapshots.get(previous_snapshot_id).generation for previous_snapshot_id in at.latest_snapshots), default=-1)
+        base_snapshot = db.snapshots.get(at.base_snapshot_id)
+        if base_snapshot is not None and not base_snapshot.rows and base_snapshot.base_snapshot_id is not None:
+            # Has the same activities as its own base, so skip it
+            base_snapshot = db.snapshots.get(base_snapshot.base_snapshot_id)
+
+        # Activity id -> the row of the activity, or None if it was deleted, relative to base_snapshot
+        changes = {}
+        for activity in db.activities.get_all(plan_id=at.plan_id):
+            activity = visible_version(activity, at.version)
+            if activity is not None:
+                changes[activity.activity_id] = None if isinstance(activity, DeletedActivity) else activity
+        if base_snapshot is not None and changes and base_snapshot.depth + 1 >= SNAPSHOT_MAX_DEPTH:
+            # Squash the chain of deltas into a single delta against the checkpoint
+            while base_snapshot.base_snapshot_id is not None:
+                for activity in db.snapshot_activities.get_all(plan_snapshot_id=base_snapshot.id):
+                    changes.setdefault(activity.activity_id, activity)
+                for activity_id in base_snapshot.deleted_activity_ids:
+                    changes.setdefault(activity_id, None)
+                base_snapshot = db.snapshots.get(base_snapshot.base_snapshot_id)
+
+        snapshot = None
+        if base_snapshot is not None:
+            snapshot_activities = []
+            deleted_activity_ids = set()
+            size = base_snapshot.size
+            for activity_id, activity in changes.items():
+                in_base = db.get_snapshot_activity(base_snapshot.id, activity_id) is not None
+                if activity is not None:
+                    snapshot_activities.append(activity)
+                    size += not in_base
+                elif in_base:
+                    deleted_activity_ids.add(activity_id)
+                    size -= 1
+            rows = len(snapshot_activities) + len(deleted_activity_ids)
+            chain_rows = base_snapshot.chain_rows + rows
+            if not rows or chain_rows <= SNAPSHOT_CHECKPOINT_FRACTION * size:
+                snapshot = PlanSnapshot(
                     snapshot_id,
-                    activity.activity_id,
-                    activity.type,
-                    activity.start_time,
-                    activity.args
-                ), db.snapshot_activities, lambda x: (x.plan_snapshot_id, x.activity_id))
+                    at.latest_snapshots,
+                    base_snapshot.id,
+                    frozenset(deleted_activity_ids),
+                    # An empty delta does not make reads any longer, since the next snapshot skips it
+                    base_snapshot.depth + 1 if rows else base_snapshot.depth,
+                    generation,
+                    at.tree,
+                    size,
+                    rows,
+                    chain_rows
+                )
+        if snapshot is None:
+            snapshot_activities = db.get_plan_activities(at.plan_id, at).values()
+            snapshot = PlanSnapshot(
+                snapshot_id,
+                at.latest_snapshots,
+                generation=generation,
+                tree=at.tree,
+                size=len(snapshot_activities),
+                rows=len(snapshot_activities)
+            )
 
+        db.snapshot_activities.insert_many(
+            PlanSnapshotActivity(
+                snapshot_id,
+                activity.activity_id,
+                activity.type,
+                activity.start_time,
+                activity.args
+            )
+            for activity in snapshot_activities
+        )
+        db.snapshots.insert(snapshot)
         return snapshot_id
 
-    def duplicate(db, parent_plan_id):  # TODO add start/end time to duplicate
+    def rebase(db, plan, snapshot_id, at):
+        """
+        Makes the given snapshot of the plan at the given version the plan's new base. The plan's own rows that
+        were not written since are moved into the snapshot, by ending them, so this costs O(the plan's own rows).
+        The caller must hold the plan's lock for writing.
+        """
+        version = db.version_counter.next()
+        oldest_version = db.oldest_read_version()
+        for activity in list(db.activities.get_all(plan_id=plan.id)):
+            if activity.end_version is None and activity.begin_version < at.version:
+                activity.end_version = version
+            if activity.end_version is not None and activity.end_version < oldest_version:
+                db.activities.remove(activity)
+            else:
+                prune_versions(activity, oldest_version)
+        plan.base_snapshot_id = snapshot_id
+        db.gc_barrier([snapshot_id])
+        db.unpin_snapshot(snapshot_id)
+        if at.tracks_changes or plan.tree is at.tree:
+            # Every change since the snapshot's version has been tracked
+            db.track_changes(plan, snapshot_id, at.change_counter)
+
+    def pin_snapshot(db, snapshot_id):
+        """
+        Keeps the snapshot from being collected while it is used by something other than a plan or merge request
+        """
+        with db.readers_lock:
+            db.pinned_snapshots[snapshot_id] = db.pinned_snapshots.get(snapshot_id, 0) + 1
+        db.gc_barrier([snapshot_id])
+
+    def unpin_snapshot(db, snapshot_id):
+        with db.readers_lock:
+            db.pinned_snapshots[snapshot_id] -= 1
+            if not db.pinned_snapshots[snapshot_id]:
+                del db.pinned_snapshots[snapshot_id]
+
+    def duplicate(db, parent_plan_id, start_time=None, end_time=None):
         """
         Duplicating a plan creates a new plan, with a fresh id,
         that contains the same activity versions as the original plan.
         Duplicating a plan also creates a plan comparison point that
         will be in the history of both the child and the parent plan.
+
+        The child shares all of its activity versions with that snapshot,
+        so no activities are copied.
+
+        If a start_time or end_time is given, the child only gets the activities that start within that window,
+        which are found with the parent's time index and copied, so this costs O(activities in the window).
+        Activities outside the window are not deleted from the child, just left out of it: they are left
+        untouched by merges.
+
+        The child is made from the parent at a version stamp (see make_snapshot), so the parent can be edited meanwhile.
         """
-        snapshot_id = db.make_snapshot(parent_plan_id)
-
-        parent_plan = get_one(db.plans, id=parent_plan_id)
-
-        parent_plan.latest_snapshots = set(list(parent_plan.latest_snapshots) + [snapshot_id])
-
-        child_plan_id = db.plan_counter
-        db.plan_counter += 1
-        append(Plan(
-            child_plan_id,
-            parent_plan.start_time,
-            parent_plan.end_time,
-            parent_plan_id,
-            {snapshot_id}
-        ), db.plans, lambda x: x.id)
-
-        for activity in get_all(db.activities, plan_id=parent_plan_id):
-            append(
-                Activity(
-                    child_plan_id,
-                    activity.activity_id,
-                    activity.type,
-                    activity.start_time,
-                    activity.args
-                ),
-                db.activities,
-                lambda x: (x.plan_id, x.activity_id)
-            )
+        parent_plan = db.get_live_plan(parent_plan_id)
+        if parent_plan.overlay_plan_id is not None:
+            raise Exception("Cannot duplicate the staging plan of merge %s" % parent_plan.merge_id)
+        with parent_plan.snapshot_lock:
+            with parent_plan.lock.read():
+                at = db.read_version(parent_plan)
+                if start_time is None and end_time is None:
+                    window = None
+                else:
+                    window = intersect_windows(at.window, (start_time, end_time))
+                    # Only the given window filters what is copied: the parent may have activities outside its own
+                    activity_ids = db.get_activity_ids_in_range(parent_plan_id, start_time, end_time)
+            try:
+                snapshot_id = db.make_snapshot_at(at)
+                if window is not None:
+                    activities = {activity_id: db.find_activity(parent_plan_id, activity_id, at) for activity_id in activity_ids}
+            finally:
+                db.release_version(at)
+            with parent_plan.lock.write():
+                db.rebase(parent_plan, snapshot_id, at)
+                parent_plan.latest_snapshots = set(list(parent_plan.latest_snapshots) + [snapshot_id])
+
+        child_plan_id = db.plan_counter.next()
+        if window is None:
+            db.plans.insert(Plan(
+                child_plan_id,
+                parent_plan.start_time,
+                parent_plan.end_time,
+                parent_plan_id,
+                {snapshot_id},
+                snapshot_id,
+                at.tree,
+                at.window
+            ))
+        else:
+            db.plans.insert(Plan(
+                child_plan_id,
+                parent_plan.start_time if start_time is None else start_time,
+                parent_plan.end_time if end_time is None else end_time,
+                parent_plan_id,
+                {snapshot_id},
+                window=window
+            ))
+            db.apply_changes(child_plan_id, activities)
+        db.track_changes(db.plans.get(child_plan_id), snapshot_id)
         return child_plan_id
 
     def request_merge(db, plan_supplying_changes, plan_receiving_changes):
         if plan_receiving_changes == plan_supplying_changes:
             raise Exception("Cannot merge a plan into itself")
-
-        history_receiving = set(db.get_history_plan_id(plan_receiving_changes))
-        history_supplying = db.get_history_plan_id(plan_supplying_changes)
-        for snapshot_id in history_supplying:
-            if snapshot_id in history_receiving:
-                merge_base_id = snapshot_id
-                break
-        else:
-            raise Exception("No merge base found")
-
-        snapshot_id = db.make_snapshot(plan_supplying_changes)
-
-        merge_request_id = db.merge_request_counter
-        db.merge_request_counter += 1
-        changeset = db.diff_plan_against_snapshot(plan_supplying_changes, merge_base_id)
-        if not changeset[0] and not changeset[1] and not changeset[2]:
-            raise Exception("Cannot request merge with empty changeset")
-        append(MergeRequest(
-            merge_request_id,
-            "REQUESTED",
-            plan_supplying_changes,
-            plan_receiving_changes,
-            snapshot_id,
-            changeset,
-            merge_base_id,
-            [],  # No non-conflicting changes yet
-            [],  # No conflicts yet
-            [],  # No decisions yet
-        ), db.merge_requests, lambda x: id)
-        return merge_request_id
+        supplier = db.get_live_plan(plan_supplying_changes)
+        with ExitStack() as stack:
+            with supplier.snapshot_lock:
+                with db.locking(reads=[plan_receiving_changes, plan_supplying_changes]):
+                    if not db.is_temporal_subset(plan_supplying_changes, plan_receiving_changes):
+                        raise Exception("Plan supplying changes must be a temporal subset of the plan receiving changes")
+
+                    merge_base_id = db.get_merge_base(
+                        db.get_live_plan(plan_supplying_changes).latest_snapshots,
+                        db.get_live_plan(plan_receiving_changes).latest_snapshots
+                    )
+                    if merge_base_id is None:
+                        raise Exception("No merge base found")
+                    if supplier.tree is db.snapshots.get(merge_base_id).tree:
+                        # Nothing changed since the merge base
+                        raise Exception("Cannot request merge with empty changeset")
+                    db.pin_snapshot(merge_base_id)
+                    # Unpinned however the request ends, from here on
+                    stack.callback(db.unpin_snapshot, merge_base_id)
+                    at = db.read_version(supplier)
+                    changed_activity_ids = db.get_changed_activity_ids(plan_supplying_changes, merge_base_id)
+
+                # The snapshot and the changeset are both of the supplier at the same version
+                try:
+                    snapshot_id = db.make_snapshot_at(at)
+                except BaseException:
+                    db.release_version(at)
+                    raise
+                try:
+                    changeset = db.diff_version_against_snapshot(at, merge_base_id, changed_activity_ids)
+                finally:
+                    db.release_version(at)
+                    # Even if the diff failed, as the new snapshot is pinned until the supplier is rebased onto it
+                    with supplier.lock.write():
+                        db.rebase(supplier, snapshot_id, at)
+
+            if not changeset[0] and not changeset[1] and not changeset[2]:
+                raise Exception("Cannot request merge with empty changeset")
+            merge_request_id = db.merge_request_counter.next()
+            db.merge_requests.insert(MergeRequest(
+                merge_request_id,
+                "REQUESTED",
+                plan_supplying_changes,
+                plan_receiving_changes,
+                snapshot_id,
+                changeset,
+                merge_base_id,
+                None,  # No staging plan yet
+                [],  # No conflicts yet
+                [],  # No decisions yet
+            ))
+            db.gc_barrier([merge_base_id])
+            return merge_request_id
 
     def begin_merge(db, merge_request_id):
         """
@@ -237,6 +973,8 @@ class PlanCollaborationInterface(interface.PlanCollaborationInterface):
             - Identical means either they're both deletes, or both modified to the same end result
         - If a change is in one but not the other, apply that change
         - If a change is in both, and it is not identical, this is a conflict
+            - Unless both are modifications that changed different fields, or different keys of the args,
+              which are combined (see merge_versions)
 
         Returns an in-progress merge that has:
          - merge id
@@ -247,82 +985,193 @@ class PlanCollaborationInterface(interface.PlanCollaborationInterface):
          - list of resolutions - initially all "UNRESOLVED"
 
          The existence of this in-progress merge must "lock" the plan_receiving_changes, preventing it from being modified.
+
+        The staging plan is an overlay on the plan_receiving_changes that holds only the non-conflicting changes
+        (see Plan), so it costs O(changes) rather than a copy of the plan. Until a conflict is resolved, the staging
+        plan has the receiver's version of the activity. The staging plan can be read like any other plan, but not modified.
         """
-        merge_request: "MergeRequest" = get_one(db.merge_requests, id=merge_request_id)
-
-        merge_base_id = merge_request.merge_base_id
-        # Diff both sides of the merge against the snapshot
-        receiver_adds, receiver_modifies, receiver_deletes = db.diff_plan_against_snapshot(merge_request.plan_receiving_changes, merge_base_id)
-        supplier_adds, supplier_modifies, supplier_deletes = merge_request.plan_supplying_changes_changeset
-
-        receiver_modifies_and_deletes_by_id = {}
-        for modification, _ in receiver_modifies:
-            receiver_modifies_and_deletes_by_id[modification.activity_id] = modification
-        for modification in receiver_deletes:
-            receiver_modifies_and_deletes_by_id[modification.activity_id] = "DELETE"
-
-        non_conflicting_changes = []
-        conflicts = []
-        for modification, _ in supplier_modifies:
-            if modification.activity_id in receiver_modifies_and_deletes_by_id:
-                if receiver_modifies_and_deletes_by_id[modification.activity_id] == "DELETE":
-                    conflicts.append((modification.activity_id, modification, "DELETE"))
-                else:
-                    receiver_modification = receiver_modifies_and_deletes_by_id[modification.activity_id]
-                    if modification.start_time != receiver_modification.start_time or modification.args != receiver_modification.args:
-                        conflicts.append((modification.activity_id, modification, receiver_modification))
+        merge_request: "MergeRequest" = db.merge_requests.get_one(id=merge_request_id)
+        with db.locking(writes=[merge_request.plan_receiving_changes]):
+            if merge_request.state != "REQUESTED":
+                raise Exception("Cannot begin a merge in state " + merge_request.state)
+            db.get_live_plan(merge_request.plan_supplying_changes)
+            plan_receiving_changes = db.get_writable_plan(merge_request.plan_receiving_changes)
+            # Lock the receiver against edits right away, so the rest can run without holding its lock
+            plan_receiving_changes.merge_id = merge_request.id
+
+        try:
+            merge_base_id = merge_request.merge_base_id
+            # Diff both sides of the merge against the snapshot
+            receiver_adds, receiver_modifies, receiver_deletes = db.diff_plan_against_snapshot(merge_request.plan_receiving_changes, merge_base_id)
+            supplier_adds, supplier_modifies, supplier_deletes = merge_request.plan_supplying_changes_changeset
+
+            receiver_modifies_and_deletes_by_id = {}
+            for modification, _ in receiver_modifies:
+                receiver_modifies_and_deletes_by_id[modification.activity_id] = modification
+            for modification in receiver_deletes:
+                receiver_modifies_and_deletes_by_id[modification.activity_id] = "DELETE"
+
+            non_conflicting_changes = {}  # activity id -> new version, or None if deleted
+            conflicts = []
+            for modification, base in supplier_modifies:
+                if modification.activity_id in receiver_modifies_and_deletes_by_id:
+                    if receiver_modifies_and_deletes_by_id[modification.activity_id] == "DELETE":
+                        conflicts.append((modification.activity_id, modification, "DELETE"))
                     else:
-                        noop()  # this is a no-op, no need to consider it a change
-            else:
-                non_conflicting_changes.append(("MODIFY", modification))
-
-        for delete in supplier_deletes:
-            if delete.activity_id in receiver_modifies_and_deletes_by_id and receiver_modifies_and_deletes_by_id[delete.activity_id] == "DELETE":
-                noop()  # this is a no-op, no need to consider it a change
-            elif delete.activity_id not in receiver_modifies_and_deletes_by_id:
-                non_conflicting_changes.append(("DELETE", delete.activity_id))
-            else:
-                conflicts.append((delete.activity_id, "DELETE", receiver_modifies_and_deletes_by_id[delete.activity_id]))
-
-        for add in supplier_adds:
-            non_conflicting_changes.append(("ADD", add))
-
-        # Now, we have a set of conflicts, which are tuples of one of the following forms:
-        # - (id, activity, activity)
-        # - (id, activity, "DELETE")
-        # - (id, "DELETE", activity)
-        # The items on the left are from the supplier, and the ones on the right are from the receiver.
-
-        merge_request.non_conflicting_changes = non_conflicting_changes
-        merge_request.conflicts = conflicts
-        merge_request.decisions = [None] * len(conflicts)
-        merge_request.state = "INPROGRESS"
-        return conflicts
+                        receiver_modification = receiver_modifies_and_deletes_by_id[modification.activity_id]
+                        if same_content(modification, receiver_modification):
+                            noop()  # this is a no-op, no need to consider it a change
+                            continue
+                        merged = merge_versions(merge_request.plan_receiving_changes, base, modification, receiver_modification)
+                        if merged is None:
+                            conflicts.append((modification.activity_id, modification, receiver_modification))
+                        elif not same_content(merged, receiver_modification):
+                            non_conflicting_changes[modification.activity_id] = merged
+                else:
+                    non_conflicting_changes[modification.activity_id] = modification
 
-        # TODO create staging plan
+            for delete in supplier_deletes:
+                if delete.activity_id in receiver_modifies_and_deletes_by_id and receiver_modifies_and_deletes_by_id[delete.activity_id] == "DELETE":
+                    noop()  # this is a no-op, no need to consider it a change
+                elif delete.activity_id not in receiver_modifies_and_deletes_by_id:
+                    non_conflicting_changes[delete.activity_id] = None
+                else:
+                    conflicts.append((delete.activity_id, "DELETE", receiver_modifies_and_deletes_by_id[delete.activity_id]))
+
+            for add in supplier_adds:
+                non_conflicting_changes[add.activity_id] = add
+
+            # Now, we have a set of conflicts, which are tuples of one of the following forms:
+            # - (id, activity, activity)
+            # - (id, activity, "DELETE")
+            # - (id, "DELETE", activity)
+            # The items on the left are from the supplier, and the ones on the right are from the receiver.
+
+        except BaseException:
+            with db.locking(writes=[merge_request.plan_receiving_changes]):
+                plan_receiving_changes.merge_id = None
+            raise
+
+        with db.locking(writes=[merge_request.plan_receiving_changes]):
+            if merge_request.state != "REQUESTED":
+                # Aborted meanwhile
+                raise Exception("Cannot begin a merge in state " + merge_request.state)
+            staging_plan = Plan(
+                db.plan_counter.next(),
+                plan_receiving_changes.start_time,
+                plan_receiving_changes.end_time,
+                None,
+                [],
+                tree=plan_receiving_changes.tree,
+                window=plan_receiving_changes.window
+            )
+            staging_plan.overlay_plan_id = plan_receiving_changes.id
+            staging_plan.merge_id = merge_request.id
+            # The staging plan is read through the receiver, so they share a lock
+            staging_plan.lock = plan_receiving_changes.lock
+            db.plans.insert(staging_plan)
+            db.apply_changes(staging_plan.id, non_conflicting_changes)
+
+            merge_request.staging_plan_id = staging_plan.id
+            # Its changes are now in the staging plan and the conflicts
+            merge_request.plan_supplying_changes_changeset = None
+            merge_request.conflicts = conflicts
+            merge_request.decisions = [None] * len(conflicts)
+            merge_request.state = "INPROGRESS"
+            return conflicts
 
     def diff_plan_against_snapshot(db, plan_id, snapshot_id):
+        """
+        If the plan tracks its changes against the snapshot, only the changed activities are compared.
+        Otherwise, the activities whose digests differ are found by diffing the plan's and snapshot's Merkle trees,
+        which costs O(changes * log N).
+
+        The plan is read at a version stamp (see read_version), so it can be edited meanwhile.
+        """
+        plan = db.plans.get(plan_id)
+        with plan.lock.read():
+            at = db.read_version(plan)
+            changed_activity_ids = db.get_changed_activity_ids(plan_id, snapshot_id)
+        try:
+            return db.diff_version_against_snapshot(at, snapshot_id, changed_activity_ids)
+        finally:
+            db.release_version(at)
+
+    def diff_version_against_snapshot(db, at, snapshot_id, changed_activity_ids=None):
+        """
+        :param at: the PlanVersion to diff
+        :param changed_activity_ids: the ids of the activities that may have changed since the snapshot, if known
+        """
         added = []
         deleted = []
         modified = []
+        snapshot = db.snapshots.get(snapshot_id)
+        if at.tree is snapshot.tree:
+            return added, modified, deleted
+
+        if changed_activity_ids is None:
+            changed_activity_ids = at.tree.diff(snapshot.tree)
+
+        for activity_id in sorted(changed_activity_ids):
+            activity = db.find_activity(at.plan_id, activity_id, at)
+            matching_activity = db.get_snapshot_activity(snapshot_id, activity_id)
+            if matching_activity is None:
+                if activity is not None:
+                    added.append(activity)
+            elif activity is None:
+                if in_window(at.window, matching_activity.start_time):
+                    deleted.append(matching_activity)
+            elif not same_content(activity, matching_activity):
+                modified.append((activity, matching_activity))
 
-        plan_activities = sorted(get_all(db.activities, plan_id=plan_id), key=lambda activity: activity.activity_id)
-        snapshot_activities = sorted(get_all(db.snapshot_activities, plan_snapshot_id=snapshot_id), key=lambda activity: activity.activity_id)
+        return added, modified, deleted
 
-        snapshot_activities_by_id = { activity.activity_id: activity for activity in snapshot_activities }
-        plan_activities_by_id = { activity.activity_id: activity for activity in plan_activities }
-        for activity in plan_activities:
-            if activity.activity_id not in snapshot_activities_by_id:
-                added.append(activity)
-            else:
-                matching_activity = snapshot_activities_by_id[activity.activity_id]
-                if not (activity.args == matching_activity.args and activity.start_time == matching_activity.start_time):
-                    modified.append((activity, snapshot_activities_by_id[activity.activity_id]))
-        for activity in snapshot_activities:
-            if activity.activity_id not in plan_activities_by_id:
-                deleted.append(activity)
+    def get_conflicts(db, merge_id, offset=0, limit=None, type=None, start_time=None, end_time=None):
+        """
+        Pages through the conflicts of an in-progress merge, in order, without reading their activity versions
+        :param offset: the number of matching conflicts to skip, e.g. the number already shown
+        :param type: only the conflicts on activities of this type
+        :param start_time, end_time: only the conflicts where either side's version starts between these times
+                                     (inclusive, and unbounded if None)
+        :return: a list of at most limit Conflicts
+        """
+        merge_request = db.merge_requests.get_one(id=merge_id)
+        with db.locking(reads=[merge_request.plan_receiving_changes]):
+            if merge_request.state != "INPROGRESS":
+                raise Exception("Cannot list conflicts of a merge in state " + merge_request.state)
+            window = None if start_time is None and end_time is None else (start_time, end_time)
+            conflicts = []
+            for conflict_index, (activity_id, supplier, receiver) in enumerate(merge_request.conflicts):
+                if limit is not None and len(conflicts) >= limit:
+                    break
+                versions = [version for version in (supplier, receiver) if version != "DELETE"]
+                if type is not None and versions[0].type != type:
+                    continue
+                if not any(in_window(window, version.start_time) for version in versions):
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                conflicts.append(Conflict(
+                    conflict_index,
+                    activity_id,
+                    "DELETE" if supplier == "DELETE" else "MODIFY",
+                    "DELETE" if receiver == "DELETE" else "MODIFY",
+                    merge_request.plan_supplying_changes_snapshot,
+                    merge_request.plan_receiving_changes,
+                    merge_request.decisions[conflict_index]
+                ))
+            return conflicts
 
-        return added, modified, deleted
+    def get_conflict(db, merge_id, conflict_index):
+        """
+        :return: the conflict's (activity_id, supplier's version or "DELETE", receiver's version or "DELETE"), like begin_merge
+        """
+        merge_request = db.merge_requests.get_one(id=merge_id)
+        with db.locking(reads=[merge_request.plan_receiving_changes]):
+            if not 0 <= conflict_index < len(merge_request.conflicts):
+                raise Exception("Invalid conflict index: " + repr(conflict_index))
+            return merge_request.conflicts[conflict_index]
 
     def resolve_conflict(db, merge_id, conflict_index, resolution):
         """
@@ -330,116 +1179,231 @@ class PlanCollaborationInterface(interface.PlanCollaborationInterface):
 
         A resolution chooses an activity version from one plan or the other
         """
-        merge_request = get_one(db.merge_requests, id=merge_id)
+        merge_request = db.merge_requests.get_one(id=merge_id)
+        with db.locking(writes=[merge_request.plan_receiving_changes]):
+            if merge_request.state != "INPROGRESS":
+                raise Exception("Cannot resolve conflicts of a merge in state " + merge_request.state)
+            db.stage_resolution(merge_request, conflict_index, resolution)
+
+    def stage_resolution(db, merge_request, conflict_index, resolution):
+        """
+        Records the resolution, and writes the version it chooses to the merge's staging plan
+        """
         merge_request.decisions[conflict_index] = resolution
+        activity_id, supplier, receiver = merge_request.conflicts[conflict_index]
+        version = supplier if resolution == "CHANGE_SUPPLIER" else receiver
+        db.apply_changes(merge_request.staging_plan_id, {activity_id: None if version == "DELETE" else version})
+
+    def resolve_conflicts_bulk(db, merge_id, resolutions):
+        """
+        Applies multiple resolutions at once.
+        :param resolutions: either "CHANGE_SUPPLIER" or "CHANGE_RECEIVER", to resolve every conflict that way,
+                            or a list of (conflict_index, resolution) pairs
+        """
+        merge_request = db.merge_requests.get_one(id=merge_id)
+        with db.locking(writes=[merge_request.plan_receiving_changes]):
+            if merge_request.state != "INPROGRESS":
+                raise Exception("Cannot resolve conflicts of a merge in state " + merge_request.state)
+            if isinstance(resolutions, str):
+                resolutions = [(conflict_index, resolutions) for conflict_index in range(len(merge_request.conflicts))]
+            else:
+                resolutions = list(resolutions)
+            for conflict_index, resolution in resolutions:
+                if resolution not in ("CHANGE_SUPPLIER", "CHANGE_RECEIVER"):
+                    raise Exception("Invalid resolution: " + repr(resolution))
+                if not 0 <= conflict_index < len(merge_request.decisions):
+                    raise Exception("Invalid conflict index: " + repr(conflict_index))
+            for conflict_index, resolution in resolutions:
+                db.stage_resolution(merge_request, conflict_index, resolution)
 
     def get_merge_status(db, merge_id):
-        return get_one(db.merge_requests, id=merge_id).state
+        return db.merge_requests.get_one(id=merge_id).state
 
     def commit_merge(db, merge_id):
         """
         Checks that the merge is fully resolved (no conflicts are in the "UNRESOLVED" state)
-        Updates the staging area based on conflict resolutions
-        Updates plan_receiving_changes to contain all activities in the staging area
+        Updates plan_receiving_changes to contain all activities in the staging area, by applying the staging
+        plan's own rows to it in one batch
         Marks the merge as "COMMITTED" (which unlocks the plan_receiving_changes for modification)
         """
-        merge_request: "MergeRequest" = get_one(db.merge_requests, id=merge_id)
+        merge_request: "MergeRequest" = db.merge_requests.get_one(id=merge_id)
 
-        if merge_request.state != "INPROGRESS":
-            raise Exception("Cannot commit a merge in state " + merge_request.state)
+        with db.locking(writes=[merge_request.plan_receiving_changes, merge_request.plan_supplying_changes]):
+            if merge_request.state != "INPROGRESS":
+                raise Exception("Cannot commit a merge in state " + merge_request.state)
 
-        if None in merge_request.decisions:
-            raise Exception("Merge cannot be committed until all conflicts are resolved")
+            if None in merge_request.decisions:
+                raise Exception("Merge cannot be committed until all conflicts are resolved")
 
-        # apply changes from the merge request to the plan_receiving_changes
-        for change_type, payload in merge_request.non_conflicting_changes:
-            if change_type == "ADD":
-                append(Activity(
-                    merge_request.plan_receiving_changes,
-                    payload.activity_id,
-                    payload.type,
-                    payload.start_time,
-                    payload.args
-                ), db.activities, lambda x: (x.plan_id, x.activity_id))
-            if change_type == "MODIFY":
-                db.modify_activity(merge_request.plan_receiving_changes, payload.activity_id, payload.start_time, payload.args)
-            if change_type == "DELETE":
-                db.delete_activity(merge_request.plan_receiving_changes, payload)
-
-        for decision, (activity_id, supplier, receiver) in zip(merge_request.decisions, merge_request.conflicts):
-            if decision == "CHANGE_RECEIVER":
-                continue
-            if decision == "CHANGE_SUPPLIER":
-                if supplier == "DELETE":
-                    db.delete_activity(merge_request.plan_receiving_changes, activity_id)
-                elif receiver == "DELETE":
-                    append(Activity(
-                        merge_request.plan_receiving_changes,
-                        activity_id,
-                        supplier.type,
-                        supplier.start_time,
-                        supplier.args
-                    ), db.activities, lambda x: (x.plan_id, x.activity_id))
-                else:
-                    db.modify_activity(merge_request.plan_receiving_changes, activity_id, supplier.start_time, supplier.args)
-        merge_request.state = "COMMITTED"
+            # Promote the staging plan's changes to the plan_receiving_changes, all in one batch.
+            # Conflicts resolved in favor of the receiver are already the receiver's versions.
+            kept_activity_ids = {
+                activity_id
+                for decision, (activity_id, _, _) in zip(merge_request.decisions, merge_request.conflicts)
+                if decision == "CHANGE_RECEIVER"
+            }
+            changes = {}
+            for activity in db.activities.get_all(plan_id=merge_request.staging_plan_id):
+                activity = visible_version(activity, None)
+                if activity is not None and activity.activity_id not in kept_activity_ids:
+                    changes[activity.activity_id] = None if isinstance(activity, DeletedActivity) else activity
 
+            db.apply_changes(merge_request.plan_receiving_changes, changes)
+            merge_request.state = "COMMITTED"
+            db.plans.get(merge_request.plan_receiving_changes).merge_id = None
+            # Its rows are reclaimed by collect_garbage
+            db.plans.get(merge_request.staging_plan_id).deleted = True
 
-        # Include the pre-merge snapshot of the plan_supplying_changes in the history of both plans going forward
-        plan_receiving_changes: "Plan" = get_one(db.plans, id=merge_request.plan_receiving_changes)
-        plan_supplying_changes: "Plan" = get_one(db.plans, id=merge_request.plan_supplying_changes)
 
-        plan_supplying_changes.latest_snapshots = {merge_request.plan_supplying_changes_snapshot} # the new snapshot dominates the old snapshots
+            # Include the pre-merge snapshot of the plan_supplying_changes in the history of both plans going forward
+            plan_receiving_changes: "Plan" = db.plans.get_one(id=merge_request.plan_receiving_changes)
+            plan_supplying_changes: "Plan" = db.plans.get_one(id=merge_request.plan_supplying_changes)
 
-        plan_receiving_changes.latest_snapshots = set(plan_receiving_changes.latest_snapshots)
-        plan_receiving_changes.latest_snapshots.update([merge_request.plan_supplying_changes_snapshot])
+            plan_supplying_changes.latest_snapshots = {merge_request.plan_supplying_changes_snapshot} # the new snapshot dominates the old snapshots
 
-        # TODO delete staging plan
+            plan_receiving_changes.latest_snapshots = set(plan_receiving_changes.latest_snapshots)
+            plan_receiving_changes.latest_snapshots.update([merge_request.plan_supplying_changes_snapshot])
+            db.gc_barrier([merge_request.plan_supplying_changes_snapshot])
 
     def abort_merge(db, merge_id):
         """
         Marks the merge as "ABORTED" (which unlocks the plan_receiving_changes for modification)
+        Drops the staging plan, whose rows are reclaimed by collect_garbage
         """
-        merge_request: "MergeRequest" = get_one(db.merge_requests, id=merge_id)
-        merge_request.state = "ABORTED"
+        merge_request: "MergeRequest" = db.merge_requests.get_one(id=merge_id)
+        with db.locking(writes=[merge_request.plan_receiving_changes]):
+            merge_request.state = "ABORTED"
+            plan_receiving_changes = db.plans.get(merge_request.plan_receiving_changes)
+            if plan_receiving_changes is not None and plan_receiving_changes.merge_id == merge_id:
+                plan_receiving_changes.merge_id = None
+            staging_plan = db.plans.get(merge_request.staging_plan_id)
+            if staging_plan is not None:
+                staging_plan.deleted = True
+
+    def delete(db, plan_id):
+        """
+        Marks the plan as deleted. Its activities, and the snapshots that are no longer needed by any
+        other plan or merge, are reclaimed by collect_garbage.
+        """
+        with db.locking(writes=[plan_id]):
+            plan = db.get_live_plan(plan_id)
+            if plan.overlay_plan_id is not None:
+                raise Exception("Cannot delete the staging plan of merge %s" % plan.merge_id)
+            for merge_request in list(db.merge_requests.get_all(plan_supplying_changes=plan_id)) + list(db.merge_requests.get_all(plan_receiving_changes=plan_id)):
+                if merge_request.state == "INPROGRESS":
+                    raise Exception("Cannot delete a plan involved in an in-progress merge")
+            plan.deleted = True
+
+    def get_live_plan(db, plan_id):
+        plan = db.plans.get(plan_id)
+        if plan is None or plan.deleted:
+            raise Exception("Plan %s is deleted" % plan_id)
+        return plan
+
+    def collect_garbage(db, budget=1000):
+        """
+        Runs the garbage collector for at most budget units of work (snapshots visited, or rows removed),
+        so that it can be interleaved with other operations. Call it repeatedly to make progress.
 
-        # TODO delete staging plan
+        A collection cycle marks every snapshot reachable from live plans and from requested or
+        in-progress merges, following both history (previous_snapshots) and delta bases. Then it
+        removes the unmarked snapshots, and the deleted plans along with their own activity rows.
 
-    def delete(db, plan):
-        pass
+        Runs under gc_lock, which the write barrier also takes, so it can run alongside other threads.
+
+        :return: True if a collection cycle finished during this call
+        """
+        with db.gc_lock:
+            if db.garbage_collection is None:
+                db.garbage_collection = db.garbage_collection_cycle()
+            for _ in range(budget):
+                try:
+                    next(db.garbage_collection)
+                except StopIteration:
+                    db.garbage_collection = None
+                    return True
+            return False
+
+    def garbage_collection_cycle(db):
+        db.gc_marked = set()
+        db.gc_worklist = []
+        # Anything created after this point is live for this cycle
+        plan_counter = db.plan_counter.value
+        snapshot_counter = db.snapshot_counter.value
+        merge_request_counter = db.merge_request_counter.value
+
+        db.gc_barrier(list(db.pinned_snapshots))
+        for plan_id in range(plan_counter):
+            plan = db.plans.get(plan_id)
+            if plan is not None and not plan.deleted:
+                # Copied, since the plan may be changed by another thread while it is being scanned
+                db.gc_barrier(list(plan.latest_snapshots) + [plan.base_snapshot_id])
+            yield
+        for merge_request_id in range(merge_request_counter):
+            merge_request = db.merge_requests.get(merge_request_id)
+            if merge_request is not None and merge_request.state in ("REQUESTED", "INPROGRESS") and not (
+                    db.plans.get(merge_request.plan_supplying_changes).deleted or db.plans.get(merge_request.plan_receiving_changes).deleted):
+                db.gc_barrier([merge_request.merge_base_id, merge_request.plan_supplying_changes_snapshot])
+            yield
+        while db.gc_worklist:
+            snapshot = db.snapshots.get(db.gc_worklist.pop())
+            if snapshot is not None:  # Unless it is pinned while it is being made
+                db.gc_barrier(snapshot.previous_snapshots)
+                db.gc_barrier([snapshot.base_snapshot_id])
+            yield
+        marked = db.gc_marked
+        db.gc_marked = None
+
+        for snapshot_id in range(snapshot_counter):
+            snapshot = db.snapshots.get(snapshot_id)
+            if snapshot is not None and snapshot_id not in marked:
+                for activity in list(db.snapshot_activities.get_all(plan_snapshot_id=snapshot_id)):
+                    db.snapshot_activities.remove(activity)
+                    yield
+                db.snapshots.remove(snapshot)
+            yield
+        for plan_id in range(plan_counter):
+            plan = db.plans.get(plan_id)
+            if plan is not None and plan.deleted:
+                for activity in list(db.activities.get_all(plan_id=plan_id)):
+                    db.activities.remove(activity)
+                    yield
+                db.plans.remove(plan)
+            yield
+
+    def gc_barrier(db, snapshot_ids):
+        """
+        Marks the given snapshots as reachable if a garbage collection cycle is marking. This must be called
+        whenever a reference to a snapshot is stored, so that snapshots that become reachable only through
+        something that was already visited by the cycle are not collected.
+        """
+        if db.gc_marked is None:
+            return
+        # Marking ends under the same lock, so a snapshot is never marked without being traced
+        with db.gc_lock:
+            marked = db.gc_marked
+            if marked is None:
+                return
+            for snapshot_id in snapshot_ids:
+                if snapshot_id is not None and snapshot_id not in marked:
+                    marked.add(snapshot_id)
+                    db.gc_worklist.append(snapshot_id)
 
     def get_activity_type(db, plan_id, activity_id):
-        return get_one(db.activities, plan_id=plan_id, activity_id=activity_id).type
+        with db.locking(reads=[plan_id]):
+            db.get_live_plan(plan_id)
+            return db.get_activity(plan_id, activity_id).type
 
     def get_activity_start_time(db, plan_id, activity_id):
-        return get_one(db.activities, plan_id=plan_id, activity_id=activity_id).start_time
+        with db.locking(reads=[plan_id]):
+            db.get_live_plan(plan_id)
+            return db.get_activity(plan_id, activity_id).start_time
 
     def get_activity_args(db, plan_id, activity_id):
-        return get_one(db.activities, plan_id=plan_id, activity_id=activity_id).args
-
+        with db.locking(reads=[plan_id]):
+            db.get_live_plan(plan_id)
+            return db.get_activity(plan_id, activity_id).args
 
-def get_one(table, **attributes):
-    all = list(get_all(table, **attributes))
-    assert len(all) == 1
-    return all[0]
-
-
-def get_all(table, **attributes):
-    for x in table:
-        for attribute_name, attribute_value in attributes.items():
-            if getattr(x, attribute_name) != attribute_value:
-                break
-        else:
-            yield x
-
-def append(new_element, list_, key):
-    keys = set()
-    for element in list_:
-        new_key = key(element)
-        if new_key in keys: raise Exception("Existing uniqueness constraint violation")
-    new_key = key(new_element)
-    if new_key in keys: raise Exception("New key causes constraint violation")
-    list_.append(new_element)
 
 def noop():
     print("", end="")
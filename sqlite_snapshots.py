@@ -0,0 +1,768 @@
+"""
+The snapshots design, stored in SQLite rather than in memory, with the tables from the notes: plans,
+activities, plan_snapshot, plan_snapshot_activities and merge_request.
+
+A plan owns a full copy of its activities, and a snapshot owns a full copy of the plan's activities at the
+time it was made. Copying is done inside the database with set-based statements (INSERT ... SELECT), so
+make_snapshot, duplicate and commit_merge never bring activities into Python. begin_merge classifies changes
+with a single statement too, and returns only the number of conflicts. They are read back lazily, with
+iter_conflicts or get_conflicts.
+
+Every operation is a transaction. The database is in WAL mode: writers take turns on a single connection,
+while readers use a pool of connections and each read a consistent version of the database, without
+blocking the writer or each other (see ConnectionPool).
+
+Activity args are stored as canonical JSON (sorted keys, no whitespace), so two args match exactly
+(see frozen.py) when their text is equal.
+"""
+
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import interface
+from common import Conflict, intersect_windows
+from frozen import freeze
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    start_time,
+    end_time,
+    parent_id INTEGER,
+    window_start,
+    window_end,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    merge_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS activities (
+    plan_id INTEGER NOT NULL,
+    activity_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    start_time NOT NULL,
+    args TEXT NOT NULL,
+    PRIMARY KEY (plan_id, activity_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS activities_start_time ON activities (plan_id, start_time);
+
+CREATE TABLE IF NOT EXISTS plan_snapshot (
+    id INTEGER PRIMARY KEY,
+    plan_id INTEGER NOT NULL,
+    generation INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS plan_snapshot_parent (
+    snapshot_id INTEGER NOT NULL,
+    previous_snapshot_id INTEGER NOT NULL,
+    PRIMARY KEY (snapshot_id, previous_snapshot_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS plan_latest_snapshots (
+    plan_id INTEGER NOT NULL,
+    snapshot_id INTEGER NOT NULL,
+    PRIMARY KEY (plan_id, snapshot_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS plan_snapshot_activities (
+    snapshot_id INTEGER NOT NULL,
+    activity_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    start_time NOT NULL,
+    args TEXT NOT NULL,
+    PRIMARY KEY (snapshot_id, activity_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS merge_request (
+    id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    plan_supplying_changes INTEGER NOT NULL,
+    plan_receiving_changes INTEGER NOT NULL,
+    plan_supplying_changes_snapshot INTEGER NOT NULL,
+    merge_base_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS merge_request_supplier ON merge_request (plan_supplying_changes);
+CREATE INDEX IF NOT EXISTS merge_request_receiver ON merge_request (plan_receiving_changes);
+
+-- The changes of an in-progress merge. change_type is 'ADD', 'MODIFY' or 'DELETE' for a change that does not
+-- conflict, or 'CONFLICT', in which case each side's change is 'MODIFY' or 'DELETE', conflict_index numbers
+-- the merge's conflicts from 0, and resolution is NULL until resolved
+CREATE TABLE IF NOT EXISTS merge_request_change (
+    merge_id INTEGER NOT NULL,
+    activity_id INTEGER NOT NULL,
+    change_type TEXT NOT NULL,
+    supplier_change TEXT NOT NULL,
+    receiver_change TEXT,
+    conflict_index INTEGER,
+    resolution TEXT,
+    PRIMARY KEY (merge_id, activity_id)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS merge_request_conflict ON merge_request_change (merge_id, conflict_index) WHERE conflict_index IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('activity', 0);
+"""
+
+# Where the activities of a plan, or of a snapshot, are stored: (table, key column)
+PLAN_ACTIVITIES = ("activities", "plan_id")
+SNAPSHOT_ACTIVITIES = ("plan_snapshot_activities", "snapshot_id")
+
+
+def same_content(a, b):
+    """
+    :return: an SQL condition of whether the activity versions in tables a and b have the same content.
+             typeof tells 1 and 1.0 apart, like frozen.equal.
+    """
+    return "{a}.type = {b}.type AND {a}.start_time = {b}.start_time AND typeof({a}.start_time) = typeof({b}.start_time) AND {a}.args = {b}.args".format(a=a, b=b)
+
+
+# The full outer join of the supplier's snapshot (s) and the merge base (b) by activity id, with each activity's change on
+# the supplier's side: 'ADD', 'MODIFY', 'DELETE', or NULL if it did not change. Deletions only count within the supplier's window.
+# SQLite runs a FULL JOIN of two filtered subqueries as a nested loop, so the join is driven by the union of their ids instead,
+# which looks both sides up by primary key.
+SUPPLIER_CHANGES = """
+    (
+        SELECT activity_id FROM plan_snapshot_activities WHERE snapshot_id = :snapshot_id
+        UNION
+        SELECT activity_id FROM plan_snapshot_activities WHERE snapshot_id = :merge_base_id
+    ) k
+    LEFT JOIN plan_snapshot_activities s ON s.snapshot_id = :snapshot_id AND s.activity_id = k.activity_id
+    LEFT JOIN plan_snapshot_activities b ON b.snapshot_id = :merge_base_id AND b.activity_id = k.activity_id
+"""
+SUPPLIER_CHANGE = """
+    CASE
+        WHEN b.activity_id IS NULL THEN 'ADD'
+        WHEN s.activity_id IS NULL THEN
+            CASE WHEN (:supplier_start IS NULL OR b.start_time >= :supplier_start) AND (:supplier_end IS NULL OR b.start_time <= :supplier_end) THEN 'DELETE' END
+        WHEN NOT (%s) THEN 'MODIFY'
+    END
+""" % same_content("s", "b")
+
+# Correlates the supplier's changes with the receiver's (r) in a single pass: a change goes through unless the receiver
+# changed the same activity differently, and changes that both sides made the same way are dropped. The receiver's
+# additions can never be changed by the merge, so the receiver is only joined to the activities the supplier changed.
+MERGE_CHANGES = """
+    INSERT INTO merge_request_change (merge_id, activity_id, change_type, supplier_change, receiver_change, conflict_index)
+    SELECT :merge_id, activity_id, change_type, supplier_change, receiver_change,
+        CASE WHEN change_type = 'CONFLICT' THEN row_number() OVER (PARTITION BY change_type = 'CONFLICT' ORDER BY activity_id) - 1 END
+    FROM (
+        SELECT activity_id, supplier_change, receiver_change,
+            CASE
+                WHEN supplier_change = 'ADD' OR receiver_change IS NULL THEN supplier_change
+                WHEN supplier_change = 'DELETE' AND receiver_change = 'DELETE' THEN NULL
+                WHEN supplier_change = 'MODIFY' AND receiver_change = 'MODIFY' AND same_result THEN NULL
+                ELSE 'CONFLICT'
+            END AS change_type
+        FROM (
+            SELECT k.activity_id,
+                %s AS supplier_change,
+                CASE
+                    WHEN b.activity_id IS NULL THEN NULL
+                    WHEN r.activity_id IS NULL THEN
+                        CASE WHEN (:receiver_start IS NULL OR b.start_time >= :receiver_start) AND (:receiver_end IS NULL OR b.start_time <= :receiver_end) THEN 'DELETE' END
+                    WHEN NOT (%s) THEN 'MODIFY'
+                END AS receiver_change,
+                s.activity_id IS NOT NULL AND r.activity_id IS NOT NULL AND %s AS same_result
+            FROM %s
+            LEFT JOIN activities r ON r.plan_id = :plan_receiving_changes AND r.activity_id = k.activity_id
+        )
+        WHERE supplier_change IS NOT NULL
+    )
+    WHERE change_type IS NOT NULL
+""" % (SUPPLIER_CHANGE, same_content("r", "b"), same_content("s", "r"), SUPPLIER_CHANGES)
+
+# A page of a merge's conflicts, without their activity versions: either side's version must match the filters
+CONFLICT_PAGE = """
+    SELECT c.conflict_index, c.activity_id, c.supplier_change, c.receiver_change, m.plan_supplying_changes_snapshot, m.plan_receiving_changes, c.resolution
+    FROM merge_request_change c
+    JOIN merge_request m ON m.id = c.merge_id
+    LEFT JOIN plan_snapshot_activities s ON s.snapshot_id = m.plan_supplying_changes_snapshot AND s.activity_id = c.activity_id
+    LEFT JOIN activities r ON r.plan_id = m.plan_receiving_changes AND r.activity_id = c.activity_id
+    WHERE c.merge_id = :merge_id AND c.conflict_index IS NOT NULL
+        AND (:type IS NULL OR COALESCE(s.type, r.type) = :type)
+        AND (
+            (s.activity_id IS NOT NULL AND (:start_time IS NULL OR s.start_time >= :start_time) AND (:end_time IS NULL OR s.start_time <= :end_time))
+            OR (r.activity_id IS NOT NULL AND (:start_time IS NULL OR r.start_time >= :start_time) AND (:end_time IS NULL OR r.start_time <= :end_time))
+        )
+    ORDER BY c.conflict_index
+    LIMIT :limit OFFSET :offset
+"""
+
+# A merge's conflicts, with the supplier's and receiver's versions of each activity
+CONFLICT_VERSIONS = """
+    SELECT c.activity_id, c.supplier_change, c.receiver_change, s.type, s.start_time, s.args, r.type, r.start_time, r.args
+    FROM merge_request_change c
+    JOIN merge_request m ON m.id = c.merge_id
+    LEFT JOIN plan_snapshot_activities s ON s.snapshot_id = m.plan_supplying_changes_snapshot AND s.activity_id = c.activity_id
+    LEFT JOIN activities r ON r.plan_id = m.plan_receiving_changes AND r.activity_id = c.activity_id
+"""
+
+
+def encode_args(args):
+    return json.dumps(args, sort_keys=True, separators=(",", ":"))
+
+
+class Activity:
+    """
+    An activity version read from the database
+    """
+    __slots__ = ("activity_id", "type", "start_time", "args")
+
+    def __init__(self, activity_id, type, start_time, args):
+        self.activity_id = activity_id
+        self.type = type
+        self.start_time = start_time
+        self.args = freeze(json.loads(args))
+
+    def __repr__(self):
+        return repr({name: getattr(self, name) for name in self.__slots__})
+
+
+def conflict_versions(row):
+    """
+    :param row: a row of CONFLICT_VERSIONS
+    :return: the conflict, as (activity_id, supplier's version or "DELETE", receiver's version or "DELETE")
+    """
+    activity_id, supplier_change, receiver_change, *versions = row
+    return (
+        activity_id,
+        "DELETE" if supplier_change == "DELETE" else Activity(activity_id, *versions[:3]),
+        "DELETE" if receiver_change == "DELETE" else Activity(activity_id, *versions[3:]),
+    )
+
+
+class ConnectionPool:
+    """
+    A single connection for writing, which writers take turns on, and a pool of connections for reading.
+    The database is in WAL mode, so a reader sees the database as of the start of its transaction, and
+    never blocks the writer or other readers.
+    """
+    def __init__(self, path, readers=4):
+        self.path = path
+        self.write_lock = threading.Lock()
+        self.writer = self.connect()
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.readers = queue.LifoQueue()
+        for _ in range(readers):
+            self.readers.put(self.connect())
+
+    def connect(self):
+        # Transactions are begun explicitly, and a connection is only used by one thread at a time
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=10000")
+        return connection
+
+    @contextmanager
+    def reading(self):
+        """
+        :return: a connection in a read transaction, for the duration of the block
+        """
+        connection = self.readers.get()
+        try:
+            connection.execute("BEGIN")
+            try:
+                yield connection
+            finally:
+                connection.execute("COMMIT")
+        finally:
+            self.readers.put(connection)
+
+    @contextmanager
+    def writing(self):
+        """
+        :return: the writer connection in a write transaction, which is committed at the end of the block,
+                 or rolled back if it raises
+        """
+        with self.write_lock:
+            self.writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.writer
+            except BaseException:
+                self.writer.execute("ROLLBACK")
+                raise
+            self.writer.execute("COMMIT")
+
+    def close(self):
+        with self.write_lock:
+            self.writer.close()
+        while not self.readers.empty():
+            self.readers.get().close()
+
+
+class PlanCollaborationInterface(interface.PlanCollaborationInterface):
+    def __init__(db, path=None, readers=4):
+        """
+        :param path: the database file, which is created if needed. By default, a temporary database
+                     is used, which is removed by close().
+        :param readers: the number of connections for concurrent readers
+        """
+        db.temporary_directory = None
+        if path is None:
+            db.temporary_directory = tempfile.mkdtemp()
+            path = os.path.join(db.temporary_directory, "snapshots.db")
+        db.pool = ConnectionPool(path, readers)
+        with db.pool.write_lock:
+            db.pool.writer.executescript(SCHEMA)
+
+    def close(db):
+        db.pool.close()
+        if db.temporary_directory is not None:
+            shutil.rmtree(db.temporary_directory)
+
+    def make_fresh_plan(db, start_time=None, end_time=None):
+        """
+        Makes a new, empty plan
+        :return: the new plan id
+        """
+        with db.pool.writing() as connection:
+            return connection.execute("INSERT INTO plans (start_time, end_time) VALUES (?, ?)", (start_time, end_time)).lastrowid
+
+    def get_activity_ids(db, plan_id):
+        """
+        :return: the activity ids of all activities in the given plan
+        """
+        with db.pool.reading() as connection:
+            return [activity_id for activity_id, in connection.execute(
+                "SELECT activity_id FROM activities WHERE plan_id = ? ORDER BY activity_id", (plan_id,))]
+
+    def add_activity(db, plan_id, type="Type", *, start_time, args):
+        """
+        Add a new activity to the given plan
+        :return: the id of the new activity
+        """
+        with db.pool.writing() as connection:
+            db.get_writable_plan(connection, plan_id)
+            activity_id, = connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'activity' RETURNING value - 1").fetchone()
+            connection.execute(
+                "INSERT INTO activities (plan_id, activity_id, type, start_time, args) VALUES (?, ?, ?, ?, ?)",
+                (plan_id, activity_id, type, start_time, encode_args(args))
+            )
+            return activity_id
+
+    def modify_activity(db, plan_id, activity_id, new_start_time, new_activity_args):
+        with db.pool.writing() as connection:
+            db.get_writable_plan(connection, plan_id)
+            cursor = connection.execute(
+                "UPDATE activities SET start_time = ?, args = ? WHERE plan_id = ? AND activity_id = ?",
+                (new_start_time, encode_args(new_activity_args), plan_id, activity_id)
+            )
+            if not cursor.rowcount:
+                raise Exception("Activity %s is not in plan %s" % (activity_id, plan_id))
+
+    def delete_activity(db, plan_id, activity_id):
+        with db.pool.writing() as connection:
+            db.get_writable_plan(connection, plan_id)
+            cursor = connection.execute("DELETE FROM activities WHERE plan_id = ? AND activity_id = ?", (plan_id, activity_id))
+            if not cursor.rowcount:
+                raise Exception("Activity %s is not in plan %s" % (activity_id, plan_id))
+
+    def get_live_plan(db, connection, plan_id):
+        """
+        :return: the plan's (start_time, end_time, window_start, window_end, merge_id)
+        """
+        plan = connection.execute(
+            "SELECT start_time, end_time, window_start, window_end, merge_id FROM plans WHERE id = ? AND NOT deleted", (plan_id,)
+        ).fetchone()
+        if plan is None:
+            raise Exception("Plan %s is deleted" % plan_id)
+        return plan
+
+    def get_writable_plan(db, connection, plan_id):
+        plan = db.get_live_plan(connection, plan_id)
+        if plan[4] is not None:
+            raise Exception("Plan %s is locked by in-progress merge %s" % (plan_id, plan[4]))
+        return plan
+
+    def get_activity(db, connection, plan_id, activity_id):
+        row = connection.execute(
+            "SELECT activity_id, type, start_time, args FROM activities WHERE plan_id = ? AND activity_id = ?", (plan_id, activity_id)
+        ).fetchone()
+        if row is None:
+            raise Exception("Activity %s is not in plan %s" % (activity_id, plan_id))
+        return Activity(*row)
+
+    def make_snapshot(db, plan_id):
+        with db.pool.writing() as connection:
+            return db.snapshot(connection, plan_id)
+
+    def snapshot(db, connection, plan_id):
+        """
+        Copies the plan's activities into a new snapshot, whose history is the plan's latest snapshots
+        :return: the new snapshot id
+        """
+        snapshot_id = connection.execute("""
+            INSERT INTO plan_snapshot (plan_id, generation)
+            SELECT ?, 1 + COALESCE(MAX(plan_snapshot.generation), -1)
+            FROM plan_latest_snapshots JOIN plan_snapshot ON plan_snapshot.id = plan_latest_snapshots.snapshot_id
+            WHERE plan_latest_snapshots.plan_id = ?
+        """, (plan_id, plan_id)).lastrowid
+        connection.execute("""
+            INSERT INTO plan_snapshot_parent (snapshot_id, previous_snapshot_id)
+            SELECT ?, snapshot_id FROM plan_latest_snapshots WHERE plan_id = ?
+        """, (snapshot_id, plan_id))
+        connection.execute("""
+            INSERT INTO plan_snapshot_activities (snapshot_id, activity_id, type, start_time, args)
+            SELECT ?, activity_id, type, start_time, args FROM activities WHERE plan_id = ?
+        """, (snapshot_id, plan_id))
+        return snapshot_id
+
+    def duplicate(db, parent_plan_id, start_time=None, end_time=None):
+        """
+        Snapshots the parent, and copies the snapshot into the new child plan. Both plans get the snapshot
+        in their history.
+
+        If a start_time or end_time is given, the child only gets the activities that start within that window.
+        Activities outside the window are not deleted from the child, just left out of it: they are left
+        untouched by merges. The child's window for diffing is that window within the parent's, but only the
+        given one filters what is copied, since the parent may have activities outside its own window.
+        """
+        with db.pool.writing() as connection:
+            parent_start_time, parent_end_time, window_start, window_end, _ = db.get_live_plan(connection, parent_plan_id)
+            window = None if window_start is None and window_end is None else (window_start, window_end)
+            if start_time is not None or end_time is not None:
+                window = intersect_windows(window, (start_time, end_time))
+            if window is None:
+                window = (None, None)
+            snapshot_id = db.snapshot(connection, parent_plan_id)
+            child_plan_id = connection.execute("""
+                INSERT INTO plans (start_time, end_time, parent_id, window_start, window_end) VALUES (?, ?, ?, ?, ?)
+            """, (
+                parent_start_time if start_time is None else start_time,
+                parent_end_time if end_time is None else end_time,
+                parent_plan_id,
+                *window
+            )).lastrowid
+            connection.execute("""
+                INSERT INTO activities (plan_id, activity_id, type, start_time, args)
+                SELECT ?1, activity_id, type, start_time, args FROM plan_snapshot_activities
+                WHERE snapshot_id = ?2 AND (?3 IS NULL OR start_time >= ?3) AND (?4 IS NULL OR start_time <= ?4)
+            """, (child_plan_id, snapshot_id, start_time, end_time))
+            connection.executemany(
+                "INSERT INTO plan_latest_snapshots (plan_id, snapshot_id) VALUES (?, ?)",
+                [(parent_plan_id, snapshot_id), (child_plan_id, snapshot_id)]
+            )
+            return child_plan_id
+
+    def get_time_window(db, connection, plan_id):
+        """
+        :return: the plan's (start_time, end_time). A plan without a start or end time extends to its earliest or latest activity.
+        """
+        start_time, end_time = db.get_live_plan(connection, plan_id)[:2]
+        if start_time is None or end_time is None:
+            earliest, latest = connection.execute(
+                "SELECT MIN(start_time), MAX(start_time) FROM activities WHERE plan_id = ?", (plan_id,)
+            ).fetchone()
+            start_time = earliest if start_time is None else start_time
+            end_time = latest if end_time is None else end_time
+        return start_time, end_time
+
+    def is_temporal_subset(db, connection, plan_id, other_plan_id):
+        """
+        :return: whether the plan's time window is within the other plan's start and end times
+        """
+        other_start_time, other_end_time = db.get_live_plan(connection, other_plan_id)[:2]
+        if other_start_time is None and other_end_time is None:
+            return True
+        start_time, end_time = db.get_time_window(connection, plan_id)
+        if other_start_time is not None and start_time is not None and start_time < other_start_time:
+            return False
+        if other_end_time is not None and end_time is not None and end_time > other_end_time:
+            return False
+        return True
+
+    def get_merge_base(db, connection, plan_id_1, plan_id_2):
+        """
+        :return: the common ancestor of the two plans' latest snapshots with the highest generation (and the most recent
+                 of those), which is not in the history of any other common ancestor, or None if the plans are unrelated
+        """
+        row = connection.execute("""
+            WITH RECURSIVE
+                history_1 (id) AS (
+                    SELECT snapshot_id FROM plan_latest_snapshots WHERE plan_id = ?1
+                    UNION
+                    SELECT previous_snapshot_id FROM plan_snapshot_parent JOIN history_1 ON snapshot_id = history_1.id
+                ),
+                history_2 (id) AS (
+                    SELECT snapshot_id FROM plan_latest_snapshots WHERE plan_id = ?2
+                    UNION
+                    SELECT previous_snapshot_id FROM plan_snapshot_parent JOIN history_2 ON snapshot_id = history_2.id
+                )
+            SELECT plan_snapshot.id FROM history_1
+            JOIN history_2 ON history_2.id = history_1.id
+            JOIN plan_snapshot ON plan_snapshot.id = history_1.id
+            ORDER BY plan_snapshot.generation DESC, plan_snapshot.id DESC
+            LIMIT 1
+        """, (plan_id_1, plan_id_2)).fetchone()
+        return None if row is None else row[0]
+
+    def diff(db, connection, activities, key, snapshot_id, window):
+        """
+        Diffs the activities of a plan or snapshot against a snapshot
+        :param activities: PLAN_ACTIVITIES or SNAPSHOT_ACTIVITIES
+        :param key: the id of the plan or snapshot
+        :param window: (start_time, end_time) of the plan's window: activities outside it are not deleted, just left out
+        :return: (added, modified, deleted), where modified is a list of (activity, snapshot activity) pairs
+        """
+        table, key_column = activities
+        added = [Activity(*row) for row in connection.execute("""
+            SELECT a.activity_id, a.type, a.start_time, a.args FROM %s a
+            WHERE a.%s = ? AND NOT EXISTS (
+                SELECT 1 FROM plan_snapshot_activities b WHERE b.snapshot_id = ? AND b.activity_id = a.activity_id
+            )
+            ORDER BY a.activity_id
+        """ % (table, key_column), (key, snapshot_id))]
+        modified = [(Activity(*row[:4]), Activity(*row[4:])) for row in connection.execute("""
+            SELECT a.activity_id, a.type, a.start_time, a.args, b.activity_id, b.type, b.start_time, b.args FROM %s a
+            JOIN plan_snapshot_activities b ON b.snapshot_id = ? AND b.activity_id = a.activity_id
+            WHERE a.%s = ? AND NOT (%s)
+            ORDER BY a.activity_id
+        """ % (table, key_column, same_content("a", "b")), (snapshot_id, key))]
+        deleted = [Activity(*row) for row in connection.execute("""
+            SELECT b.activity_id, b.type, b.start_time, b.args FROM plan_snapshot_activities b
+            WHERE b.snapshot_id = ?1 AND NOT EXISTS (
+                SELECT 1 FROM %s a WHERE a.%s = ?2 AND a.activity_id = b.activity_id
+            ) AND (?3 IS NULL OR b.start_time >= ?3) AND (?4 IS NULL OR b.start_time <= ?4)
+            ORDER BY b.activity_id
+        """ % (table, key_column), (snapshot_id, key, *window))]
+        return added, modified, deleted
+
+    def diff_plan_against_snapshot(db, plan_id, snapshot_id):
+        with db.pool.reading() as connection:
+            window = db.get_live_plan(connection, plan_id)[2:4]
+            return db.diff(connection, PLAN_ACTIVITIES, plan_id, snapshot_id, window)
+
+    def request_merge(db, plan_supplying_changes, plan_receiving_changes):
+        if plan_receiving_changes == plan_supplying_changes:
+            raise Exception("Cannot merge a plan into itself")
+        with db.pool.writing() as connection:
+            db.get_live_plan(connection, plan_supplying_changes)
+            db.get_live_plan(connection, plan_receiving_changes)
+            if not db.is_temporal_subset(connection, plan_supplying_changes, plan_receiving_changes):
+                raise Exception("Plan supplying changes must be a temporal subset of the plan receiving changes")
+            merge_base_id = db.get_merge_base(connection, plan_supplying_changes, plan_receiving_changes)
+            if merge_base_id is None:
+                raise Exception("No merge base found")
+
+            snapshot_id = db.snapshot(connection, plan_supplying_changes)
+            supplier_start, supplier_end = db.get_live_plan(connection, plan_supplying_changes)[2:4]
+            if not connection.execute(
+                "SELECT EXISTS (SELECT 1 FROM %s WHERE %s IS NOT NULL)" % (SUPPLIER_CHANGES, SUPPLIER_CHANGE),
+                {"snapshot_id": snapshot_id, "merge_base_id": merge_base_id, "supplier_start": supplier_start, "supplier_end": supplier_end}
+            ).fetchone()[0]:
+                # Rolls back the snapshot
+                raise Exception("Cannot request merge with empty changeset")
+            return connection.execute("""
+                INSERT INTO merge_request (state, plan_supplying_changes, plan_receiving_changes, plan_supplying_changes_snapshot, merge_base_id)
+                VALUES ('REQUESTED', ?, ?, ?, ?)
+            """, (plan_supplying_changes, plan_receiving_changes, snapshot_id, merge_base_id)).lastrowid
+
+    def get_merge_request(db, connection, merge_id):
+        """
+        :return: the merge request's (state, plan_supplying_changes, plan_receiving_changes, plan_supplying_changes_snapshot, merge_base_id)
+        """
+        merge_request = connection.execute("""
+            SELECT state, plan_supplying_changes, plan_receiving_changes, plan_supplying_changes_snapshot, merge_base_id
+            FROM merge_request WHERE id = ?
+        """, (merge_id,)).fetchone()
+        if merge_request is None:
+            raise Exception("No merge request %s" % merge_id)
+        return merge_request
+
+    def begin_merge(db, merge_request_id):
+        """
+        Classifies every change of the supplier's snapshot against the receiver and the merge base with one statement
+        (see MERGE_CHANGES), which stores the merge's changes and conflicts without bringing them into Python, and
+        locks the receiver until the merge is committed or aborted
+        :return: the number of conflicts, which are left in the database: stream them with iter_conflicts,
+                 or page through them with get_conflicts
+        """
+        with db.pool.writing() as connection:
+            state, plan_supplying_changes, plan_receiving_changes, snapshot_id, merge_base_id = db.get_merge_request(connection, merge_request_id)
+            if state != "REQUESTED":
+                raise Exception("Cannot begin a merge in state " + state)
+            supplier_start, supplier_end = db.get_live_plan(connection, plan_supplying_changes)[2:4]
+            receiver_start, receiver_end = db.get_writable_plan(connection, plan_receiving_changes)[2:4]
+            connection.execute(MERGE_CHANGES, {
+                "merge_id": merge_request_id,
+                "snapshot_id": snapshot_id,
+                "merge_base_id": merge_base_id,
+                "plan_receiving_changes": plan_receiving_changes,
+                "supplier_start": supplier_start,
+                "supplier_end": supplier_end,
+                "receiver_start": receiver_start,
+                "receiver_end": receiver_end,
+            })
+            connection.execute("UPDATE merge_request SET state = 'INPROGRESS' WHERE id = ?", (merge_request_id,))
+            connection.execute("UPDATE plans SET merge_id = ? WHERE id = ?", (merge_request_id, plan_receiving_changes))
+            return connection.execute(
+                "SELECT COUNT(*) FROM merge_request_change WHERE merge_id = ? AND conflict_index IS NOT NULL", (merge_request_id,)
+            ).fetchone()[0]
+
+    def conflicts(db, connection, merge_id):
+        """
+        :return: an iterator of the merge's conflicts, as (activity_id, supplier's version or "DELETE", receiver's version
+                 or "DELETE"), which fetches them from the connection as it goes
+        """
+        rows = connection.execute(CONFLICT_VERSIONS + "WHERE c.merge_id = ? AND c.conflict_index IS NOT NULL ORDER BY c.conflict_index", (merge_id,))
+        return map(conflict_versions, rows)
+
+    def iter_conflicts(db, merge_id):
+        """
+        Streams the conflicts of an in-progress merge, holding a reader connection until the iterator is exhausted or closed
+        :return: an iterator of the conflicts, like conflicts()
+        """
+        with db.pool.reading() as connection:
+            yield from db.conflicts(connection, merge_id)
+
+    def get_conflicts(db, merge_id, offset=0, limit=None, type=None, start_time=None, end_time=None):
+        """
+        Pages through the conflicts of an in-progress merge, in order, without reading their activity versions
+        :param offset: the number of matching conflicts to skip, e.g. the number already shown
+        :param type: only the conflicts on activities of this type
+        :param start_time, end_time: only the conflicts where either side's version starts between these times
+                                     (inclusive, and unbounded if None)
+        :return: a list of at most limit Conflicts
+        """
+        with db.pool.reading() as connection:
+            state = db.get_merge_request(connection, merge_id)[0]
+            if state != "INPROGRESS":
+                raise Exception("Cannot list conflicts of a merge in state " + state)
+            return [Conflict(*row) for row in connection.execute(CONFLICT_PAGE, {
+                "merge_id": merge_id,
+                "offset": offset,
+                "limit": -1 if limit is None else limit,
+                "type": type,
+                "start_time": start_time,
+                "end_time": end_time,
+            })]
+
+    def get_conflict(db, merge_id, conflict_index):
+        """
+        :return: the conflict's (activity_id, supplier's version or "DELETE", receiver's version or "DELETE"), like iter_conflicts
+        """
+        with db.pool.reading() as connection:
+            row = connection.execute(CONFLICT_VERSIONS + "WHERE c.merge_id = ? AND c.conflict_index = ?", (merge_id, conflict_index)).fetchone()
+        if row is None:
+            raise Exception("Invalid conflict index: " + repr(conflict_index))
+        return conflict_versions(row)
+
+    def resolve_conflict(db, merge_id, conflict_index, resolution):
+        """
+        Resolution is either "CHANGE_SUPPLIER" or "CHANGE_RECEIVER"
+        """
+        db.resolve_conflicts_bulk(merge_id, [(conflict_index, resolution)])
+
+    def resolve_conflicts_bulk(db, merge_id, resolutions):
+        """
+        :param resolutions: either "CHANGE_SUPPLIER" or "CHANGE_RECEIVER", to resolve every conflict that way,
+                            or a list of (conflict_index, resolution) pairs
+        """
+        with db.pool.writing() as connection:
+            state = db.get_merge_request(connection, merge_id)[0]
+            if state != "INPROGRESS":
+                raise Exception("Cannot resolve conflicts of a merge in state " + state)
+            if isinstance(resolutions, str):
+                if resolutions not in ("CHANGE_SUPPLIER", "CHANGE_RECEIVER"):
+                    raise Exception("Invalid resolution: " + repr(resolutions))
+                connection.execute("UPDATE merge_request_change SET resolution = ? WHERE merge_id = ? AND conflict_index IS NOT NULL", (resolutions, merge_id))
+                return
+            conflict_count, = connection.execute(
+                "SELECT COUNT(*) FROM merge_request_change WHERE merge_id = ? AND conflict_index IS NOT NULL", (merge_id,)
+            ).fetchone()
+            resolutions = list(resolutions)
+            for conflict_index, resolution in resolutions:
+                if resolution not in ("CHANGE_SUPPLIER", "CHANGE_RECEIVER"):
+                    raise Exception("Invalid resolution: " + repr(resolution))
+                if not 0 <= conflict_index < conflict_count:
+                    raise Exception("Invalid conflict index: " + repr(conflict_index))
+            connection.executemany(
+                "UPDATE merge_request_change SET resolution = ? WHERE merge_id = ? AND conflict_index = ?",
+                [(resolution, merge_id, conflict_index) for conflict_index, resolution in resolutions]
+            )
+
+    def get_merge_status(db, merge_id):
+        with db.pool.reading() as connection:
+            return db.get_merge_request(connection, merge_id)[0]
+
+    def commit_merge(db, merge_id):
+        """
+        Applies the non-conflicting changes, and the conflicts resolved in favor of the supplier, to the receiver
+        with one statement per kind of change, copying activity versions from the supplier's snapshot
+        """
+        with db.pool.writing() as connection:
+            state, plan_supplying_changes, plan_receiving_changes, snapshot_id, _ = db.get_merge_request(connection, merge_id)
+            if state != "INPROGRESS":
+                raise Exception("Cannot commit a merge in state " + state)
+            if connection.execute(
+                "SELECT 1 FROM merge_request_change WHERE merge_id = ? AND conflict_index IS NOT NULL AND resolution IS NULL LIMIT 1", (merge_id,)
+            ).fetchone():
+                raise Exception("Merge cannot be committed until all conflicts are resolved")
+
+            connection.execute("""
+                INSERT INTO activities (plan_id, activity_id, type, start_time, args)
+                SELECT ?1, s.activity_id, s.type, s.start_time, s.args FROM plan_snapshot_activities s
+                WHERE s.snapshot_id = ?2 AND s.activity_id IN (
+                    SELECT activity_id FROM merge_request_change
+                    WHERE merge_id = ?3 AND (change_type != 'CONFLICT' OR resolution = 'CHANGE_SUPPLIER') AND supplier_change != 'DELETE'
+                )
+                ON CONFLICT (plan_id, activity_id) DO UPDATE SET type = excluded.type, start_time = excluded.start_time, args = excluded.args
+            """, (plan_receiving_changes, snapshot_id, merge_id))
+            connection.execute("""
+                DELETE FROM activities WHERE plan_id = ?1 AND activity_id IN (
+                    SELECT activity_id FROM merge_request_change
+                    WHERE merge_id = ?2 AND (change_type != 'CONFLICT' OR resolution = 'CHANGE_SUPPLIER') AND supplier_change = 'DELETE'
+                )
+            """, (plan_receiving_changes, merge_id))
+
+            connection.execute("UPDATE merge_request SET state = 'COMMITTED' WHERE id = ?", (merge_id,))
+            connection.execute("UPDATE plans SET merge_id = NULL WHERE id = ?", (plan_receiving_changes,))
+
+            # Include the pre-merge snapshot of the plan_supplying_changes in the history of both plans going forward
+            connection.execute("DELETE FROM plan_latest_snapshots WHERE plan_id = ?", (plan_supplying_changes,))
+            connection.executemany(
+                "INSERT OR IGNORE INTO plan_latest_snapshots (plan_id, snapshot_id) VALUES (?, ?)",
+                [(plan_supplying_changes, snapshot_id), (plan_receiving_changes, snapshot_id)]
+            )
+
+    def abort_merge(db, merge_id):
+        """
+        Marks the merge as "ABORTED" (which unlocks the plan_receiving_changes for modification)
+        """
+        with db.pool.writing() as connection:
+            connection.execute("UPDATE merge_request SET state = 'ABORTED' WHERE id = ?", (merge_id,))
+            connection.execute("UPDATE plans SET merge_id = NULL WHERE merge_id = ?", (merge_id,))
+
+    def delete(db, plan_id):
+        """
+        Marks the plan as deleted, and deletes its activities. Its snapshots are kept, since they may be
+        in the history of other plans.
+        """
+        with db.pool.writing() as connection:
+            db.get_live_plan(connection, plan_id)
+            if connection.execute("""
+                SELECT 1 FROM merge_request WHERE state = 'INPROGRESS' AND (plan_supplying_changes = ?1 OR plan_receiving_changes = ?1) LIMIT 1
+            """, (plan_id,)).fetchone():
+                raise Exception("Cannot delete a plan involved in an in-progress merge")
+            connection.execute("UPDATE plans SET deleted = 1 WHERE id = ?", (plan_id,))
+            connection.execute("DELETE FROM activities WHERE plan_id = ?", (plan_id,))
+
+    def get_activity_type(db, plan_id, activity_id):
+        with db.pool.reading() as connection:
+            return db.get_activity(connection, plan_id, activity_id).type
+
+    def get_activity_start_time(db, plan_id, activity_id):
+        with db.pool.reading() as connection:
+            return db.get_activity(connection, plan_id, activity_id).start_time
+
+    def get_activity_args(db, plan_id, activity_id):
+        with db.pool.reading() as connection:
+            return db.get_activity(connection, plan_id, activity_id).args
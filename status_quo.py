@@ -1,10 +1,14 @@
 import interface
 
 class Plan:
+    __slots__ = ("id",)
+
     def __init__(self, id):
         self.id = id
 
 class Activity:
+    __slots__ = ("plan_id", "activity_id", "type", "start_time", "args")
+
     def __init__(self, plan_id, activity_id, type, start_time, args):
         self.plan_id = plan_id
         self.activity_id = activity_id
@@ -0,0 +1,114 @@
+"""
+In-memory tables with a primary key and secondary indexes.
+
+A table behaves like the lists it replaces (iteration, len, positional indexing),
+but point lookups by primary key are O(1), and lookups by an indexed attribute
+only visit the rows that share that attribute's value.
+
+Indexed attributes (including the primary key attributes) must not be modified
+in place on a row that is in a table - remove the row and insert a new one instead.
+"""
+
+
+class Table:
+    def __init__(self, primary_key, indexes=()):
+        """
+        :param primary_key: attribute name, or tuple of attribute names, that identifies a row
+        :param indexes: names of attributes to maintain secondary indexes on
+        """
+        self.primary_key = primary_key if isinstance(primary_key, tuple) else (primary_key,)
+        self.rows = {}
+        self.indexes = {attribute_name: {} for attribute_name in indexes}
+
+    def key(self, row):
+        if len(self.primary_key) == 1:
+            return getattr(row, self.primary_key[0])
+        return tuple(getattr(row, attribute_name) for attribute_name in self.primary_key)
+
+    def insert(self, row):
+        """
+        Adds a row to the table
+        :raises Exception: if a row with the same primary key already exists
+        """
+        key = self.key(row)
+        if key in self.rows:
+            raise Exception("Uniqueness constraint violation: " + repr(key))
+        self._insert(key, row)
+
+    def insert_many(self, rows):
+        """
+        Adds all the given rows, or none of them if any of them would violate the uniqueness constraint
+        """
+        keyed_rows = [(self.key(row), row) for row in rows]
+        new_keys = set()
+        for key, _ in keyed_rows:
+            if key in self.rows or key in new_keys:
+                raise Exception("Uniqueness constraint violation: " + repr(key))
+            new_keys.add(key)
+        for key, row in keyed_rows:
+            self._insert(key, row)
+
+    def _insert(self, key, row):
+        self.rows[key] = row
+        for attribute_name, index in self.indexes.items():
+            index.setdefault(getattr(row, attribute_name), {})[key] = row
+
+    def replace(self, row):
+        """
+        Replaces the row that has the same primary key and indexed attributes as the given row. Readers see
+        either the old row or the new one, never neither.
+        """
+        key = self.key(row)
+        if key not in self.rows:
+            raise Exception("No row to replace: " + repr(key))
+        self.rows[key] = row
+        for attribute_name, index in self.indexes.items():
+            index[getattr(row, attribute_name)][key] = row
+
+    def remove(self, row):
+        key = self.key(row)
+        del self.rows[key]
+        for attribute_name, index in self.indexes.items():
+            value = getattr(row, attribute_name)
+            bucket = index[value]
+            del bucket[key]
+            if not bucket:
+                del index[value]
+
+    def get(self, key, default=None):
+        """
+        :return: the row with the given primary key, or default if there is no such row
+        """
+        return self.rows.get(key, default)
+
+    def get_one(self, **attributes):
+        all = list(self.get_all(**attributes))
+        assert len(all) == 1
+        return all[0]
+
+    def get_all(self, **attributes):
+        if attributes and set(attributes) == set(self.primary_key):
+            key = tuple(attributes[attribute_name] for attribute_name in self.primary_key)
+            row = self.rows.get(key[0] if len(key) == 1 else key)
+            candidates = [] if row is None else [row]
+        else:
+            candidates = self.rows.values()
+            for attribute_name in attributes:
+                if attribute_name in self.indexes:
+                    candidates = self.indexes[attribute_name].get(attributes[attribute_name], {}).values()
+                    break
+        for x in list(candidates):
+            for attribute_name, attribute_value in attributes.items():
+                if getattr(x, attribute_name) != attribute_value:
+                    break
+            else:
+                yield x
+
+    def __iter__(self):
+        return iter(self.rows.values())
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return list(self.rows.values())[index]
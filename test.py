@@ -1,6 +1,20 @@
+import os
+import sys
+import threading
+import time
+import types
+
 import pytest
 
+import bench
+import event_log
+import event_store
+import frozen
+import interface
+import merkle
 import snapshots
+import sqlite_snapshots
+from tables import Table
 
 aerie = snapshots.PlanCollaborationInterface()
 
@@ -393,8 +407,140 @@ def test_receiver_deleted_supplier_modified_back_to_same():
 # Can a user rescind a merge request/update it with
 # another one/just generally update it based on feedback?
 
-# TODO test plan locking
-# TODO test staging plan
+def test_staging_plan():
+    plan_a = aerie.make_fresh_plan()
+    activity_1 = aerie.add_activity(plan_a, start_time=1, args={})
+    activity_2 = aerie.add_activity(plan_a, start_time=2, args={})
+    plan_b = aerie.duplicate(plan_a)
+    aerie.modify_activity(plan_b, activity_1, 1, {"x": "b"})
+    aerie.modify_activity(plan_a, activity_1, 1, {"x": "a"})
+    aerie.delete_activity(plan_b, activity_2)
+    activity_3 = aerie.add_activity(plan_b, start_time=3, args={})
+
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    aerie.begin_merge(merge_id)
+    staging_plan = aerie.merge_requests.get(merge_id).staging_plan_id
+    # The receiver plus the non-conflicting changes, with the receiver's version of the conflicting activity
+    assert aerie.get_activity_ids(staging_plan) == [activity_1, activity_3]
+    assert aerie.get_activity_args(staging_plan, activity_1) == {"x": "a"}
+    assert aerie.get_activity_ids(plan_a) == [activity_1, activity_2]
+    assert aerie.get_activity_ids_in_range(staging_plan, 2, 3) == [activity_3]
+    with pytest.raises(Exception, match="locked by in-progress merge"):
+        aerie.add_activity(staging_plan, start_time=0, args={})
+    with pytest.raises(Exception, match="Cannot duplicate the staging plan"):
+        aerie.duplicate(staging_plan)
+
+    aerie.resolve_conflict(merge_id, 0, "CHANGE_SUPPLIER")
+    assert aerie.get_activity_args(staging_plan, activity_1) == {"x": "b"}
+    assert aerie.get_activity_args(plan_a, activity_1) == {"x": "a"}
+    aerie.resolve_conflict(merge_id, 0, "CHANGE_RECEIVER")
+    assert aerie.get_activity_args(staging_plan, activity_1) == {"x": "a"}
+    aerie.resolve_conflict(merge_id, 0, "CHANGE_SUPPLIER")
+
+    aerie.commit_merge(merge_id)
+    assert aerie.get_activity_ids(plan_a) == [activity_1, activity_3]
+    assert aerie.get_activity_args(plan_a, activity_1) == {"x": "b"}
+    assert aerie.plans.get(staging_plan).deleted
+
+    plan_c = aerie.duplicate(plan_a)
+    aerie.add_activity(plan_c, start_time=4, args={})
+    merge_id = aerie.request_merge(plan_c, plan_a)
+    aerie.begin_merge(merge_id)
+    staging_plan = aerie.merge_requests.get(merge_id).staging_plan_id
+    aerie.abort_merge(merge_id)
+    assert aerie.plans.get(staging_plan).deleted
+    assert aerie.get_activity_ids(plan_a) == [activity_1, activity_3]
+
+def test_get_conflicts():
+    plan_a = aerie.make_fresh_plan()
+    activity_ids = [aerie.add_activity(plan_a, "Even" if i % 2 == 0 else "Odd", start_time=i, args={}) for i in range(10)]
+    plan_b = aerie.duplicate(plan_a)
+    for activity_id in activity_ids:
+        aerie.modify_activity(plan_b, activity_id, aerie.get_activity_start_time(plan_b, activity_id), {"x": "b"})
+        aerie.modify_activity(plan_a, activity_id, aerie.get_activity_start_time(plan_a, activity_id), {"x": "a"})
+    aerie.delete_activity(plan_a, activity_ids[9])
+
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    aerie.begin_merge(merge_id)
+    page = aerie.get_conflicts(merge_id, offset=2, limit=3)
+    assert [conflict.activity_id for conflict in page] == activity_ids[2:5]
+    assert [conflict.activity_id for conflict in aerie.get_conflicts(merge_id, type="Odd", start_time=4)] == activity_ids[5:10:2]
+    last = aerie.get_conflicts(merge_id, offset=9)[0]
+    assert (last.supplier_change, last.receiver_change, last.receiver_plan_id, last.resolution) == ("MODIFY", "DELETE", plan_a, None)
+
+    aerie.resolve_conflict(merge_id, last.conflict_index, "CHANGE_SUPPLIER")
+    assert aerie.get_conflicts(merge_id, offset=9)[0].resolution == "CHANGE_SUPPLIER"
+    activity_id, supplier, receiver = aerie.get_conflict(merge_id, last.conflict_index)
+    assert activity_id == activity_ids[9] and supplier.args == {"x": "b"} and receiver == "DELETE"
+    aerie.abort_merge(merge_id)
+    with pytest.raises(Exception, match="Cannot list conflicts"):
+        aerie.get_conflicts(merge_id)
+
+
+def test_plan_locking():
+    plan_a = aerie.make_fresh_plan()
+    activity_1 = aerie.add_activity(plan_a, start_time=1, args={})
+    plan_b = aerie.duplicate(plan_a)
+    aerie.modify_activity(plan_b, activity_1, 2, {})
+
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    aerie.begin_merge(merge_id)
+    with pytest.raises(Exception, match="locked by in-progress merge"):
+        aerie.add_activity(plan_a, start_time=1, args={})
+    with pytest.raises(Exception, match="locked by in-progress merge"):
+        aerie.modify_activity(plan_a, activity_1, 3, {})
+    with pytest.raises(Exception, match="locked by in-progress merge"):
+        aerie.delete_activity(plan_a, activity_1)
+    with pytest.raises(Exception, match="Cannot begin a merge"):
+        aerie.begin_merge(merge_id)
+    aerie.modify_activity(plan_b, activity_1, 4, {})  # the supplier is not locked
+    aerie.abort_merge(merge_id)
+    aerie.modify_activity(plan_a, activity_1, 3, {})
+
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    aerie.begin_merge(merge_id)
+    aerie.resolve_conflicts_bulk(merge_id, "CHANGE_SUPPLIER")
+    aerie.commit_merge(merge_id)
+    aerie.delete_activity(plan_a, activity_1)
+
+
+def test_concurrent_edits():
+    db = snapshots.PlanCollaborationInterface()
+    parent = db.make_fresh_plan()
+    for i in range(10):
+        db.add_activity(parent, start_time=i, args={"i": i})
+    plans = [db.duplicate(parent) for _ in range(4)]
+    errors = []
+
+    def edit(plan_id):
+        try:
+            for i in range(100):
+                activity_id = db.add_activity(plan_id, start_time=i, args={"plan": plan_id})
+                db.modify_activity(plan_id, activity_id, i + 1, {"plan": plan_id, "i": i})
+                if i % 10 == 0:
+                    db.make_snapshot(plan_id)
+                else:
+                    db.duplicate(parent)
+                db.collect_garbage(budget=10)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=edit, args=(plan_id,)) for plan_id in plans]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    activity_ids = set()
+    for plan_id in plans:
+        plan_activity_ids = db.get_activity_ids(plan_id)
+        assert len(plan_activity_ids) == 110
+        activity_ids.update(plan_activity_ids)
+    assert len(activity_ids) == 10 + 4 * 100
+    while not db.collect_garbage():
+        pass
+    assert sorted(db.get_activity_ids(parent)) == sorted(db.get_activity_ids(plans[0]))[:10]
 
 def test_modify_delete_supplier():
     plan_a = aerie.make_fresh_plan()
@@ -455,3 +601,1023 @@ def test_commit_twice():
     with pytest.raises(Exception) as excinfo:
         aerie.commit_merge(merge_id)
     assert excinfo.value.args[0] == "Cannot commit a merge in state COMMITTED"
+
+
+def test_table_indexes():
+    table = Table(("plan_id", "activity_id"), indexes=["plan_id"])
+    rows = [snapshots.Activity(plan_id, activity_id, "Type", 0, {}) for plan_id in range(3) for activity_id in range(3)]
+    for row in rows:
+        table.insert(row)
+    assert len(table) == 9
+    assert table.get_one(plan_id=1, activity_id=2) is rows[5]
+    assert list(table.get_all(plan_id=2)) == rows[6:]
+    assert list(table.get_all(activity_id=0)) == rows[0::3]
+    table.remove(rows[5])
+    assert not list(table.get_all(plan_id=1, activity_id=2))
+    assert list(table.get_all(plan_id=1)) == rows[3:5]
+
+
+def test_table_uniqueness():
+    table = Table(("plan_id", "activity_id"), indexes=["plan_id"])
+    table.insert(snapshots.Activity(0, 0, "Type", 0, {}))
+    with pytest.raises(Exception):
+        table.insert(snapshots.Activity(0, 0, "Type", 1, {}))
+    with pytest.raises(Exception):
+        table.insert_many([snapshots.Activity(0, 1, "Type", 0, {}), snapshots.Activity(0, 1, "Type", 0, {})])
+    assert len(table) == 1  # a failed batch inserts nothing
+    table.insert_many([snapshots.Activity(0, 1, "Type", 0, {}), snapshots.Activity(1, 1, "Type", 0, {})])
+    assert len(table) == 3
+
+
+def test_rows_have_no_instance_dict():
+    activity = snapshots.Activity(0, 0, "".join(["Ty", "pe"]), 0, {})
+    assert not hasattr(activity, "__dict__")
+    assert activity.type is snapshots.Activity(0, 1, "Type", 0, {}).type
+    assert repr(activity).startswith("{'plan_id': 0, 'activity_id': 0, 'type': 'Type', 'start_time': 0, 'args': {}")
+
+
+def test_frozen_args_exact_match():
+    args = frozen.freeze({"a": [1, {"b": 1.5}], "c": None})
+    assert args is frozen.freeze({"c": None, "a": [1, {"b": 1.5}]})
+    assert args == {"a": [1, {"b": 1.5}], "c": None}
+    assert args != {"a": [1.0, {"b": 1.5}], "c": None}
+    assert frozen.freeze([True]) is not frozen.freeze([1])
+    assert frozen.freeze([0.0]) != frozen.freeze([-0.0])
+    assert frozen.freeze({"a": []}) != frozen.freeze({"a": [None]})
+    with pytest.raises(Exception):
+        args["a"].append(2)
+
+    plan_a = aerie.make_fresh_plan()
+    activity_1 = aerie.add_activity(plan_a, start_time=0, args={"x": [1, 2]})
+    plan_b = aerie.duplicate(plan_a)
+    aerie.modify_activity(plan_a, activity_1, 1, {"x": [1, 2]})
+    aerie.modify_activity(plan_b, activity_1, 1, {"x": [1, 2]})
+    assert aerie.get_activity_args(plan_a, activity_1) is aerie.get_activity_args(plan_b, activity_1)
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    assert aerie.begin_merge(merge_id) == []  # identical modifications do not conflict
+
+
+def test_frozen_interning_across_threads():
+    results = []
+
+    def freeze_all():
+        results.append([frozen.freeze({"thread": i, "items": [i, str(i)]}) for i in range(500)])
+
+    threads = [threading.Thread(target=freeze_all) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(value is first for values in results for value, first in zip(values, results[0]))
+
+    hashes = {value.hash for value in results[0]}
+    del results[:]
+    frozen.freeze({"thread": -1})  # removes the dead values from the pool
+    assert not hashes & frozen.pool.keys()
+
+
+def test_field_level_merge():
+    base = frozen.freeze({"a": 1, "nested": {"x": 1, "y": [1]}, "gone": 0})
+    ours = frozen.freeze({"a": 2, "nested": {"x": 1, "y": [1]}})
+    theirs = frozen.freeze({"a": 1, "nested": {"x": 1, "y": [2]}, "gone": 0, "new": True})
+    assert frozen.three_way_merge(base, ours, theirs) is frozen.freeze({"a": 2, "nested": {"x": 1, "y": [2]}, "new": True})
+    assert frozen.three_way_merge(base, ours, frozen.freeze({"a": 3})) is frozen.CONFLICT
+    assert frozen.three_way_merge(1, 1.0, 1) == 1.0
+
+    plan_a = aerie.make_fresh_plan()
+    activity_1 = aerie.add_activity(plan_a, start_time=0, args={"x": 0, "y": 0})
+    activity_2 = aerie.add_activity(plan_a, start_time=0, args={"x": 0})
+    plan_b = aerie.duplicate(plan_a)
+    aerie.modify_activity(plan_b, activity_1, 0, {"x": 1, "y": 0})
+    aerie.modify_activity(plan_a, activity_1, 5, {"x": 0, "y": 2})
+    aerie.modify_activity(plan_b, activity_2, 0, {"x": 1})
+    aerie.modify_activity(plan_a, activity_2, 0, {"x": 2})
+
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    conflicts = aerie.begin_merge(merge_id)
+    # Only the edits to the same key conflict
+    assert [(activity_id, supplier.args, receiver.args) for activity_id, supplier, receiver in conflicts] == [(activity_2, {"x": 1}, {"x": 2})]
+    aerie.resolve_conflict(merge_id, 0, "CHANGE_RECEIVER")
+    aerie.commit_merge(merge_id)
+    assert aerie.get_activity_args(plan_a, activity_1) == {"x": 1, "y": 2}
+    assert aerie.get_activity_start_time(plan_a, activity_1) == 5
+
+
+def test_field_level_merge_of_snapshotted_receiver():
+    plan_a = aerie.make_fresh_plan()
+    activity_1 = aerie.add_activity(plan_a, start_time=0, args={"p": 0, "q": 0})
+    plan_b = aerie.duplicate(plan_a)
+    aerie.modify_activity(plan_b, activity_1, 0, {"p": 1, "q": 0})
+    aerie.modify_activity(plan_a, activity_1, 0, {"p": 0, "q": 1})
+    # The receiver's version now lives in its base snapshot rather than in its own rows
+    aerie.duplicate(plan_a)
+
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    assert aerie.begin_merge(merge_id) == []
+    aerie.commit_merge(merge_id)
+    assert aerie.get_activity_args(plan_a, activity_1) == {"p": 1, "q": 1}
+
+
+def test_duplicate_shares_activity_versions():
+    plan_a = aerie.make_fresh_plan()
+    activity_ids = [aerie.add_activity(plan_a, start_time=i, args={"i": i}) for i in range(5)]
+    plan_b = aerie.duplicate(plan_a)
+    assert not list(aerie.activities.get_all(plan_id=plan_b))
+    assert aerie.get_activity_ids(plan_b) == activity_ids
+
+    aerie.modify_activity(plan_b, activity_ids[0], 10, {"i": 10})
+    aerie.delete_activity(plan_b, activity_ids[1])
+    own_activities = list(aerie.activities.get_all(plan_id=plan_b))
+    assert [activity.activity_id for activity in own_activities if not isinstance(activity, snapshots.DeletedActivity)] == [activity_ids[0]]
+    assert aerie.get_activity_ids(plan_b) == [activity_ids[0]] + activity_ids[2:]
+    assert aerie.get_activity_ids(plan_a) == activity_ids
+    assert aerie.get_activity_start_time(plan_a, activity_ids[0]) == 0
+    assert aerie.get_activity_start_time(plan_b, activity_ids[0]) == 10
+    assert aerie.get_activity_args(plan_b, activity_ids[2]) is aerie.get_activity_args(plan_a, activity_ids[2])
+
+
+def test_snapshot_at_version():
+    db = snapshots.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    activity_1 = db.add_activity(plan_a, start_time=1, args={})
+    activity_2 = db.add_activity(plan_a, start_time=2, args={})
+    plan = db.plans.get(plan_a)
+    with plan.lock.read():
+        at = db.read_version(plan)
+
+    # Edits made after the version stamp are not seen by a reader at that version
+    db.modify_activity(plan_a, activity_1, 10, {"x": 1})
+    db.delete_activity(plan_a, activity_2)
+    activity_3 = db.add_activity(plan_a, start_time=3, args={})
+    assert sorted(db.get_plan_activities(plan_a, at)) == [activity_1, activity_2]
+    assert db.find_activity(plan_a, activity_1, at).start_time == 1
+    assert db.get_activity_ids(plan_a) == [activity_1, activity_3]
+
+    with plan.snapshot_lock:
+        snapshot_id = db.make_snapshot_at(at)
+        db.release_version(at)
+        with plan.lock.write():
+            db.rebase(plan, snapshot_id, at)
+    assert sorted(db.get_snapshot_activities(snapshot_id)) == [activity_1, activity_2]
+    assert db.get_snapshot_activity(snapshot_id, activity_1).start_time == 1
+    # The edits made meanwhile are kept on top of the snapshot
+    assert db.get_activity_ids(plan_a) == [activity_1, activity_3]
+    assert db.get_activity_start_time(plan_a, activity_1) == 10
+    added, _, deleted = db.diff_plan_against_snapshot(plan_a, snapshot_id)
+    assert [activity.activity_id for activity in added] == [activity_3]
+    assert [activity.activity_id for activity in deleted] == [activity_2]
+
+    # Without readers, replaced versions are dropped
+    db.modify_activity(plan_a, activity_1, 11, {})
+    assert db.activities.get((plan_a, activity_1)).previous is None
+    assert not db.readers and not db.pinned_snapshots
+
+
+def test_request_merge_unpins_merge_base_on_error(monkeypatch):
+    db = snapshots.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    db.add_activity(plan_a, start_time=0, args={})
+    plan_b = db.duplicate(plan_a)
+    db.add_activity(plan_b, start_time=1, args={})
+
+    def fail(*args):
+        raise Exception("Failed to diff")
+    monkeypatch.setattr(db, "diff_version_against_snapshot", fail)
+    with pytest.raises(Exception, match="Failed to diff"):
+        db.request_merge(plan_b, plan_a)
+    assert not db.pinned_snapshots
+
+
+def test_merge_with_colliding_digests(monkeypatch):
+    # Every version has the same digest, so only an exact comparison can tell them apart
+    monkeypatch.setattr(snapshots, "activity_digest", lambda activity: 0)
+    db = snapshots.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    activity_id = db.add_activity(plan_a, start_time=0, args={"a": 1})
+    plan_b = db.duplicate(plan_a)
+    db.modify_activity(plan_b, activity_id, 1, {"a": 1})
+    db.modify_activity(plan_a, activity_id, 2, {"a": 1})
+
+    merge_id = db.request_merge(plan_b, plan_a)
+    conflicts = db.begin_merge(merge_id)
+    assert [conflict[0] for conflict in conflicts] == [activity_id]
+
+
+def test_duplicate_while_editing():
+    db = snapshots.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    done = threading.Event()
+
+    def edit():
+        for i in range(300):
+            db.add_activity(plan_a, start_time=i, args={"i": i})
+        done.set()
+
+    thread = threading.Thread(target=edit)
+    thread.start()
+    children = []
+    while not done.is_set():
+        children.append(db.duplicate(plan_a))
+    thread.join()
+    children.append(db.duplicate(plan_a))
+
+    # Every child is a consistent copy of its parent: the activities added up to some point
+    for child in children:
+        start_times = sorted(db.get_activity_start_time(child, activity_id) for activity_id in db.get_activity_ids(child))
+        assert start_times == list(range(len(start_times)))
+    assert len(db.get_activity_ids(children[-1])) == 300
+
+
+def test_snapshot_checkpoints():
+    plan_a = aerie.make_fresh_plan()
+    activity_ids = [aerie.add_activity(plan_a, start_time=0, args={}) for _ in range(100)]
+    checkpoints = 0
+    for i in range(4 * snapshots.SNAPSHOT_MAX_DEPTH):
+        aerie.modify_activity(plan_a, activity_ids[i], i + 1, {})
+        snapshot_id = aerie.make_snapshot(plan_a)
+        snapshot = aerie.snapshots.get(snapshot_id)
+        assert snapshot.depth < snapshots.SNAPSHOT_MAX_DEPTH
+        assert snapshot.chain_rows <= snapshots.SNAPSHOT_CHECKPOINT_FRACTION * snapshot.size
+        rows = len(list(aerie.snapshot_activities.get_all(plan_snapshot_id=snapshot_id)))
+        if snapshot.base_snapshot_id is None:
+            checkpoints += 1
+            assert rows == 100
+        elif snapshot.depth == 1:
+            # A squashed chain of deltas, or the first delta after a checkpoint
+            assert rows == snapshot.chain_rows
+        else:
+            # Deltas only store what changed since the previous snapshot
+            assert rows == 1
+        assert aerie.get_snapshot_activity(snapshot_id, activity_ids[i]).start_time == i + 1
+        assert aerie.get_snapshot_activity(snapshot_id, activity_ids[-1]).start_time == 0
+    # The first snapshot, and one once the deltas add up to half the plan
+    assert checkpoints == 2
+    assert aerie.get_activity_start_time(plan_a, activity_ids[i]) == i + 1
+
+
+def test_snapshot_of_unchanged_plan_stores_nothing():
+    plan_a = aerie.make_fresh_plan()
+    for i in range(100):
+        aerie.add_activity(plan_a, start_time=i, args={})
+    aerie.make_snapshot(plan_a)
+    rows = len(aerie.snapshot_activities.rows)
+    children = [aerie.duplicate(plan_a) for _ in range(4 * snapshots.SNAPSHOT_MAX_DEPTH)]
+    assert len(aerie.snapshot_activities.rows) == rows
+    assert aerie.snapshots.get(aerie.plans.get(children[-1]).base_snapshot_id).depth <= 1
+    assert aerie.get_activity_ids(children[-1]) == aerie.get_activity_ids(plan_a)
+
+
+def test_changed_activities_diff_matches_full_diff():
+    import random
+    rng = random.Random(0)
+    plan_a = aerie.make_fresh_plan()
+    for i in range(20):
+        aerie.add_activity(plan_a, start_time=i, args={"i": i})
+    plan_b = aerie.duplicate(plan_a)
+    snapshot_id = aerie.plans.get(plan_b).base_snapshot_id
+    for i in range(50):
+        activity_ids = aerie.get_activity_ids(plan_b)
+        operation = rng.choice(["add", "modify", "modify_back", "delete"])
+        if operation == "add" or not activity_ids:
+            aerie.add_activity(plan_b, start_time=i, args={})
+        elif operation == "delete":
+            aerie.delete_activity(plan_b, rng.choice(activity_ids))
+        else:
+            activity_id = rng.choice(activity_ids)
+            start_time = aerie.get_activity_start_time(plan_b, activity_id)
+            aerie.modify_activity(plan_b, activity_id, start_time if operation == "modify_back" else i, {"i": i})
+
+        incremental_diff = aerie.diff_plan_against_snapshot(plan_b, snapshot_id)
+        plan = aerie.plans.get(plan_b)
+        snapshot_change_counters, plan.snapshot_change_counters = plan.snapshot_change_counters, {}
+        full_diff = aerie.diff_plan_against_snapshot(plan_b, snapshot_id)
+        plan.snapshot_change_counters = snapshot_change_counters
+        assert incremental_diff == full_diff
+
+
+def test_merkle_tree_diff():
+    import random
+    rng = random.Random(2)
+    empty = merkle.MerkleTree()
+    tree = empty
+    expected = {}
+    for key in rng.sample(range(5000), 500):
+        expected[key] = rng.getrandbits(64)
+        tree = tree.set(key, expected[key])
+    assert len(tree) == 500
+    assert all(tree.get(key) == value for key, value in expected.items())
+    assert tree.diff(empty) == empty.diff(tree) == sorted(expected)
+
+    changed = tree
+    for key in rng.sample(sorted(expected), 10):
+        changed = changed.set(key, None)
+    for key in rng.sample(sorted(expected), 10):
+        changed = changed.set(key, rng.getrandbits(64))
+    changed = changed.set(100000, 1)
+    expected_diff = [key for key in set(expected) | {100000} if changed.get(key) != tree.get(key)]
+    assert changed.diff(tree) == tree.diff(changed) == sorted(expected_diff)
+
+    # Setting every key back to its old value gives a tree with the same digest
+    for key in expected_diff:
+        changed = changed.set(key, tree.get(key))
+    assert changed.digest == tree.digest and not changed.diff(tree)
+
+
+def test_plan_digests():
+    import functools
+    import operator
+    import random
+    rng = random.Random(1)
+
+    def check(plan_id):
+        plan = aerie.plans.get(plan_id)
+        assert plan.digest == functools.reduce(operator.xor, (activity.digest for activity in aerie.get_plan_activities(plan_id).values()), 0)
+
+    plan_a = aerie.make_fresh_plan()
+    for i in range(10):
+        aerie.add_activity(plan_a, start_time=i, args={"i": i})
+    plan_b = aerie.duplicate(plan_a)
+    check(plan_b)
+    for i in range(40):
+        plan_id = rng.choice([plan_a, plan_b])
+        activity_ids = aerie.get_activity_ids(plan_id)
+        operation = rng.choice(["add", "modify", "delete", "snapshot"])
+        if operation == "add" or not activity_ids:
+            aerie.add_activity(plan_id, start_time=i, args={})
+        elif operation == "modify":
+            aerie.modify_activity(plan_id, rng.choice(activity_ids), i, {"i": i})
+        elif operation == "delete":
+            aerie.delete_activity(plan_id, rng.choice(activity_ids))
+        else:
+            aerie.make_snapshot(plan_id)
+        check(plan_id)
+
+    plan_c = aerie.duplicate(plan_a)
+    activity_id = aerie.get_activity_ids(plan_c)[0]
+    start_time = aerie.get_activity_start_time(plan_c, activity_id)
+    args = aerie.get_activity_args(plan_c, activity_id)
+    aerie.modify_activity(plan_c, activity_id, start_time + 1, {})
+    assert aerie.plans.get(plan_c).digest != aerie.plans.get(plan_a).digest
+    aerie.modify_activity(plan_c, activity_id, start_time, args)
+    assert aerie.plans.get(plan_c).digest == aerie.plans.get(plan_a).digest
+    with pytest.raises(Exception) as excinfo:
+        aerie.request_merge(plan_c, plan_a)
+    assert excinfo.value.args[0] == "Cannot request merge with empty changeset"
+
+
+def test_time_index():
+    import random
+    rng = random.Random(3)
+    plan_a = aerie.make_fresh_plan()
+    for i in range(30):
+        aerie.add_activity(plan_a, start_time=rng.randrange(100), args={})
+    plan_b = aerie.duplicate(plan_a)
+    assert aerie.plans.get(plan_b).time_index is None
+    assert aerie.get_activity_ids_in_range(plan_b, 20, 40) is not None
+    for i in range(60):
+        activity_ids = aerie.get_activity_ids(plan_b)
+        operation = rng.choice(["add", "modify", "delete", "snapshot"])
+        if operation == "add":
+            aerie.add_activity(plan_b, start_time=rng.randrange(100), args={})
+        elif operation == "modify":
+            aerie.modify_activity(plan_b, rng.choice(activity_ids), rng.randrange(100), {})
+        elif operation == "delete":
+            aerie.delete_activity(plan_b, rng.choice(activity_ids))
+        else:
+            aerie.make_snapshot(plan_b)
+        start_times = {activity_id: aerie.get_activity_start_time(plan_b, activity_id) for activity_id in aerie.get_activity_ids(plan_b)}
+        assert aerie.get_activity_ids_in_range(plan_b, 20, 40) == [
+            activity_id for activity_id in sorted(start_times, key=lambda activity_id: (start_times[activity_id], activity_id))
+            if 20 <= start_times[activity_id] <= 40
+        ]
+    assert aerie.get_time_window(plan_b) == (min(start_times.values()), max(start_times.values()))
+
+
+def test_temporal_subset():
+    plan_a = aerie.make_fresh_plan(0, 100)
+    plan_b = aerie.duplicate(plan_a)
+    activity_1 = aerie.add_activity(plan_b, start_time=50, args={})
+    plan_c = aerie.duplicate(plan_b)
+    aerie.plans.get(plan_c).end_time = None  # unbounded, so its activities bound it
+    aerie.modify_activity(plan_c, activity_1, 150, {})
+    with pytest.raises(Exception) as excinfo:
+        aerie.request_merge(plan_c, plan_b)
+    assert excinfo.value.args[0] == "Plan supplying changes must be a temporal subset of the plan receiving changes"
+    aerie.modify_activity(plan_c, activity_1, 60, {})
+    merge_id = aerie.request_merge(plan_c, plan_b)
+    aerie.begin_merge(merge_id)
+    aerie.commit_merge(merge_id)
+    assert aerie.get_activity_ids_in_range(plan_b, 55, 65) == [activity_1]
+
+
+def test_windowed_duplicate():
+    plan_a = aerie.make_fresh_plan()
+    activity_ids = [aerie.add_activity(plan_a, start_time=i, args={}) for i in range(100)]
+    plan_b = aerie.duplicate(plan_a, 10, 19)
+    assert aerie.get_activity_ids(plan_b) == activity_ids[10:20]
+    assert (aerie.plans.get(plan_b).start_time, aerie.plans.get(plan_b).end_time) == (10, 19)
+    plan_c = aerie.duplicate(plan_b, 15, None)
+    assert aerie.get_activity_ids(plan_c) == activity_ids[15:20]
+
+    aerie.modify_activity(plan_b, activity_ids[15], 16, {"modified": True})
+    aerie.delete_activity(plan_b, activity_ids[12])
+    activity_new = aerie.add_activity(plan_b, start_time=11, args={})
+    aerie.modify_activity(plan_a, activity_ids[50], 50, {"modified": True})
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    assert aerie.begin_merge(merge_id) == []
+    aerie.commit_merge(merge_id)
+
+    # Activities outside plan_b's window were left out of it, not deleted
+    assert aerie.get_activity_ids(plan_a) == activity_ids[:12] + activity_ids[13:] + [activity_new]
+    assert aerie.get_activity_args(plan_a, activity_ids[15]) == {"modified": True}
+    assert aerie.get_activity_args(plan_a, activity_ids[50]) == {"modified": True}
+    assert aerie.get_activity_ids(plan_b) == activity_ids[10:12] + activity_ids[13:20] + [activity_new]
+
+
+def test_merge_base_is_best_common_ancestor():
+    plan_a = aerie.make_fresh_plan()
+    aerie.add_activity(plan_a, start_time=0, args={})
+    plan_b = aerie.duplicate(plan_a)
+    first_snapshot = aerie.plans.get(plan_b).base_snapshot_id
+    plan_c = aerie.duplicate(plan_a)
+    second_snapshot = aerie.plans.get(plan_c).base_snapshot_id
+    # plan_a's history now contains both snapshots; the second one is newer and in plan_c's history
+    assert aerie.get_merge_base(aerie.plans.get(plan_a).latest_snapshots, aerie.plans.get(plan_c).latest_snapshots) == second_snapshot
+    assert aerie.get_merge_base(aerie.plans.get(plan_b).latest_snapshots, aerie.plans.get(plan_c).latest_snapshots) == first_snapshot
+    assert aerie.get_history_plan_id(plan_a) == [second_snapshot, first_snapshot]
+    plan_unrelated = aerie.duplicate(aerie.make_fresh_plan())
+    assert aerie.get_merge_base(aerie.plans.get(plan_b).latest_snapshots, aerie.plans.get(plan_unrelated).latest_snapshots) is None
+
+
+def test_resolve_conflicts_bulk():
+    plan_a = aerie.make_fresh_plan()
+    activity_ids = [aerie.add_activity(plan_a, start_time=0, args={}) for _ in range(4)]
+    plan_b = aerie.duplicate(plan_a)
+    for activity_id in activity_ids:
+        aerie.modify_activity(plan_a, activity_id, 1, {})
+        aerie.modify_activity(plan_b, activity_id, 2, {})
+
+    merge_id = aerie.request_merge(plan_b, plan_a)
+    conflicts = aerie.begin_merge(merge_id)
+    assert len(conflicts) == 4
+    aerie.resolve_conflicts_bulk(merge_id, "CHANGE_RECEIVER")
+    aerie.resolve_conflicts_bulk(merge_id, [(0, "CHANGE_SUPPLIER"), (3, "CHANGE_SUPPLIER")])
+    with pytest.raises(Exception):
+        aerie.resolve_conflicts_bulk(merge_id, [(1, "CHANGE_SUPPLIER"), (2, "CHANGE_NEITHER")])
+    aerie.commit_merge(merge_id)
+
+    supplier_wins = {conflicts[0][0], conflicts[3][0]}
+    for activity_id in activity_ids:
+        assert aerie.get_activity_start_time(plan_a, activity_id) == (2 if activity_id in supplier_wins else 1)
+        assert aerie.get_activity_start_time(plan_b, activity_id) == 2
+
+
+def test_garbage_collection():
+    db = snapshots.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    activity_ids = [db.add_activity(plan_a, start_time=i, args={}) for i in range(10)]
+    plan_b = db.duplicate(plan_a)
+    plan_c = db.duplicate(plan_b)
+    db.modify_activity(plan_c, activity_ids[0], 10, {})
+    merge_id = db.request_merge(plan_c, plan_b)
+    db.begin_merge(merge_id)
+    with pytest.raises(Exception):
+        db.delete(plan_c)
+    db.commit_merge(merge_id)
+    db.delete(plan_c)
+    with pytest.raises(Exception):
+        db.duplicate(plan_c)
+
+    # Interleave slices of a collection cycle with edits that store new references to snapshots
+    plan_d = None
+    finished = False
+    while not finished:
+        finished = db.collect_garbage(budget=3)
+        if plan_d is None:
+            plan_d = db.duplicate(plan_b)
+            db.modify_activity(plan_d, activity_ids[1], 20, {})
+    assert db.plans.get(plan_c) is None
+    assert not list(db.activities.get_all(plan_id=plan_c))
+    for read in (db.get_activity_ids, db.get_time_window):
+        with pytest.raises(Exception) as excinfo:
+            read(plan_c)
+        assert excinfo.value.args[0] == "Plan %s is deleted" % plan_c
+    for read in (db.get_activity_type, db.get_activity_start_time, db.get_activity_args):
+        with pytest.raises(Exception) as excinfo:
+            read(plan_c, activity_ids[0])
+        assert excinfo.value.args[0] == "Plan %s is deleted" % plan_c
+
+    merge_id = db.request_merge(plan_d, plan_a)
+    db.begin_merge(merge_id)
+    db.commit_merge(merge_id)
+    assert db.get_activity_start_time(plan_a, activity_ids[0]) == 10
+    assert db.get_activity_start_time(plan_a, activity_ids[1]) == 20
+
+    # Nothing is collected while every plan is live
+    snapshot_count = len(db.snapshots)
+    while not db.collect_garbage():
+        pass
+    assert len(db.snapshots) == snapshot_count
+
+    for plan_id in (plan_a, plan_b, plan_d):
+        db.delete(plan_id)
+    while not db.collect_garbage():
+        pass
+    assert not len(db.plans) and not len(db.snapshots) and not len(db.snapshot_activities) and not len(db.activities)
+
+
+def test_bench_smoke():
+    result = bench.run("snapshots", activities=20, depth=2, fan_out=2, edit_rate=0.5, conflict_rate=0.5, reads=2)
+    assert set(result["stages"].values()) == {"ok"}
+    assert result["merges"] == 6
+    assert result["conflicts"] > 0
+    assert result["operations"]["duplicate"]["count"] == 6
+
+
+def test_bench_skips_unsupported_designs(monkeypatch):
+    abstract_design = types.ModuleType("abstract_design")
+    abstract_design.PlanCollaborationInterface = interface.PlanCollaborationInterface
+    monkeypatch.setitem(sys.modules, "abstract_design", abstract_design)
+    assert bench.run("abstract_design")["skipped"].startswith("TypeError")
+
+    class NoDuplicates(snapshots.PlanCollaborationInterface):
+        def duplicate(db, parent_plan_id, start_time=None, end_time=None):
+            raise NotImplementedError("duplicate")
+
+    partial_design = types.ModuleType("partial_design")
+    partial_design.PlanCollaborationInterface = NoDuplicates
+    monkeypatch.setitem(sys.modules, "partial_design", partial_design)
+    result = bench.run("partial_design")
+    assert result["stages"] == {"build": "unsupported (NotImplementedError: duplicate)"}
+
+    class Broken(snapshots.PlanCollaborationInterface):
+        def duplicate(db, parent_plan_id, start_time=None, end_time=None):
+            raise AttributeError("bug")
+
+    broken_design = types.ModuleType("broken_design")
+    broken_design.PlanCollaborationInterface = Broken
+    monkeypatch.setitem(sys.modules, "broken_design", broken_design)
+    # Real crashes are not hidden as unsupported stages
+    with pytest.raises(AttributeError):
+        bench.run("broken_design")
+
+
+def test_sqlite_merge(tmp_path):
+    db = sqlite_snapshots.PlanCollaborationInterface(str(tmp_path / "plans.db"))
+    try:
+        plan_a = db.make_fresh_plan()
+        activity_1 = db.add_activity(plan_a, start_time=1, args={"x": 1})
+        activity_2 = db.add_activity(plan_a, start_time=2, args={})
+        activity_3 = db.add_activity(plan_a, start_time=3, args={})
+        plan_b = db.duplicate(plan_a)
+        assert db.get_activity_ids(plan_b) == [activity_1, activity_2, activity_3]
+
+        db.modify_activity(plan_b, activity_1, 1, {"x": 2})
+        db.delete_activity(plan_b, activity_2)
+        activity_4 = db.add_activity(plan_b, start_time=4, args={})
+        db.modify_activity(plan_a, activity_1, 1, {"x": 3})
+        db.modify_activity(plan_a, activity_3, 5, {})
+
+        merge_id = db.request_merge(plan_b, plan_a)
+        assert db.begin_merge(merge_id) == 1
+        conflicts = db.iter_conflicts(merge_id)
+        assert [(activity_id, supplier.args, receiver.args) for activity_id, supplier, receiver in conflicts] == [(activity_1, {"x": 2}, {"x": 3})]
+        with pytest.raises(Exception, match="locked by in-progress merge"):
+            db.add_activity(plan_a, start_time=1, args={})
+        with pytest.raises(Exception, match="until all conflicts are resolved"):
+            db.commit_merge(merge_id)
+        db.resolve_conflict(merge_id, 0, "CHANGE_SUPPLIER")
+        db.commit_merge(merge_id)
+        assert db.get_merge_status(merge_id) == "COMMITTED"
+        assert db.get_activity_ids(plan_a) == [activity_1, activity_3, activity_4]
+        assert db.get_activity_args(plan_a, activity_1) == {"x": 2}
+        assert db.get_activity_start_time(plan_a, activity_3) == 5
+
+        with pytest.raises(Exception) as excinfo:
+            db.request_merge(plan_b, plan_a)
+        assert excinfo.value.args[0] == "Cannot request merge with empty changeset"
+
+        plan_c = db.duplicate(plan_a, start_time=2, end_time=4)
+        assert db.get_activity_ids(plan_c) == [activity_4]
+        db.delete_activity(plan_c, activity_4)
+        merge_id = db.request_merge(plan_c, plan_a)
+        assert db.begin_merge(merge_id) == 0
+        db.commit_merge(merge_id)
+        # Activities outside the window are left untouched
+        assert db.get_activity_ids(plan_a) == [activity_1, activity_3]
+    finally:
+        db.close()
+
+
+def test_duplicate_of_windowed_plan(tmp_path):
+    sqlite_db = sqlite_snapshots.PlanCollaborationInterface(str(tmp_path / "plans.db"))
+    try:
+        for db in (aerie, sqlite_db):
+            plan_p = db.make_fresh_plan()
+            activity_1 = db.add_activity(plan_p, start_time=5, args={})
+            plan_c = db.duplicate(plan_p, 0, 10)
+            # Outside the window plan_c inherited, but its own
+            activity_2 = db.add_activity(plan_c, start_time=50, args={})
+            assert db.get_activity_ids(db.duplicate(plan_c)) == [activity_1, activity_2]
+            assert db.get_activity_ids(db.duplicate(plan_c, 0, 100)) == [activity_1, activity_2]
+    finally:
+        sqlite_db.close()
+
+
+def test_sqlite_conflict_shapes():
+    db = sqlite_snapshots.PlanCollaborationInterface()
+    try:
+        plan_a = db.make_fresh_plan()
+        activity_ids = [db.add_activity(plan_a, start_time=i, args={}) for i in range(5)]
+        plan_b = db.duplicate(plan_a)
+        db.modify_activity(plan_b, activity_ids[0], 0, {"b": 1})
+        db.modify_activity(plan_a, activity_ids[0], 0, {"a": 1})
+        db.modify_activity(plan_b, activity_ids[1], 1, {"b": 1})
+        db.delete_activity(plan_a, activity_ids[1])
+        db.delete_activity(plan_b, activity_ids[2])
+        db.modify_activity(plan_a, activity_ids[2], 2, {"a": 1})
+        # The same change on both sides is not a conflict
+        db.modify_activity(plan_b, activity_ids[3], 3, {"x": 1})
+        db.modify_activity(plan_a, activity_ids[3], 3, {"x": 1})
+        db.delete_activity(plan_b, activity_ids[4])
+        db.delete_activity(plan_a, activity_ids[4])
+
+        merge_id = db.request_merge(plan_b, plan_a)
+        assert db.begin_merge(merge_id) == 3
+        shapes = [
+            (activity_id, supplier if supplier == "DELETE" else supplier.args, receiver if receiver == "DELETE" else receiver.args)
+            for activity_id, supplier, receiver in db.iter_conflicts(merge_id)
+        ]
+        assert shapes == [(activity_ids[0], {"b": 1}, {"a": 1}), (activity_ids[1], {"b": 1}, "DELETE"), (activity_ids[2], "DELETE", {"a": 1})]
+        streamed = db.iter_conflicts(merge_id)
+        assert next(streamed)[0] == activity_ids[0]
+        streamed.close()
+        assert [conflict[0] for conflict in db.iter_conflicts(merge_id)] == activity_ids[:3]
+        page = db.get_conflicts(merge_id, offset=1, limit=1)
+        assert [(conflict.conflict_index, conflict.supplier_change, conflict.receiver_change) for conflict in page] == [(1, "MODIFY", "DELETE")]
+        assert [conflict.activity_id for conflict in db.get_conflicts(merge_id, start_time=2)] == [activity_ids[2]]
+        assert db.get_conflict(merge_id, 2)[1] == "DELETE"
+
+        db.resolve_conflicts_bulk(merge_id, "CHANGE_SUPPLIER")
+        db.commit_merge(merge_id)
+        assert db.get_activity_ids(plan_a) == [activity_ids[0], activity_ids[1], activity_ids[3]]
+        assert db.get_activity_args(plan_a, activity_ids[1]) == {"b": 1}
+    finally:
+        db.close()
+
+
+def test_sqlite_survives_restart(tmp_path):
+    path = str(tmp_path / "plans.db")
+    db = sqlite_snapshots.PlanCollaborationInterface(path)
+    plan_a = db.make_fresh_plan()
+    activity_1 = db.add_activity(plan_a, start_time=1, args={"x": [1, 2.0]})
+    plan_b = db.duplicate(plan_a)
+    db.close()
+
+    db = sqlite_snapshots.PlanCollaborationInterface(path)
+    try:
+        assert db.get_activity_args(plan_b, activity_1) == {"x": [1, 2.0]}
+        activity_2 = db.add_activity(plan_b, start_time=2, args={})
+        assert activity_2 != activity_1
+        merge_id = db.request_merge(plan_b, plan_a)
+        db.begin_merge(merge_id)
+        db.commit_merge(merge_id)
+        assert db.get_activity_ids(plan_a) == [activity_1, activity_2]
+    finally:
+        db.close()
+
+
+def test_sqlite_concurrent_readers():
+    db = sqlite_snapshots.PlanCollaborationInterface(readers=3)
+    try:
+        plan_a = db.make_fresh_plan()
+        done = threading.Event()
+        errors = []
+
+        def read():
+            try:
+                while not done.is_set():
+                    # Every read sees a whole number of duplicates' worth of activities
+                    assert len(db.get_activity_ids(plan_a)) % 10 == 0
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(3)]
+        for reader in readers:
+            reader.start()
+        for _ in range(20):
+            plan_b = db.duplicate(plan_a)
+            for i in range(10):
+                db.add_activity(plan_b, start_time=i, args={})
+            merge_id = db.request_merge(plan_b, plan_a)
+            db.begin_merge(merge_id)
+            db.commit_merge(merge_id)
+        done.set()
+        for reader in readers:
+            reader.join()
+        assert not errors
+        assert len(db.get_activity_ids(plan_a)) == 200
+    finally:
+        db.close()
+
+
+def test_event_log_projection():
+    db = event_log.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    activity_1 = db.add_activity(plan_a, start_time=1, args={"a": 1})
+    activity_2 = db.add_activity(plan_a, "Other", start_time=2, args={})
+    plan_b = db.duplicate(plan_a)
+    db.modify_activity(plan_b, activity_1, 3, {"a": 2})
+    db.delete_activity(plan_a, activity_2)
+
+    assert db.get_activity_ids(plan_a) == [activity_1]
+    assert db.get_activity_ids(plan_b) == [activity_1, activity_2]
+    assert db.get_activity_type(plan_b, activity_2) == "Other"
+    assert db.get_activity_start_time(plan_a, activity_1) == 1
+    assert db.get_activity_start_time(plan_b, activity_1) == 3
+    assert db.get_activity_args(plan_b, activity_1) == {"a": 2}
+
+
+def test_event_log_point_in_time_state():
+    db = event_log.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    plan_b = db.duplicate(plan_a)
+    activity_ids = []
+    states = {}
+    for i in range(3 * event_log.CHECKPOINT_INTERVAL):
+        plan_id = plan_a if i % 3 else plan_b
+        if i % 5 == 4:
+            db.delete_activity(plan_id, db.get_activity_ids(plan_id)[0])
+        elif i % 2 and activity_ids and activity_ids[-1] in db.get_activity_ids(plan_id):
+            db.modify_activity(plan_id, activity_ids[-1], i, {"i": i})
+        else:
+            activity_ids.append(db.add_activity(plan_id, start_time=i, args={}))
+        states[len(db.event_log) - 1] = {plan: {activity_id: dict(activity) for activity_id, activity in db.projections[plan].items()} for plan in (plan_a, plan_b)}
+
+    for event_id, expected in states.items():
+        assert db.get_plan_state_at(plan_a, event_id) == expected[plan_a]
+        assert db.get_plan_state_at(plan_b, event_id) == expected[plan_b]
+    assert db.get_plan_state_at(plan_b, 0) is None  # plan_b was created by event 1
+    # Only the latest checkpoint, and the events since, are kept in memory; the older ones are in the checkpoint store
+    assert len(db.plan_event_ids[plan_a]) <= event_log.CHECKPOINT_INTERVAL
+    assert db.plan_event_ids[plan_a][0] == db.checkpoints[plan_a][0] == db.checkpoint_ids[plan_a][-1]
+    assert len(db.checkpoint_store.checkpoints) == len(db.checkpoint_ids[plan_a]) + len(db.checkpoint_ids[plan_b]) - 2
+
+
+def test_event_log_historical_read_replays_from_nearest_checkpoint(tmp_path, monkeypatch):
+    for log in [None, event_store.SegmentedEventLog(str(tmp_path), segment_size=4096)]:
+        db = event_log.PlanCollaborationInterface(log)
+        plan_a = db.make_fresh_plan()
+        activity_ids = {}
+        for i in range(10 * event_log.CHECKPOINT_INTERVAL):
+            db.add_activity(plan_a, start_time=i, args={"i": i})
+            activity_ids[len(db.event_log) - 1] = db.get_activity_ids(plan_a)
+            if i % 2:
+                db.delete_activity(plan_a, db.get_activity_ids(plan_a)[0])
+                activity_ids[len(db.event_log) - 1] = db.get_activity_ids(plan_a)
+        assert len(db.checkpoint_ids[plan_a]) > 5
+
+        replayed = []
+        apply_payload = event_log.apply_payload
+        monkeypatch.setattr(event_log, "apply_payload", lambda state, payload: replayed.append(payload) or apply_payload(state, payload))
+        for event_id in [db.checkpoint_ids[plan_a][1] - 1, db.checkpoint_ids[plan_a][3] + 9, db.checkpoint_ids[plan_a][-2] - 1]:
+            del replayed[:]
+            state = db.get_plan_state_at(plan_a, event_id)
+            assert sorted(state) == activity_ids[event_id]
+            # Replayed from the nearest checkpoint before the event, not from the plan's creation
+            assert len(replayed) <= max(event_log.CHECKPOINT_INTERVAL, len(state))
+        monkeypatch.undo()
+        if log is not None:
+            log.close()
+
+
+def test_event_log_merge_base():
+    db = event_log.PlanCollaborationInterface()
+    plan_c = db.make_fresh_plan()
+    db.add_activity(plan_c, start_time=0, args={})
+    plan_a = db.duplicate(plan_c)
+    plan_b = db.duplicate(plan_c)
+    plan_d = db.duplicate(plan_b)
+    db.add_activity(plan_a, start_time=1, args={})
+
+    assert db.get_merge_base(plan_a, plan_d) == (db.creation_events[plan_a].event_id, plan_c)
+    assert db.get_merge_base(plan_d, plan_b) == (db.creation_events[plan_d].event_id, plan_b)
+    assert [event.payload["type"] for event in db.get_events_since(plan_c, -1)] == ["PLAN_CREATED", "ACTIVITY_CREATED"]
+    assert [event.event_id for event in db.get_events_since(plan_a, db.creation_events[plan_a].event_id)] == [len(db.event_log) - 1]
+    with pytest.raises(event_log.UnrelatedPlans):
+        db.get_merge_base(plan_a, db.make_fresh_plan())
+
+
+def test_event_log_merge():
+    db = event_log.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    activity_1 = db.add_activity(plan_a, start_time=1, args={"x": 0})
+    activity_2 = db.add_activity(plan_a, start_time=2, args={})
+    activity_3 = db.add_activity(plan_a, start_time=3, args={})
+    plan_b = db.duplicate(plan_a)
+    db.modify_activity(plan_a, activity_1, 1, {"x": 1})
+    db.modify_activity(plan_b, activity_1, 1, {"x": 2})  # modify - modify conflict
+    db.delete_activity(plan_b, activity_2)
+    db.delete_activity(plan_a, activity_3)
+    db.modify_activity(plan_b, activity_3, 30, {})  # modify - delete conflict
+    activity_4 = db.add_activity(plan_b, start_time=4, args={})
+
+    with pytest.raises(Exception) as excinfo:
+        db.request_merge(plan_a, plan_a)
+    assert excinfo.value.args[0] == "Cannot merge a plan into itself"
+    merge_id = db.request_merge(plan_b, plan_a)
+    assert db.get_merge_status(merge_id) == "REQUESTED"
+    conflicts = db.begin_merge(merge_id)
+    assert db.get_merge_status(merge_id) == "INPROGRESS"
+    assert conflicts == [
+        (activity_1, db.projections[plan_b][activity_1], db.projections[plan_a][activity_1]),
+        (activity_3, db.projections[plan_b][activity_3], "DELETE"),
+    ]
+    staging_plan = db.merge_requests[merge_id].staging_plan_id
+    assert db.get_activity_ids(staging_plan) == [activity_1, activity_4]
+    with pytest.raises(Exception) as excinfo:
+        db.add_activity(plan_a, start_time=0, args={})
+    assert excinfo.value.args[0] == "Plan %s is locked by in-progress merge %s" % (plan_a, merge_id)
+    with pytest.raises(Exception):
+        db.modify_activity(staging_plan, activity_1, 0, {})
+    with pytest.raises(Exception):
+        db.delete(plan_a)
+    with pytest.raises(Exception) as excinfo:
+        db.commit_merge(merge_id)
+    assert excinfo.value.args[0] == "Merge cannot be committed until all conflicts are resolved"
+
+    db.resolve_conflict(merge_id, 0, "CHANGE_RECEIVER")
+    db.resolve_conflict(merge_id, 1, "CHANGE_SUPPLIER")
+    assert db.get_activity_start_time(staging_plan, activity_3) == 30
+    db.commit_merge(merge_id)
+    assert db.get_merge_status(merge_id) == "COMMITTED"
+    assert sorted(db.get_activity_ids(plan_a)) == [activity_1, activity_3, activity_4]
+    assert db.get_activity_args(plan_a, activity_1) == {"x": 1}
+    assert db.get_activity_start_time(plan_a, activity_3) == 30
+    assert staging_plan in db.deleted_plans
+    db.add_activity(plan_a, start_time=0, args={})  # unlocked
+
+    plan_c = db.duplicate(plan_b)
+    db.delete_activity(plan_c, activity_4)
+    merge_id = db.request_merge(plan_c, plan_b)
+    assert db.begin_merge(merge_id) == []
+    db.abort_merge(merge_id)
+    assert db.get_merge_status(merge_id) == "ABORTED"
+    assert activity_4 in db.get_activity_ids(plan_b)
+    with pytest.raises(Exception) as excinfo:
+        db.commit_merge(merge_id)
+    assert excinfo.value.args[0] == "Cannot commit a merge in state ABORTED"
+
+    # The merge base is kept when the common ancestor's child on the way is compacted away
+    plan_d = db.duplicate(plan_c)
+    db.modify_activity(plan_d, activity_1, 5, {"x": 2})
+    db.delete(plan_c)
+    while not db.compact():
+        pass
+    merge_id = db.request_merge(plan_d, plan_b)
+    assert db.begin_merge(merge_id) == []
+    db.commit_merge(merge_id)
+    assert db.get_activity_start_time(plan_b, activity_1) == 5
+    assert activity_4 not in db.get_activity_ids(plan_b)
+
+
+def test_event_log_merge_base_moves_forward(tmp_path):
+    log = event_store.SegmentedEventLog(str(tmp_path))
+    db = event_log.PlanCollaborationInterface(log)
+    plan_a = db.make_fresh_plan()
+    activity_1 = db.add_activity(plan_a, start_time=0, args={})
+    activity_2 = db.add_activity(plan_a, start_time=0, args={})
+    plan_b = db.duplicate(plan_a)
+    db.modify_activity(plan_b, activity_1, 1, {})
+    merge_id = db.request_merge(plan_b, plan_a)
+    db.begin_merge(merge_id)
+    db.commit_merge(merge_id)
+    with pytest.raises(Exception) as excinfo:
+        db.request_merge(plan_b, plan_a)
+    assert excinfo.value.args[0] == "Cannot request merge with empty changeset"
+
+    # Against the original merge base, these would conflict with the first merge's change
+    db.modify_activity(plan_b, activity_1, 2, {})
+    merge_id = db.request_merge(plan_b, plan_a)
+    assert db.begin_merge(merge_id) == []
+    db.commit_merge(merge_id)
+    assert db.get_activity_start_time(plan_a, activity_1) == 2
+
+    # And the other way around
+    db.modify_activity(plan_a, activity_1, 3, {})
+    db.modify_activity(plan_a, activity_2, 3, {})
+    merge_id = db.request_merge(plan_a, plan_b)
+    assert db.begin_merge(merge_id) == []
+    db.commit_merge(merge_id)
+    assert db.projections[plan_b] == db.projections[plan_a]
+    log.close()
+
+    reopened = event_log.PlanCollaborationInterface(event_store.SegmentedEventLog(str(tmp_path)))
+    with pytest.raises(Exception) as excinfo:
+        reopened.request_merge(plan_a, plan_b)
+    assert excinfo.value.args[0] == "Cannot request merge with empty changeset"
+    reopened.event_log.close()
+
+
+def test_durable_event_log(tmp_path):
+    log = event_store.SegmentedEventLog(str(tmp_path), segment_size=1024, group_commit_size=8)
+    db = event_log.PlanCollaborationInterface(log)
+    plan_a = db.make_fresh_plan()
+    activity_ids = [db.add_activity(plan_a, start_time=i, args={"i": i}) for i in range(100)]
+    plan_b = db.duplicate(plan_a)
+    for activity_id in activity_ids[::3]:
+        db.modify_activity(plan_b, activity_id, -1, {"modified": True})
+    db.delete_activity(plan_a, activity_ids[0])
+    segments = [name for name in os.listdir(str(tmp_path)) if name.endswith(event_store.SEGMENT_SUFFIX)]
+    assert len(segments) > 1  # rolled over to new segments
+    assert db.get_plan_state_at(plan_b, len(log) - 1) == db.projections[plan_b]
+    # From before plan_a's latest checkpoint, so it is rebuilt from a checkpoint in the checkpoints file
+    assert db.checkpoints[plan_a][0] > 10
+    assert list(db.get_plan_state_at(plan_a, 10)) == activity_ids[:10]
+    log.close()
+
+    # Simulate a crash in the middle of writing a record
+    last_segment = os.path.join(str(tmp_path), max(segments))
+    with open(last_segment, "ab") as f:
+        f.write(event_store.HEADER.pack(100, 0, len(log), plan_a) + b"{")
+
+    reopened = event_log.PlanCollaborationInterface(event_store.SegmentedEventLog(str(tmp_path)))
+    assert len(reopened.event_log) == len(log)
+    assert reopened.projections == db.projections
+    assert reopened.get_activity_ids(plan_a) == activity_ids[1:]
+    assert reopened.event_log[5].payload == log[5].payload == {"type": "ACTIVITY_CREATED", "activity_id": 4, "activity_type": "Type", "start_time": 4, "args": {"i": 4}}
+    new_activity = reopened.add_activity(plan_a, start_time=0, args={})
+    assert new_activity == activity_ids[-1] + 1
+    assert reopened.get_activity_ids(plan_a) == activity_ids[1:] + [new_activity]
+    reopened.event_log.close()
+
+
+def test_group_commit_interval(tmp_path):
+    log = event_store.SegmentedEventLog(str(tmp_path), group_commit_size=1000, group_commit_interval=0.2)
+    db = event_log.PlanCollaborationInterface(log)
+    db.make_fresh_plan()
+    assert log.unsynced == 1
+    # Synced by the timer, although nothing else was appended
+    deadline = time.monotonic() + 5
+    while log.unsynced and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert log.unsynced == 0 and log.timer is None
+    log.close()
+
+
+def test_event_log_compaction():
+    db = event_log.PlanCollaborationInterface()
+    plan_a = db.make_fresh_plan()
+    activity_ids = [db.add_activity(plan_a, start_time=i, args={}) for i in range(10)]
+    plan_b = db.duplicate(plan_a)
+    plan_c = db.duplicate(plan_b)
+    plan_d = db.duplicate(plan_a)
+    db.modify_activity(plan_b, activity_ids[0], 10, {})
+    db.delete_activity(plan_d, activity_ids[1])
+    expected_c = dict(db.projections[plan_c])
+    db.delete(plan_a)
+    db.delete(plan_d)
+    with pytest.raises(Exception):
+        db.add_activity(plan_a, start_time=0, args={})
+    with pytest.raises(Exception):
+        db.duplicate(plan_d)
+
+    while not db.compact(budget=3):
+        db.modify_activity(plan_c, activity_ids[2], 20, {})
+    expected_c[activity_ids[2]] = db.projections[plan_c][activity_ids[2]]
+    assert db.projections[plan_c] == expected_c
+    # plan_a is an ancestor of live plans, so only its creation and deletion remain; plan_d is gone
+    assert [db.event_log[event_id].payload["type"] for event_id in db.plan_event_ids[plan_a]] == ["PLAN_CREATED", "PLAN_DELETED"]
+    assert [db.event_log[event_id].payload["type"] for event_id in db.plan_event_ids[plan_d]] == ["PLAN_DELETED"]
+    assert plan_a not in db.projections and plan_d not in db.creation_events
+    assert db.get_merge_base(plan_c, plan_b) == (db.creation_events[plan_c].event_id, plan_b)
+    assert db.get_plan_state_at(plan_b, db.creation_events[plan_c].event_id)[activity_ids[0]]["start_time"] == 0
+
+
+def test_durable_event_log_compaction(tmp_path):
+    log = event_store.SegmentedEventLog(str(tmp_path), segment_size=1024)
+    db = event_log.PlanCollaborationInterface(log)
+    plan_a = db.make_fresh_plan()
+    for i in range(50):
+        db.add_activity(plan_a, start_time=i, args={"i": i})
+    plan_b = db.duplicate(plan_a)
+    plan_c = db.duplicate(plan_a)
+    db.add_activity(plan_c, start_time=0, args={})
+    db.delete(plan_c)
+    db.delete(plan_a)
+    size = sum(os.path.getsize(os.path.join(str(tmp_path), name)) for name in os.listdir(str(tmp_path)))
+    while not db.compact(budget=10):
+        pass
+    assert sum(os.path.getsize(os.path.join(str(tmp_path), name)) for name in os.listdir(str(tmp_path))) < size
+    assert not log.pending
+    db.add_activity(plan_b, start_time=0, args={})
+    log.close()
+
+    reopened = event_log.PlanCollaborationInterface(event_store.SegmentedEventLog(str(tmp_path)))
+    while not reopened.compact():
+        pass
+    assert reopened.projections == db.projections
+    assert reopened.deleted_plans == {plan_a, plan_c}
+    assert reopened.event_log[1] is None
+    assert reopened.duplicate(plan_b) == plan_c + 1
+    reopened.event_log.close()